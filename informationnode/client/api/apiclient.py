@@ -0,0 +1,348 @@
+'''
+information-node - an advanced tool for data synchronization
+Copyright (C) 2015  Information Node Development Team (see AUTHORS.md)
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 2 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+
+import logging
+import os
+import socket
+import threading
+import time
+
+from informationnode.helper import get_api_socket_for_node, request_json, \
+    negotiate_framing, send_frame, FrameReader, recv_json
+
+class EventSubscription(object):
+    """ A subscription to events of the data server, see
+        ApiClient.subscribe. Call close() to end it.
+    """
+    def __init__(self, sock, subscription_id, on_events, on_disconnect):
+        self.sock = sock
+        self.subscription_id = subscription_id
+        self.on_events = on_events
+        self.on_disconnect = on_disconnect
+        self.closed = False
+        self.thread = threading.Thread(target=self._listen, daemon=True)
+        self.thread.start()
+
+    def _listen(self):
+        # events may take arbitrarily long to arrive:
+        self.sock.settimeout(None)
+        while True:
+            msg = recv_json(self.sock)
+            if msg == None:
+                break
+            if msg.get("action", None) != "event":
+                continue
+            try:
+                self.on_events(msg["events"])
+            except Exception as e:
+                logging.exception("[client.api.EventSubscription] " +\
+                    "error in event callback: " + str(e))
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+        if not self.closed and self.on_disconnect != None:
+            self.on_disconnect()
+
+    def close(self):
+        self.closed = True
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+class ApiClient(object):
+    """ Talks to the data server of a node directly through its api socket
+        (api_access.sock), without launching an information-node process
+        for each request.
+
+        Connections are kept open in a small pool and reused. If a pooled
+        connection turns out to be broken (e.g. because the data server was
+        restarted), the request is retried once on a fresh connection.
+
+        This class is thread-safe. Use get_api_client() to get the shared
+        instance for a node.
+    """
+    def __init__(self, node_path, max_idle_connections=4):
+        self.node_path = node_path
+        self.max_idle_connections = max_idle_connections
+        self.idle_connections = []
+        self.lock = threading.Lock()
+
+    def _get_connection(self):
+        """ Returns (True, socket, reused) or (False, error_msg, False). """
+        with self.lock:
+            if len(self.idle_connections) > 0:
+                return (True, self.idle_connections.pop(), True)
+        try:
+            (result, sock) = get_api_socket_for_node(self.node_path)
+        except OSError as e:
+            return (False, "couldn't connect to data server: " + str(e),
+                False)
+        return (result, sock, False)
+
+    def _release_connection(self, sock):
+        with self.lock:
+            if len(self.idle_connections) < self.max_idle_connections:
+                self.idle_connections.append(sock)
+                return
+        sock.close()
+
+    def request(self, json_obj, max_busy_retries=20):
+        """ Send the given request to the data server and wait for the
+            response. Busy responses are retried as suggested by the data
+            server, see helper.request_json.
+
+            Returns (True, response) on success, and (False, error_msg) on
+            failure.
+        """
+        while True:
+            (result, sock, reused) = self._get_connection()
+            if not result:
+                return (False, sock)
+            response = request_json(sock, json_obj,
+                max_busy_retries=max_busy_retries)
+            if response != None:
+                self._release_connection(sock)
+                return (True, response)
+            sock.close()
+            if not reused:
+                return (False, "connection to data server lost")
+            # the pooled connection was stale, try again with a new one:
+            logging.debug("[client.api.ApiClient] reconnecting to " +\
+                str(self.node_path))
+
+    def batch(self, requests, atomic=False, max_busy_retries=20):
+        """ Send many requests to the data server in one round trip, using
+            the "batch" action. If atomic is True, the storage changes of the
+            requests are only done if all of them succeed, which only
+            permission changes support (see the "raw-cmd" help).
+
+            Returns (True, list of responses) on success, and
+            (False, error_msg or error response) on failure.
+        """
+        (result, response) = self.request({"action" : "batch",
+            "requests" : requests, "atomic" : atomic},
+            max_busy_retries=max_busy_retries)
+        if not result:
+            return (False, response)
+        if response.get("response_type", None) != "success":
+            return (False, response)
+        return (True, response["results"])
+
+    def subscribe(self, on_events, event_types=None, on_disconnect=None):
+        """ Subscribe to events of the data server on a separate long-lived
+            connection. on_events(events) is called with each list of events
+            as they arrive, and on_disconnect() when the connection to the
+            data server is lost (e.g. because it was stopped). Both are
+            called from the subscription's own thread.
+
+            Returns (True, EventSubscription) on success, and
+            (False, error_msg) on failure.
+        """
+        try:
+            (result, sock) = get_api_socket_for_node(self.node_path)
+        except OSError as e:
+            return (False, "couldn't connect to data server: " + str(e))
+        if not result:
+            return (False, sock)
+        msg = {"action" : "subscribe"}
+        if event_types != None:
+            msg["events"] = event_types
+        response = request_json(sock, msg)
+        if response == None or \
+                response.get("response_type", None) != "success":
+            sock.close()
+            if response == None:
+                return (False, "connection to data server lost")
+            return (False, response.get("error_info", str(response)))
+        return (True, EventSubscription(sock, response["subscription_id"],
+            on_events, on_disconnect))
+
+    def _open_stream_connection(self):
+        """ Open a new connection with binary framing for streaming, which is
+            not part of the pool. Returns (True, socket, reader) or
+            (False, error_msg, None).
+        """
+        try:
+            (result, sock) = get_api_socket_for_node(self.node_path)
+        except OSError as e:
+            return (False, "couldn't connect to data server: " + str(e),
+                None)
+        if not result:
+            return (False, sock, None)
+        if not negotiate_framing(sock, "binary"):
+            sock.close()
+            return (False, "data server refused binary framing", None)
+        return (True, sock, FrameReader(sock))
+
+    def _recv_stream_msg(self, sock, reader, resend):
+        """ Receive the next message of a stream. If it is a busy response,
+            resend(msg) is called after waiting as suggested.
+            Returns (msg, data), (None, None) if the connection broke.
+        """
+        while True:
+            (msg, data) = reader.recv()
+            if msg == None or msg.get("response_type", None) != "busy":
+                return (msg, data)
+            time.sleep(max(int(msg.get("retry_after_ms", 100)), 1) / 1000.0)
+            if not resend(msg):
+                return (None, None)
+
+    def upload(self, item_id, fileobj):
+        """ Upload the contents of the given binary file object as a new
+            content version of the item with the given identifier, streamed
+            chunk by chunk with constant memory use.
+
+            Returns (True, response) on success, and (False, error_msg) on
+            failure.
+        """
+        (result, sock, reader) = self._open_stream_connection()
+        if not result:
+            return (False, sock)
+        try:
+            if not send_frame(sock, {"action" : "stream-upload",
+                    "item_id" : item_id}):
+                return (False, "connection to data server lost")
+            (response, unused) = reader.recv()
+            if response == None or \
+                    response.get("response_type", None) != "success":
+                return (False, response)
+            stream_id = response["stream_id"]
+            chunk_size = response["chunk_size"]
+
+            # unacknowledged chunks stay in their buffer, so they can be sent
+            # again if the data server was busy:
+            free_buffers = [bytearray(chunk_size) \
+                for i in range(max(1, response["window"]))]
+            pending = dict()
+            def send_chunk(chunk_no):
+                (buf, length) = pending[chunk_no]
+                return send_frame(sock, {"action" : "stream-data",
+                    "stream_id" : stream_id, "item_id" : item_id,
+                    "chunk_no" : chunk_no, "request_id" : chunk_no},
+                    memoryview(buf)[:length])
+            def wait_for_ack():
+                (msg, unused) = self._recv_stream_msg(sock, reader,
+                    lambda msg: send_chunk(msg["request_id"]))
+                if msg == None or msg.get("response_type", None) != \
+                        "stream-ack":
+                    return False
+                free_buffers.append(pending.pop(msg["chunk_no"])[0])
+                return True
+
+            chunk_no = 0
+            at_end = False
+            while not at_end:
+                if len(free_buffers) == 0 and not wait_for_ack():
+                    return (False, "stream upload failed")
+                buf = free_buffers.pop()
+                view = memoryview(buf)
+                length = 0
+                while length < chunk_size:
+                    amount = fileobj.readinto(view[length:])
+                    if amount == None or amount == 0:
+                        at_end = True
+                        break
+                    length += amount
+                if length == 0:
+                    free_buffers.append(buf)
+                    break
+                pending[chunk_no] = (buf, length)
+                if not send_chunk(chunk_no):
+                    return (False, "connection to data server lost")
+                chunk_no += 1
+            while len(pending) > 0:
+                if not wait_for_ack():
+                    return (False, "stream upload failed")
+
+            end_msg = {"action" : "stream-end", "stream_id" : stream_id,
+                "item_id" : item_id, "chunk_count" : chunk_no}
+            if not send_frame(sock, end_msg):
+                return (False, "connection to data server lost")
+            (response, unused) = self._recv_stream_msg(sock, reader,
+                lambda msg: send_frame(sock, end_msg))
+            if response == None or \
+                    response.get("response_type", None) != "success":
+                return (False, response)
+            return (True, response)
+        finally:
+            sock.close()
+
+    def download(self, item_id, fileobj, from_chunk=0):
+        """ Download the contents of the item with the given identifier into
+            the given binary file object, streamed chunk by chunk with
+            constant memory use.
+
+            Returns (True, chunk_count) on success, and (False, error_msg) on
+            failure.
+        """
+        (result, sock, reader) = self._open_stream_connection()
+        if not result:
+            return (False, sock)
+        try:
+            if not send_frame(sock, {"action" : "stream-download",
+                    "item_id" : item_id, "from_chunk" : from_chunk}):
+                return (False, "connection to data server lost")
+            (response, unused) = reader.recv()
+            if response == None or \
+                    response.get("response_type", None) != "success":
+                return (False, response)
+            stream_id = response["stream_id"]
+            def send_ack():
+                return send_frame(sock, {"action" : "stream-ack",
+                    "stream_id" : stream_id, "item_id" : item_id,
+                    "count" : 1})
+            while True:
+                (msg, data) = self._recv_stream_msg(sock, reader,
+                    lambda msg: send_ack())
+                if msg == None:
+                    return (False, "connection to data server lost")
+                if msg.get("action", None) == "stream-end":
+                    return (True, msg["chunk_count"])
+                if msg.get("action", None) != "stream-data":
+                    return (False, msg)
+                if data != None:
+                    fileobj.write(data)
+                if not send_ack():
+                    return (False, "connection to data server lost")
+        finally:
+            sock.close()
+
+    def close(self):
+        """ Close all pooled connections. """
+        with self.lock:
+            connections = self.idle_connections
+            self.idle_connections = []
+        for sock in connections:
+            try:
+                sock.close()
+            except OSError:
+                pass
+
+_api_clients = dict()
+_api_clients_lock = threading.Lock()
+
+def get_api_client(node_path):
+    """ Get the shared ApiClient for the node at the given path. """
+    node_path = os.path.normpath(os.path.abspath(node_path))
+    with _api_clients_lock:
+        if not node_path in _api_clients:
+            _api_clients[node_path] = ApiClient(node_path)
+        return _api_clients[node_path]
@@ -20,12 +20,26 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import json
 import logging
+import os
 import subprocess
 
+from informationnode.client.api.apiclient import get_api_client
+
 class NodeAction(object):
+    """ An action to be run on a node. Requests which only talk to the data
+        server ("raw-cmd" and "ping" of information-node) are sent directly
+        through the node's pooled ApiClient, everything else is done by
+        running the respective tool.
+
+        A "ping" returns (True, pong response) with answer_is_json, and
+        (True, "Pong received.\n") without.
+    """
+    API_CMDS = ["raw-cmd", "ping"]
+
     def __init__(self, node_path, json_request,
             tool="information-node", cmd="raw-cmd",
-            cmd_args=[], answer_is_json=True, reason=None):
+            cmd_args=[], answer_is_json=True, reason=None, api_client=None):
+        self.api_client = api_client
         self.answer_is_json = answer_is_json
         self.node_path = node_path
         self.tool = tool
@@ -41,12 +55,51 @@ class NodeAction(object):
             + "\", tool=\"" + self.tool + \
             "\", cmd=\"" + self.cmd + "\")"
 
+    def uses_api_client(self):
+        """ Whether this action is sent directly to the data server instead of
+            running a tool process.
+        """
+        return os.path.basename(self.tool) == "information-node" and \
+            self.cmd in self.API_CMDS and len(self.cmd_args) == 0
+
+    def _run_with_api_client(self):
+        api_client = self.api_client
+        if api_client == None:
+            api_client = get_api_client(self.node_path)
+        if self.cmd == "ping":
+            request = {"action" : "ping"}
+        else:
+            try:
+                request = json.loads(self.json_request)
+            except ValueError:
+                return (False, "invalid JSON request")
+        (result, response) = api_client.request(request)
+        self._done = True
+        if not result:
+            logging.debug("[client.api.NodeAction] api request failed: " +\
+                str(response))
+            return (False, response)
+
+        # return the same output the information-node tool would print:
+        if self.cmd == "ping":
+            if not isinstance(response, dict) or \
+                    response.get("action", None) != "pong":
+                return (False, "invalid response.")
+            if self.answer_is_json:
+                return (True, response)
+            return (True, "Pong received.\n")
+        if self.answer_is_json:
+            return (True, response)
+        return (True, json.dumps(response) + "\n")
+
     def run(self):
         """ Returns (True, json_obj) on success, and
             (False, error_msg) on failure.
         """
         logging.debug("[client.api.NodeAction] Running action " +\
             self.__repr__(redact_details=True))
+        if self.uses_api_client():
+            return self._run_with_api_client()
         program = subprocess.Popen([self.tool] + \
             [self.cmd] + [self.node_path] + self.cmd_args,
             stdout=subprocess.PIPE,
@@ -18,25 +18,27 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 '''
 
+from informationnode.client.api.apiclient import get_api_client
 from informationnode.client.api.nodeaction import NodeAction
 import logging
 import os
-import subprocess
+import shutil
 
 class NodeActions(object):
     def __init__(self, app, keep_history=False):
         self.app = app
         self.history = dict()
         self.keep_history = keep_history
+        self._tools_installed = None
 
     def are_tools_installed(self):
-        try:
-            with open(os.devnull, 'w') as nullfile:
-                subprocess.check_output(["information-node", "--help"],
-                    stderr=nullfile)
-            return True
-        except (subprocess.CalledProcessError, FileNotFoundError):
-            return False
+        """ Check whether the tools are installed in the PATH. The result is
+            remembered, so this doesn't cost anything after the first call.
+        """
+        if self._tools_installed == None:
+            self._tools_installed = \
+                (shutil.which("information-node") != None)
+        return self._tools_installed
 
     def do(self, node_url, json, tool="information-node",
             cmd="raw-cmd", cmd_args=[], answer_is_json=False,
@@ -47,7 +49,7 @@ class NodeActions(object):
                 "..", "..", "..", tool)
         action = NodeAction(node_url, json, tool=tool, cmd=cmd,
             cmd_args=cmd_args, answer_is_json=answer_is_json,
-            reason=reason)
+            reason=reason, api_client=get_api_client(node_url))
         print("keep history: " + str(self.keep_history))
         if self.keep_history:
             print("putting into history: " + str(action))
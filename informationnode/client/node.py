@@ -19,10 +19,12 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 '''
 
 from enum import Enum
+from informationnode.client.api.apiclient import get_api_client
 from informationnode.helper import check_if_node_dir, check_if_node_runs
 import logging
 import os
 import sys
+import threading
 import time
 
 class NodeState(Enum):
@@ -59,6 +61,12 @@ class Node(object):
         self.state = NodeState.UNKNOWN
         self.path = path
 
+        # while the data server runs, a subscription to its events tells us
+        # about changes, so we don't need to poll it:
+        self.subscription = None
+        self.subscription_lock = threading.Lock()
+        self.state_listeners = []
+
         # see if this is a valid node:
         (result, msg) = check_if_node_dir(path)
         if not result and not create_new:
@@ -107,15 +115,62 @@ class Node(object):
             self._detect_state()
         return (result, content)
 
+    def add_state_listener(self, func):
+        """ Have func(node) called when the node's state changes on its own,
+            e.g. because the data server was stopped. Note that func is
+            called from a background thread.
+        """
+        if not func in self.state_listeners:
+            self.state_listeners.append(func)
+
+    def remove_state_listener(self, func):
+        if func in self.state_listeners:
+            self.state_listeners.remove(func)
+
+    def _notify_state_listeners(self):
+        for func in list(self.state_listeners):
+            func(self)
+
+    def _subscribe(self):
+        """ Internal function which subscribes to the data server's events
+            once it is reachable.
+        """
+        with self.subscription_lock:
+            if self.subscription != None:
+                return
+            (result, subscription) = get_api_client(self.path).subscribe(
+                self._on_events, on_disconnect=self._on_data_server_lost)
+            if not result:
+                logging.debug("[client.Node] subscribing to data server " +\
+                    "events failed: " + str(subscription))
+                return
+            self.subscription = subscription
+
+    def _on_events(self, events):
+        if len([e for e in events if e["event"] == "daemon-state"]) > 0:
+            self.state = NodeState.UNKNOWN
+            self._detect_state()
+        self._notify_state_listeners()
+
+    def _on_data_server_lost(self):
+        with self.subscription_lock:
+            self.subscription = None
+        self.state = NodeState.UNKNOWN
+        self._detect_state()
+        self._notify_state_listeners()
+
     def _check_node_data_server(self, force_recheck=False):
         """ Internal function which checks the state of the data server. The
             data server will be pinged if it appears to be running to make
             sure it is reachable, unless this has already been done before.
 
             To force another ping to make sure it is still reachable right
-            now, use force_recheck = True.
+            now, use force_recheck = True. This isn't necessary while the node
+            is subscribed to the data server's events, since a lost
+            connection is noticed right away then.
         """
-        if self.state == NodeState.DATA_SERVER_ON and not force_recheck:
+        if self.state == NodeState.DATA_SERVER_ON and (not force_recheck or \
+                self.subscription != None):
             return
 
         # check if there's a data server process:
@@ -135,6 +190,7 @@ class Node(object):
             self.state = NodeState.DATA_SERVER_UNREACHABLE
         else:
             self.state = NodeState.DATA_SERVER_ON
+            self._subscribe()
 
     def _detect_state(self):
         """ Internal function to detect/update the node's state.
@@ -153,11 +209,18 @@ class Node(object):
         (result, content) = action.run()
         return (result, content)
 
+    def close(self):
+        """ Stop watching the node's data server. """
+        self.state_listeners = []
+        with self.subscription_lock:
+            if self.subscription != None:
+                self.subscription.close()
+                self.subscription = None
+
     def __del__(self):
         self._detect_state()
 
         # clean up:
-
-        pass
+        self.close()
 
 
@@ -0,0 +1,159 @@
+'''
+information-node - an advanced tool for data synchronization
+Copyright (C) 2015  Information Node Development Team (see AUTHORS.md)
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 2 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import unittest
+
+from informationnode.client.api.apiclient import ApiClient
+from informationnode.client.api.nodeaction import NodeAction
+from informationnode.daemon.apiserver import FileSocketApiServer, \
+    make_response
+
+class EchoDaemon(object):
+    """ Serves the api socket of a node folder and answers every request
+        with its "value".
+    """
+    def __init__(self, node_path):
+        self.requests = 0
+        api_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        api_socket.bind(os.path.join(node_path, "api_access.sock"))
+        self.api_server = FileSocketApiServer(self, api_socket)
+        self.thread = threading.Thread(target=self.api_server.run)
+        self.thread.start()
+
+    def queue_internal_request(self, client, msg, data=None):
+        self.requests += 1
+        client.respond(make_response(msg, value=msg.get("value", None)))
+        client.request_done()
+        return (True, 0)
+
+    def api_retry_after_ms(self, msg):
+        return 100
+
+    def terminate(self):
+        self.api_server.terminate()
+        self.thread.join()
+        self.api_server.api_socket.close()
+
+class FakeApiClient(object):
+    def __init__(self, response):
+        self.response = response
+        self.requests = []
+
+    def request(self, json_obj):
+        self.requests.append(json_obj)
+        return (True, self.response)
+
+class TestApiClient(unittest.TestCase):
+    def setUp(self):
+        self.node_path = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.node_path, "storage"))
+        for name, contents in [("identity.secret", "-"),
+                ("pidfile", str(os.getpid()))]:
+            with open(os.path.join(self.node_path, name), "w") as f:
+                f.write(contents)
+        self.daemon = EchoDaemon(self.node_path)
+        self.client = ApiClient(self.node_path, max_idle_connections=1)
+
+    def tearDown(self):
+        self.client.close()
+        self.daemon.terminate()
+        shutil.rmtree(self.node_path)
+
+    def test_pooling(self):
+        for i in range(5):
+            self.assertEqual(self.client.request({"action" : "echo",
+                "value" : i})[1]["value"], i)
+        # all requests went over the same pooled connection:
+        self.assertEqual(len(self.client.idle_connections), 1)
+        self.assertEqual(self.daemon.api_server.client_count(), 1)
+
+        # connections beyond max_idle_connections are closed when done:
+        (result, sock, reused) = self.client._get_connection()
+        (result, other_sock, reused) = self.client._get_connection()
+        self.assertFalse(reused)
+        self.client._release_connection(sock)
+        self.client._release_connection(other_sock)
+        self.assertEqual(self.client.idle_connections, [sock])
+
+    def test_reconnect(self):
+        # a pooled connection whose other end went away, like after a
+        # restart of the data server:
+        (stale, peer) = socket.socketpair()
+        peer.close()
+        self.client.idle_connections = [stale]
+        (result, response) = self.client.request({"action" : "echo",
+            "value" : "x"})
+        self.assertTrue(result, response)
+        self.assertEqual(response["value"], "x")
+        self.assertEqual(self.daemon.requests, 1)
+        self.assertEqual(stale.fileno(), -1)
+
+        # without a data server, there is nothing to reconnect to:
+        self.daemon.terminate()
+        os.remove(os.path.join(self.node_path, "api_access.sock"))
+        self.client.close()
+        (result, response) = self.client.request({"action" : "echo"})
+        self.assertFalse(result)
+        self.daemon = EchoDaemon(self.node_path)
+
+class TestNodeActionRouting(unittest.TestCase):
+    def test_uses_api_client(self):
+        self.assertTrue(NodeAction("node", '{"action" : "x"}').\
+            uses_api_client())
+        self.assertTrue(NodeAction("node", "", cmd="ping",
+            tool="/usr/bin/information-node").uses_api_client())
+        self.assertFalse(NodeAction("node", "", cmd="node",
+            answer_is_json=False).uses_api_client())
+        self.assertFalse(NodeAction("node", "", cmd="raw-cmd",
+            cmd_args=["--other"]).uses_api_client())
+        self.assertFalse(NodeAction("node", "", tool="inode-viewer-cli",
+            cmd="ping").uses_api_client())
+
+    def test_run_with_api_client(self):
+        api_client = FakeApiClient({"action" : "response",
+            "response_type" : "success", "value" : 1})
+        self.assertEqual(NodeAction("node", '{"action" : "x"}',
+            api_client=api_client).run(), (True, api_client.response))
+        self.assertEqual(api_client.requests, [{"action" : "x"}])
+        self.assertEqual(NodeAction("node", '{"action" : "x"}',
+            answer_is_json=False, api_client=api_client).run(),
+            (True, '{"action": "response", "response_type": "success", ' +\
+            '"value": 1}\n'))
+        self.assertEqual(NodeAction("node", "not json",
+            api_client=api_client).run()[0], False)
+
+    def test_ping(self):
+        api_client = FakeApiClient({"action" : "pong"})
+        self.assertEqual(NodeAction("node", "", cmd="ping",
+            api_client=api_client).run(), (True, {"action" : "pong"}))
+        self.assertEqual(NodeAction("node", "", cmd="ping",
+            answer_is_json=False, api_client=api_client).run(),
+            (True, "Pong received.\n"))
+        self.assertEqual(api_client.requests, [{"action" : "ping"}] * 2)
+        api_client.response = {"action" : "response"}
+        self.assertFalse(NodeAction("node", "", cmd="ping",
+            api_client=api_client).run()[0])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -19,7 +19,7 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 '''
 
 from enum import Enum
-from gi.repository import Gtk
+from gi.repository import GLib, Gtk
 from informationnode.helper import check_if_node_dir, check_if_node_runs
 import informationnode.uilib as uilib
 from informationnode.client.node import Node, NodeState
@@ -271,6 +271,7 @@ class NodeWindow(uilib.Window):
 
         # adapt window/menus to reflect the state:
         if opened:
+            self.node.add_state_listener(self.node_state_changed)
             can_use = self.node.can_use()
             self.menu.nodemenu.close.enable()
             if can_use:
@@ -293,6 +294,16 @@ class NodeWindow(uilib.Window):
             if previously_usable != self.node.can_use():
                 self.notebook_update_usable_state()
 
+    def node_state_changed(self, node):
+        """ Called from a background thread when the node's state changed,
+            e.g. because its data server was stopped.
+        """
+        def update():
+            if node == self.node:
+                self.update_node_state()
+            return False
+        GLib.idle_add(update)
+
     def nodemenu_open_remote(self, widget):
         print("TEST")        
 
@@ -332,6 +343,7 @@ class NodeWindow(uilib.Window):
     def nodemenu_close(self, widget):
         if self.node == None:
             return
+        self.node.close()
         del(self.node)
         self.node = None
         self.update_node_state()    
@@ -0,0 +1,415 @@
+'''
+information-node - an advanced tool for data synchronization
+Copyright (C) 2015  Information Node Development Team (see AUTHORS.md)
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 2 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+
+import collections
+import itertools
+import logging
+from selectors import DefaultSelector, EVENT_READ, EVENT_WRITE
+import socket
+import threading
+
+from informationnode.helper import encode_json, encode_frame, \
+    decode_json_msg, decode_frame
+
+def make_response(msg, response_type="success", **info):
+    """ Build a response to the given api msg. Any further keyword arguments
+        are added to the response as they are.
+
+        If the msg carried a "request_id", it is echoed back so clients can
+        pipeline requests and match up responses arriving out of order.
+    """
+    response = {"action" : "response",
+        "responded_action" : str(msg.get("action", "")),
+        "response_type" : response_type}
+    response.update(info)
+    if "request_id" in msg:
+        response["request_id"] = msg["request_id"]
+    return response
+
+class FileSocketApiClient(object):
+    """ A client connected to the api socket (api_access.sock). It doesn't
+        have a thread of its own, all reading and writing is done by the
+        FileSocketApiServer's event loop.
+
+        Requests may carry a "request_id" which is echoed back in the
+        response. A client can therefore send many requests without waiting,
+        and will get the responses in whatever order the internal api
+        processor finishes them.
+
+        Clients start out with length-prefixed JSON messages and may switch
+        to binary frames with a "set-framing" request, see helper.py. They
+        must not have other requests in flight while doing so.
+    """
+    def __init__(self, server, socket, address):
+        self.server = server
+        self.daemon = server.daemon
+        self.address = address
+        self.socket = socket
+        self.framing = "json"
+        self.recv_buf = bytearray()
+        self.send_queue = collections.deque()
+        self.send_pending = 0
+        self.send_lock = threading.Lock()
+        self.in_flight = 0
+        self.in_flight_lock = threading.Lock()
+        self.close_callbacks = []
+
+    def process_msg(self, msg, data=None):
+        """ Process an API msg that was received, with the raw data attached
+            to it if binary framing is used.
+        """
+        logging.debug("received msg from: " + str(self.address))
+        logging.debug("msg contents: " + str(msg))
+        if not isinstance(msg, dict) or not "action" in msg:
+            # whoops this is invalid.
+            return False
+        if msg["action"] == "ping":
+            response = {"action":"pong"}
+            if "request_id" in msg:
+                response["request_id"] = msg["request_id"]
+            return self.respond(response)
+        elif msg["action"] == "set-framing":
+            if not msg.get("framing", None) in ["json", "binary"]:
+                return self.respond(make_response(msg, "error",
+                    error_info="unknown framing, use \"json\" or " +\
+                    "\"binary\""))
+            # respond with the old framing, then switch:
+            result = self.respond(make_response(msg))
+            self.framing = msg["framing"]
+            return result
+        elif msg["action"] == "status":
+            # answered right away, so it works even if the internal api
+            # processor is saturated:
+            return self.respond(make_response(msg,
+                status=self.daemon.get_status()))
+        elif msg["action"] == "shutdown":
+            result = self.respond(make_response(msg))
+            self.daemon.terminate()
+            return result
+        else:
+            # everything else is done by the internal api processor, which
+            # will respond whenever it is done. Refuse if this client or the
+            # daemon as a whole already has too much going on:
+            with self.in_flight_lock:
+                if self.in_flight >= self.server.max_in_flight:
+                    return self.respond_busy(msg,
+                        self.daemon.api_retry_after_ms(msg),
+                        "too many requests in flight on this connection")
+                self.in_flight += 1
+            (result, retry_after_ms) = \
+                self.daemon.queue_internal_request(self, msg, data)
+            if not result:
+                self.request_done()
+                return self.respond_busy(msg, retry_after_ms,
+                    "data server is busy")
+            return True
+
+    def respond_busy(self, msg, retry_after_ms, reason):
+        """ Tell the client to back off and send the msg again later. """
+        return self.respond(make_response(msg, "busy",
+            retry_after_ms=retry_after_ms,
+            error_info=reason + ", retry after " + str(retry_after_ms) +\
+            "ms"))
+
+    def request_done(self):
+        """ Called when a request handed to the internal api processor was
+            completed.
+        """
+        with self.in_flight_lock:
+            self.in_flight -= 1
+
+    def respond(self, obj, data=None):
+        """ Queue up the given response for sending, with optional raw data
+            attached if binary framing is used. This may be called from
+            any thread - if not called from the event loop, the event loop
+            is woken up to do the actual sending.
+        """
+        # check the connection still being open:
+        if self.socket == None:
+            # client was already closed.
+            return False
+        with self.send_lock:
+            if self.framing == "binary":
+                buffers = encode_frame(obj, data)
+            else:
+                if data != None:
+                    raise ValueError("raw data can only be sent with " +\
+                        "binary framing")
+                buffers = [encode_json(obj)]
+            for buf in buffers:
+                self.send_queue.append(memoryview(buf).cast("B"))
+                self.send_pending += len(self.send_queue[-1])
+        if not self.server.in_loop_thread():
+            self.server.request_flush(self)
+            return True
+        return self.flush()
+
+    def flush(self):
+        """ Send as much of the pending output as the socket takes without
+            blocking. Returns False if the connection broke.
+        """
+        if self.socket == None:
+            return False
+        try:
+            with self.send_lock:
+                while len(self.send_queue) > 0:
+                    if hasattr(self.socket, "sendmsg"):
+                        sent = self.socket.sendmsg(list(itertools.islice(
+                            self.send_queue, 0, 64)))
+                    else:
+                        # e.g. on windows.
+                        sent = self.socket.send(self.send_queue[0])
+                    if sent <= 0:
+                        break
+                    self.send_pending -= sent
+                    while sent > 0:
+                        if sent >= len(self.send_queue[0]):
+                            sent -= len(self.send_queue.popleft())
+                        else:
+                            self.send_queue[0] = self.send_queue[0][sent:]
+                            sent = 0
+        except (BlockingIOError, InterruptedError):
+            pass
+        except OSError:
+            return False
+        self.server.update_interest(self)
+        return True
+
+    def handle_readable(self):
+        """ Called by the event loop when there is data to read. Returns
+            False if the client should be dropped.
+        """
+        try:
+            data = self.socket.recv(64 * 1024)
+        except (BlockingIOError, InterruptedError):
+            return True
+        except OSError:
+            return False
+        if len(data) == 0:
+            # connection closed by the other side.
+            return False
+        self.recv_buf += data
+
+        # process all complete messages. This is done one by one, since
+        # the framing can change in between:
+        offset = 0
+        try:
+            while self.socket != None:
+                if self.framing == "binary":
+                    (msg, data, offset) = decode_frame(self.recv_buf, offset)
+                else:
+                    data = None
+                    (msg, offset) = decode_json_msg(self.recv_buf, offset)
+                if msg == None:
+                    break
+                try:
+                    if not self.process_msg(msg, data):
+                        return False
+                except Exception as e:
+                    logging.exception("Error in " +\
+                        "FileSocketApiClient.process_msg: " + str(e))
+                    return False
+        except ValueError:
+            # oversized or broken message.
+            return False
+        finally:
+            del(self.recv_buf[:offset])
+        return True
+
+    def add_close_callback(self, func):
+        """ Have func() called once the connection is closed, e.g. to clean
+            up state kept for this client.
+        """
+        self.close_callbacks.append(func)
+
+    def force_terminate(self):
+        try:
+            self.socket.close()
+        except (OSError, AttributeError):
+            pass
+        self.socket = None
+        (callbacks, self.close_callbacks) = (self.close_callbacks, [])
+        for func in callbacks:
+            try:
+                func()
+            except Exception as e:
+                logging.exception("Error in close callback: " + str(e))
+
+    def terminated(self):
+        if self.socket == None:
+            return True
+        return False
+
+class FileSocketApiServer(object):
+    """ Serves all clients of the api socket (api_access.sock) on a single
+        selectors-based event loop, instead of running a thread per
+        connection. Closed connections are reaped as soon as they are
+        noticed.
+
+        Call run() from a thread of its own, and terminate() from any thread
+        to stop it.
+
+        Each client may only have max_in_flight requests waiting for the
+        internal api processor, further ones are answered with a "busy"
+        response. A client which doesn't read its responses isn't read from
+        anymore once max_send_buffer bytes of responses are pending.
+    """
+    def __init__(self, daemon, api_socket, max_in_flight=64,
+            max_send_buffer=(1024 * 1024)):
+        self.daemon = daemon
+        self.max_in_flight = max_in_flight
+        self.max_send_buffer = max_send_buffer
+        self.api_socket = api_socket
+        self.api_socket.listen(100)
+        self.api_socket.setblocking(False)
+        self.clients = dict()
+        self.selector = DefaultSelector()
+        self._terminate = False
+        self._loop_thread_id = None
+        self._pending_flush = set()
+        self._pending_flush_lock = threading.Lock()
+
+        # socket pair to wake up the event loop from other threads:
+        (self._wakeup_recv, self._wakeup_send) = socket.socketpair()
+        self._wakeup_recv.setblocking(False)
+        self._wakeup_send.setblocking(False)
+
+    def wakeup(self):
+        """ Wake up the event loop if it's waiting in select(). """
+        try:
+            self._wakeup_send.send(b"\0")
+        except (BlockingIOError, OSError):
+            # the loop has a wakeup pending already, or is gone.
+            pass
+
+    def terminate(self):
+        """ Stop the event loop. Can be called from any thread. """
+        self._terminate = True
+        self.wakeup()
+
+    def in_loop_thread(self):
+        return threading.get_ident() == self._loop_thread_id
+
+    def request_flush(self, client):
+        """ Have the event loop send out the client's pending output. Used
+            when responses are produced by other threads.
+        """
+        with self._pending_flush_lock:
+            self._pending_flush.add(client)
+        self.wakeup()
+
+    def _flush_pending(self):
+        with self._pending_flush_lock:
+            pending = self._pending_flush
+            self._pending_flush = set()
+        for client in pending:
+            if client.socket != None and not client.flush():
+                self._drop_client(client)
+
+    def client_count(self):
+        return len(self.clients)
+
+    def update_interest(self, client):
+        """ Watch the client for writability only while output is pending,
+            and stop reading from it while too much output is pending.
+        """
+        if client.socket == None or not client.socket in self.clients:
+            return
+        events = 0
+        if client.send_pending < self.max_send_buffer:
+            events |= EVENT_READ
+        if client.send_pending > 0:
+            events |= EVENT_WRITE
+        if self.selector.get_key(client.socket).events != events:
+            self.selector.modify(client.socket, events, client)
+
+    def _accept_clients(self):
+        while True:
+            try:
+                (c, addr) = self.api_socket.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            c.setblocking(False)
+            client = FileSocketApiClient(self, c, addr)
+            self.clients[c] = client
+            self.selector.register(c, EVENT_READ, client)
+            logging.debug("[api_socket_processor] new client, " +\
+                str(len(self.clients)) + " connected")
+
+    def _drop_client(self, client):
+        if client.socket != None:
+            try:
+                self.selector.unregister(client.socket)
+            except (KeyError, ValueError):
+                pass
+            if client.socket in self.clients:
+                del(self.clients[client.socket])
+        client.force_terminate()
+        logging.debug("[api_socket_processor] client closed, " +\
+            str(len(self.clients)) + " connected")
+
+    def _shutdown_clients(self):
+        for client in list(self.clients.values()):
+            # try to get out any remaining responses (e.g. to "shutdown"):
+            if client.send_pending > 0 and client.socket != None:
+                try:
+                    client.socket.settimeout(1.0)
+                    for buf in client.send_queue:
+                        client.socket.sendall(buf)
+                except OSError:
+                    pass
+            self._drop_client(client)
+
+    def run(self):
+        logging.debug("[api_socket_processor] starting...")
+        self._loop_thread_id = threading.get_ident()
+        self.selector.register(self.api_socket, EVENT_READ, None)
+        self.selector.register(self._wakeup_recv, EVENT_READ, None)
+        logging.debug("[api_socket_processor] now listening")
+        try:
+            while not self._terminate:
+                for (key, mask) in self.selector.select():
+                    if key.fileobj == self._wakeup_recv:
+                        try:
+                            while len(self._wakeup_recv.recv(1024)) > 0:
+                                pass
+                        except (BlockingIOError, InterruptedError):
+                            pass
+                        self._flush_pending()
+                        continue
+                    if key.fileobj == self.api_socket:
+                        self._accept_clients()
+                        continue
+                    client = key.data
+                    if client.socket == None:
+                        # dropped earlier in this iteration.
+                        continue
+                    if mask & EVENT_READ:
+                        if not client.handle_readable():
+                            self._drop_client(client)
+                            continue
+                    if mask & EVENT_WRITE and client.socket != None:
+                        if not client.flush():
+                            self._drop_client(client)
+            logging.debug("[api_socket_processor] shutting down...")
+        finally:
+            self._shutdown_clients()
+            self.selector.close()
+            self._wakeup_recv.close()
+            self._wakeup_send.close()
@@ -0,0 +1,155 @@
+'''
+information-node - an advanced tool for data synchronization
+Copyright (C) 2015  Information Node Development Team (see AUTHORS.md)
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 2 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+
+import json
+import logging
+
+from informationnode.daemon.apiserver import make_response
+
+class BatchResultCollector(object):
+    """ Stands in for the api client while the sub-requests of a batch are
+        processed, and collects their responses instead of sending them.
+    """
+    def __init__(self, client):
+        self.client = client
+        self.framing = client.framing
+        self.responses = []
+
+    def respond(self, obj, data=None):
+        self.responses.append(obj)
+        return True
+
+    def add_close_callback(self, func):
+        self.client.add_close_callback(func)
+
+class BatchAction(object):
+    """ The "batch" action runs a list of sub-requests in one pass through
+        the internal api processor and responds with the list of their
+        results:
+
+        {"action" : "batch", "requests" : [...], "atomic" : false}
+
+        With binary framing, the list of requests may also be attached as
+        JSON data instead, which allows for much larger batches.
+
+        If "atomic" is true, all storage writes of the sub-requests are
+        done in one StorageTransaction: they are only applied if every
+        sub-request succeeded, and otherwise none of them are. Only the
+        actions in atomic_actions write through the daemon's storage_writer,
+        so atomic batches with any other action are refused. The writes are
+        only applied at the end, so the sub-requests of an atomic batch
+        don't see each other's changes.
+
+        The batch is processed by a single worker, so if all sub-requests
+        concern the same item, the batch should carry its "item_id" to stay
+        in order with other requests for that item.
+    """
+    NOT_IN_BATCH = ["batch", "stream-upload", "stream-download",
+        "stream-data", "stream-ack", "stream-end"]
+    ATOMIC = ["allow-read", "revoke-read", "allow-write-modify",
+        "revoke-write-modify"]
+
+    def __init__(self, daemon, max_requests=100000, atomic_actions=None):
+        self.daemon = daemon
+        self.max_requests = max_requests
+        if atomic_actions == None:
+            atomic_actions = self.ATOMIC
+        self.atomic_actions = atomic_actions
+
+    def register_actions(self, actions):
+        actions["batch"] = self.batch
+
+    def _get_requests(self, msg, data):
+        requests = msg.get("requests", None)
+        if requests == None and data != None:
+            requests = json.loads(bytes(data).decode("utf-8", "ignore"))
+        if not isinstance(requests, list):
+            raise ValueError("no list of requests specified")
+        if len(requests) > self.max_requests:
+            raise ValueError("too many requests in batch, at most " +\
+                str(self.max_requests) + " allowed")
+        return requests
+
+    def _process_request(self, collector, request):
+        if not isinstance(request, dict) or not "action" in request:
+            return {"action" : "response", "response_type" : "error",
+                "error_info" : "invalid request"}
+        if request["action"] in self.NOT_IN_BATCH:
+            return make_response(request, "error",
+                error_info="action not allowed in batch")
+        try:
+            response = self.daemon.process_internal_msg(collector, request)
+        except Exception as e:
+            logging.exception("Error in batch request: " + str(e))
+            response = make_response(request, "error",
+                error_info="internal error: " + str(e))
+        if response == None:
+            # the action responded through the collector:
+            if len(collector.responses) == 0:
+                return make_response(request)
+            response = collector.responses[-1]
+        del(collector.responses[:])
+        return response
+
+    def batch(self, client, msg, data):
+        try:
+            requests = self._get_requests(msg, data)
+        except ValueError as e:
+            return make_response(msg, "error", error_info=str(e))
+        atomic = bool(msg.get("atomic", False))
+        if atomic:
+            for request in requests:
+                action = None
+                if isinstance(request, dict):
+                    action = request.get("action", None)
+                if not action in self.atomic_actions:
+                    return make_response(msg, "error", committed=False,
+                        error_info="action \"" + str(action) +\
+                        "\" can't be part of an atomic batch, nothing " +\
+                        "was written")
+
+        collector = BatchResultCollector(client)
+        writer = self.daemon.storage_writer
+        transaction = None
+        if atomic:
+            transaction = writer.begin()
+        try:
+            results = [self._process_request(collector, request) \
+                for request in requests]
+        finally:
+            if atomic:
+                writer.end()
+
+        if not atomic:
+            return make_response(msg, results=results)
+        failed = [r for r in results if \
+            r.get("response_type", None) != "success"]
+        if len(failed) > 0:
+            transaction.abort()
+            return make_response(msg, "error", results=results,
+                committed=False, error_info=str(len(failed)) +\
+                " request(s) failed, nothing was written")
+        try:
+            transaction.commit()
+        except Exception as e:
+            logging.exception("Error committing batch: " + str(e))
+            return make_response(msg, "error", results=results,
+                committed=False, error_info="commit failed, nothing " +\
+                "was written: " + str(e))
+        return make_response(msg, results=results, committed=True)
@@ -29,111 +29,61 @@ import struct
 import threading
 import time
 
-from informationnode.helper import send_json, recv_json
-
-class FileSocketApiClientHandler(threading.Thread):
-    def __init__(self, client):
-        super().__init__()
-        self.daemon = client.daemon
-        self.client = client
-        self.socket = client.socket
-        self.internal_api_queue = self.daemon.internal_api_queue
-
-    def process_msg(self, msg):
-        """ Process an API msg that was received. """
-        logging.debug("received msg from: " + str(self.client.address))
-        logging.debug("msg contents: " + str(msg))
-        if not "action" in msg:
-            # whoops this is invalid.
-            return False
-        if msg["action"] == "ping":
-            return self.respond({"action":"pong"})
-        elif msg["action"] == "shutdown":
-            result = self.respond({"action" : "response",
-                "responded_action" : msg["action"],
-                "response_type" : "success"})
-            self.daemon.terminate()
-            return result
-        else:
-            # unknown action.
-            return self.respond({"action" : "response",
-                "responded_action" : str(msg["action"]),
-                "response_type" : "error",
-                "error_info" : "unknown action: \"" +\
-                str(msg["action"]) + "\""})
-
-    def respond(self, obj):
-        # check the connection still being open:
-        if self.client.socket == None:
-            # client was already closed.
-            return False
-        # try to send:
-        if not send_json(self.socket, obj):
-            # sending failed
-            self.socket.close()
-            self.client.socket = None
-            return False
-
-        return True
-
-    def run(self):
-        try:
-            recv_buf = b""
-            while self.client.socket != None:
-                # get message from client:
-                msg = recv_json(self.socket)
-                if msg == None:
-                    # nothing received / connection lost.
-                    self.socket.close()
-                    self.client.socket = None
-                    return
-
-                # process received message:
-                try:
-                    if not self.process_msg(msg):
-                        # client was terminated.
-                        self.socket.close()
-                        self.client.socket = None
-                        return
-                except Exception as e:
-                    logging.exception("Error in " +\
-                        "FileSocketApiClientHandler.process_msg: " +\
-                            str(e))
-                    self.socket.close()
-                    self.client.socket = None
-                    return
-        except Exception as e:
-            logging.exception("Error in FileSocketApiClientHandler.run: " +\
-                str(e))
-            self.socket.close()
-            self.client.socket = None
-
-class FileSocketApiClient(object):
-    def __init__(self, daemon, socket, address):
-        self.daemon = daemon
-        self.address = address
-        self.socket = socket
-        self.client_thread = FileSocketApiClientHandler(self)
-        self.client_thread.start()
-
-    def force_terminate(self):
-        try:
-            self.socket.close()
-        except (OSError, AttributeError):
-            pass
-        self.socket = None
- 
-    def terminated(self):
-        if self.socket == None:
-            return True
-        return False
+from informationnode.daemon.apiserver import FileSocketApiServer, \
+    make_response
+from informationnode.daemon.batch import BatchAction
+from informationnode.daemon.events import EventHub
+from informationnode.daemon.permissions import PeerPermissions
+from informationnode.daemon.scheduler import Scheduler
+from informationnode.daemon.storage.catalog import ItemCatalog
+from informationnode.daemon.storage.chunkcache import ChunkCache
+from informationnode.daemon.storage.chunkstore import ChunkStore
+from informationnode.daemon.storage.garbagecollector import \
+    GarbageCollector
+from informationnode.daemon.storage.metadataindex import MetadataIndex
+from informationnode.daemon.storage.migration import StorageMigration
+from informationnode.daemon.storage.queryitems import QueryItems
+from informationnode.daemon.storage.retention import VersionRetention
+from informationnode.daemon.storage.tagindex import TagIndex
+from informationnode.daemon.storage.transaction import StorageWriter
+from informationnode.daemon.streams import StreamTransfers
+from informationnode.daemon.workerpool import InternalApiWorkerPool
 
 class Daemon(object):
-    def __init__(self, node_path):
+    def __init__(self, node_path, api_workers=4, api_queue_size=256,
+            api_max_in_flight=64, chunk_cache_size=(1024 * 1024 * 64),
+            chunker=None, compressor=None, retention=None,
+            gc_bytes_per_second=(1024 * 1024 * 8)):
         self.node_path = node_path
-        self.api_processor_terminated = False
+        # how new items are split into chunks (None for fixed size chunks
+        # of Item.CHUNK_SIZE). Existing items keep their chunking:
+        self.chunker = chunker
+        # compresses the chunks of new items if not None:
+        self.compressor = compressor
+        # RetentionPolicy for old content versions (None keeps them all):
+        self.retention_policy = retention
+        self.api_workers = api_workers
+        self.api_queue_size = api_queue_size
+        self.api_max_in_flight = api_max_in_flight
         self.api_socket_processor_terminated = False
         self._terminate = False
+        self.scheduler = Scheduler()
+
+        # all storage writes go through this, so they can be grouped into
+        # atomic transactions (e.g. by the "batch" action):
+        self.storage_writer = StorageWriter()
+
+        # actions handled by the internal api processor, as a mapping of
+        # action name -> function(client, msg, data). The function returns
+        # the response, or None if it responded to the client itself:
+        self.internal_api_actions = dict()
+        self.events = EventHub(self.scheduler)
+        self.events.register_actions(self.internal_api_actions)
+        self.streams = StreamTransfers(self.open_item_content,
+            on_saved=self.item_changed)
+        self.streams.register_actions(self.internal_api_actions)
+        self.batch = BatchAction(self)
+        self.batch.register_actions(self.internal_api_actions)
 
         # set up signal handlers:
         if platform.system().lower() != "windows":
@@ -150,22 +100,63 @@ class Daemon(object):
             format='%(asctime)s %(levelname)s %(message)s',
             datefmt='%H:%M:%S',
             level=logging.DEBUG)
+
+        # content-addressed store for the chunks of all items, whose saves
+        # are journaled (and recovered here if the node crashed):
+        self.chunk_store = ChunkStore(os.path.join(node_path, "storage"),
+            use_journal=True)
+
+        # limits how much chunk data all open items keep in memory together:
+        self.chunk_cache = ChunkCache(chunk_cache_size)
+
+        # the metadata of all items in memory, for lookups of single items
+        # without a database query:
+        self.item_catalog = ItemCatalog()
+        self.item_catalog.rebuild(self.chunk_store.driver)
+
+        # index of the item metadata for queries, and tag bitmaps for tag
+        # queries and permission checks:
+        self.tag_index = TagIndex(os.path.join(node_path, "storage"))
+        self.metadata_index = MetadataIndex(os.path.join(node_path,
+            "storage"), tag_index=self.tag_index)
+        if self.metadata_index.is_new:
+            self.metadata_index.rebuild(self.chunk_store.driver)
+        else:
+            for item_id in self.chunk_store.recovered_items:
+                self._reindex_item(item_id)
+        self.add_timed_action(5.0, self.tag_index.flush)
+        self.query_items = QueryItems(node_path,
+            chunk_store=self.chunk_store,
+            metadata_index=self.metadata_index,
+            chunk_cache=self.chunk_cache,
+            tag_index=self.tag_index,
+            item_catalog=self.item_catalog)
+        self.query_items.register_actions(self.internal_api_actions)
+        self.permissions = PeerPermissions(node_path, self.tag_index,
+            self.metadata_index, storage_writer=self.storage_writer)
+        self.permissions.register_actions(self.internal_api_actions)
+        self.retention = VersionRetention(self.chunk_store,
+            self.retention_policy)
+        self.retention.register_actions(self.internal_api_actions)
+
+        # reclaims the space of deleted data in the background, pausing
+        # while api requests are waiting (0 bytes per second disables it):
+        self.garbage_collector = GarbageCollector(self.chunk_store,
+            is_busy=self._api_busy,
+            bytes_per_second=max(1, gc_bytes_per_second))
+        self.gc_enabled = (gc_bytes_per_second > 0)
+        self.storage_migration = StorageMigration(self.chunk_store.driver,
+            is_busy=self._api_busy)
+        self.storage_migration.register_actions(self.internal_api_actions)
         logging.info("Data server initialized.")
 
     def terminate(self):
-        """ Set the shutdown signal on the daemon and terminate various things
-            like the api socket.
+        """ Set the shutdown signal on the daemon. This only wakes up the
+            main thread, which then stops the api socket and everything
+            else, so it is safe to call from the SIGTERM handler.
         """
-
-        # remove api socket:
-        try:
-            self.api_socket.close()
-        except OSError:
-            pass
-        if platform.system().lower() != "windows":
-            os.remove(os.path.join(self.node_path, "api_access.sock"))
-
         self._terminate = True
+        self.scheduler.terminate()
         logging.info("Shutdown initiated...")
 
     def sigterm_handler(self, signal, unused_info):
@@ -180,61 +171,144 @@ class Daemon(object):
          """
         pass
 
-    def internal_api_processor(self):
-        """ Internal api processor thread. This thread does the actual I/O
-            work on disk.
+    def add_timed_action(self, interval, func, *args):
+        """ Have func(*args) called every interval seconds from the daemon's
+            main thread, e.g. for link reconnect attempts or gateway polls.
+            Returns a TimedAction which can be cancelled.
+
+            Timed actions should be quick, and hand off any longer work to the
+            internal api pool.
+        """
+        return self.scheduler.call_every(interval, func, *args)
+
+    def open_item_content(self, item_id, writable):
+        """ Get the contents of the item with the given identifier as an
+            ItemChunkManager. If writable is True, a new content version is
+            started which can be written to.
+        """
+        # imported here, since the item encryption needs PyCrypto:
+        from informationnode.daemon.storage.item import Item
+        from informationnode.daemon.storage.itemdata import ItemChunkManager
+
+        versions = self.chunk_store.driver.list_versions(item_id)
+        if len(versions) == 0:
+            if not writable:
+                raise ValueError("no such item: " + str(item_id))
+            self.chunk_store.begin_version(item_id, 1)
+            return ItemChunkManager(Item.CHUNK_SIZE, item_id,
+                chunk_store=self.chunk_store, chunk_cache=self.chunk_cache,
+                chunker=self.chunker, compressor=self.compressor)
+        content = ItemChunkManager(Item.CHUNK_SIZE, item_id,
+            content_version=versions[-1], chunk_store=self.chunk_store,
+            chunk_cache=self.chunk_cache, compressor=self.compressor)
+        content._refresh_contents()
+        if writable:
+            new_content = content.new_content_version()
+            content.close()
+            return new_content
+        return content
+
+    def _reindex_item(self, item_id):
+        driver = self.chunk_store.driver
+        versions = driver.list_versions(item_id)
+        if len(versions) == 0:
+            self.metadata_index.remove_item(item_id)
+            self.item_catalog.remove_item(item_id)
+            return
+        record = driver.read_version(item_id, versions[-1])
+        self.metadata_index.update_from_record(item_id, versions[-1], record)
+        self.item_catalog.update_from_record(item_id, versions[-1], record)
+
+    def item_changed(self, item_id):
+        """ Prune old versions of the given item if the retention policy
+            says so, update the metadata index and the item catalog for its
+            latest version, and notify subscribed api clients that it was
+            added, changed or removed.
+        """
+        was_indexed = (item_id in self.item_catalog)
+        self.retention.item_saved(item_id)
+        self._reindex_item(item_id)
+        if not item_id in self.item_catalog:
+            event_type = "item-removed"
+        elif not was_indexed:
+            event_type = "item-added"
+        else:
+            event_type = "item-changed"
+        self.events.publish(event_type, item_id, item_id=item_id)
+
+    def _api_busy(self):
+        return self.internal_api_pool.queue_depth() > 0
+
+    def queue_internal_request(self, client, msg, data=None):
+        """ Hand off an api msg (and its attached raw data, if any) received
+            from the given client to the internal api processor. The
+            response is sent to the client as soon as the processor is done
+            with it.
+
+            Returns (result, retry_after_ms) - see
+            InternalApiWorkerPool.submit.
         """
+        return self.internal_api_pool.submit(client, msg, data)
+
+    def api_retry_after_ms(self, msg):
+        """ Suggested time in milliseconds a client should wait before sending
+            the given msg again after it was refused as busy.
+        """
+        return self.internal_api_pool.retry_after_ms(msg)
+
+    def get_status(self):
+        """ Get JSON serializable info about the daemon's current load. """
+        return {"internal_api" : self.internal_api_pool.stats(),
+            "api_clients" : self.api_server.client_count(),
+            "subscribers" : self.events.subscriber_count(),
+            "chunk_cache" : self.chunk_cache.stats(),
+            "journal" : self.chunk_store.journal.stats(),
+            "gc" : self.garbage_collector.stats()}
+
+    def process_internal_msg(self, client, msg, data=None):
+        """ Do the actual work for an api msg and return the response, or
+            None if the action already responded itself.
+        """
+        if not msg["action"] in self.internal_api_actions:
+            # unknown action.
+            return make_response(msg, "error",
+                error_info="unknown action: \"" + str(msg["action"]) + "\"")
+        return self.internal_api_actions[msg["action"]](client, msg, data)
+
+    def internal_api_processor(self, client, msg, data):
+        """ Processes one api msg in one of the internal api pool's worker
+            threads, which do the actual I/O work on disk.
+        """
+        logging.debug("got internal api message: " + str(msg))
         try:
-            while not self._terminate:
-                try:
-                    next_msg = self.internal_api_queue.get(timeout=0.5)
-                except queue.Empty:
-                    continue
-                logging.debug("got internal api message: " + str(next_msg))
-                try:
-                    if msg["action"] == "":
-                        pass
-                except Exception as e:
-                    logging.error("Error in Daemon.internal_api_processor: " +\
-                        str(e))
-            self.api_processor_terminated = True
+            response = self.process_internal_msg(client, msg, data)
         except Exception as e:
-            logging.exception("unhandled exception in internal_api_processor")
-            raise e
+            logging.exception("Error in " +\
+                "Daemon.internal_api_processor: " + str(e))
+            response = make_response(msg, "error",
+                error_info="internal error: " + str(e))
+        if response != None:
+            client.respond(response)
+        client.request_done()
 
     def api_socket_processor(self):
         """ Deals with the outside requests coming into the api socket
             (api_access.sock). Hands off the actual work to the internal api
             processor later by forming the according internal JSON requests.
+
+            All clients are served by the event loop of a single
+            FileSocketApiServer.
         """
-        logging.debug("[api_socket_processor] starting...")
         try:
-            self.api_socket.listen(1)
-            logging.debug("[api_socket_processor] now listening")
-            clients = {}
-            while True:
-                # add new client(s):
-                c, addr = self.api_socket.accept()
-                if self._terminate:
-                    logging.debug("[api_socket_processor] shutting down...")
-                    for client_k in clients:
-                        if not clients[client_k].terminated():
-                            clients[client_k].force_terminate()
-                    break
-
-                clients[c] = FileSocketApiClient(self, c, addr)
-                logging.debug("[api_socket_processor] new client")          
-
-                # throw away clients that have been terminated:
-                remove_clients = []
-                for client_k in clients:
-                    if clients[client_k].terminated():
-                        remove_clients.append(client_k)
-                for client_k in remove_clients:
-                    del(clients[client_k])
-            self.api_socket_processor_terminated = True
+            self.api_server.run()
         except Exception as e:
             logging.exception("unhandled exception in api_socket_processor")
+        finally:
+            try:
+                self.api_socket.close()
+            except OSError:
+                pass
+            self.api_socket_processor_terminated = True
 
     def run(self, api_socket):
         """ Run the data server which handles local api requests by the
@@ -242,22 +316,49 @@ class Daemon(object):
         """
         logging.debug("Launching other processing threads...")
         # internal api processor that handles all the actual work:
-        self.internal_api_queue = queue.Queue()
-        self.internal_api_thread = threading.Thread(target=\
-            self.internal_api_processor)
-        self.internal_api_thread.start()
+        self.internal_api_pool = InternalApiWorkerPool(
+            self.internal_api_processor, worker_count=self.api_workers,
+            queue_size=self.api_queue_size)
+        self.internal_api_pool.start()
+        if self.gc_enabled:
+            self.garbage_collector.start()
 
         # unix file socket api request reader:
         self.api_socket = api_socket
+        self.api_server = FileSocketApiServer(self, api_socket,
+            max_in_flight=self.api_max_in_flight)
         self.api_thread = threading.Thread(target=\
             self.api_socket_processor)
         self.api_thread.start()
+        self.events.publish("daemon-state", "daemon", state="running")
 
         logging.debug("Data server main thread starting.")
         
-        # process continuous timed actions:
-        while not self._terminate or not self.api_processor_terminated:
-            time.sleep(1)
+        # process continuous timed actions registered with
+        # add_timed_action until terminate() is called. The main thread only
+        # wakes up when an action is due:
+        self.scheduler.run()
+
+        # tell subscribers before their connections go away. The scheduler
+        # won't flush anymore, so this is sent right away:
+        self.events.publish("daemon-state", "daemon", state="stopping")
+        self.events.flush()
+
+        # remove api socket:
+        if platform.system().lower() != "windows":
+            try:
+                os.remove(os.path.join(self.node_path, "api_access.sock"))
+            except OSError:
+                pass
+        self.api_server.terminate()
+
+        self.garbage_collector.stop()
+        self.storage_migration.stop()
+        self.internal_api_pool.terminate()
+        self.internal_api_pool.join()
+        self.chunk_store.close()
+        self.metadata_index.close()
+        self.tag_index.close()
         logging.info("Shutting down data server.")
         
         # remove PID file:
@@ -116,7 +116,7 @@ class AESinRSAStreamEncryption(CryptoStreamEncryption):
             raise ValueError("AES info has wrong length")
 
         # extract the info for the counter:
-        self.ctr_iv = decrypted_info[:16])
+        self.ctr_iv = decrypted_info[:16]
         decrypted_info = decrypted_info[16:]
 
         # extract aes key:
@@ -130,11 +130,19 @@ class AESinRSAStreamEncryption(CryptoStreamEncryption):
 
     def encrypt(self, data):
         super().encrypt(data)
-        return self.aes_encryption.encrypt(data)
+        try:
+            return self.aes_encryption.encrypt(data)
+        except TypeError:
+            # older PyCrypto versions only take bytes, not other buffers:
+            return self.aes_encryption.encrypt(bytes(data))
 
     def decrypt(self, data):
         super().decrypt(data)
-        return self.aes_encryption.decrypt(data)
+        try:
+            return self.aes_encryption.decrypt(data)
+        except TypeError:
+            # older PyCrypto versions only take bytes, not other buffers:
+            return self.aes_encryption.decrypt(bytes(data))
 
     def seek_step(self):
         """ The amount of bytes that can be seeked in one step. For example,
@@ -0,0 +1,184 @@
+'''
+information-node - an advanced tool for data synchronization
+Copyright (C) 2015  Information Node Development Team (see AUTHORS.md)
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 2 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+
+import itertools
+import json
+import threading
+
+from informationnode.daemon.apiserver import make_response
+
+EVENT_TYPES = ["daemon-state", "item-added", "item-changed",
+    "item-removed", "sync-progress", "gateway-status"]
+
+# api clients read json messages of up to 20 KB (see helper.recv_json), so
+# the events of one message may take up this much, leaving room for the rest:
+MAX_EVENTS_SIZE = 1024 * 16
+
+class EventSubscription(object):
+    """ The events one api client subscribed to, and the events waiting to
+        be sent to it.
+    """
+    def __init__(self, subscription_id, client, event_types):
+        self.subscription_id = subscription_id
+        self.client = client
+        self.event_types = event_types
+        self.closed = False
+
+        # pending events as (event type, key) -> event, so a newer event
+        # about the same thing replaces the older one:
+        self.pending = dict()
+        # size of the pending events in json:
+        self.pending_size = 0
+        self.overflowed = False
+        self.coalesced = 0
+
+class EventHub(object):
+    """ Pushes events about changes on the node (items added/changed, sync
+        progress, gateway status, data server state) to subscribed api
+        clients, so they don't need to poll.
+
+        A client subscribes with:
+        {"action" : "subscribe", "events" : [<event type>, ...]}
+
+        and from then on receives messages like this on the same connection,
+        until it sends "unsubscribe" or disconnects:
+        {"action" : "event", "subscription_id" : ..., "events" : [...]}
+
+        Events are not sent right away, but collected for coalesce_delay
+        seconds. Events about the same thing (e.g. the same item) that happen
+        within that time are merged into one, and if a subscriber has more
+        than max_pending different events or more than max_events_size bytes
+        of them waiting, they are all replaced by one "resync" event telling
+        the client to query the state again.
+    """
+    def __init__(self, scheduler, coalesce_delay=0.2, max_pending=1000,
+            max_events_size=MAX_EVENTS_SIZE):
+        self.scheduler = scheduler
+        self.coalesce_delay = coalesce_delay
+        self.max_pending = max_pending
+        self.max_events_size = max_events_size
+        self.subscriptions = dict()
+        self.lock = threading.Lock()
+        self.flush_scheduled = False
+        self._subscription_ids = itertools.count(1)
+
+    def register_actions(self, actions):
+        actions["subscribe"] = self.subscribe
+        actions["unsubscribe"] = self.unsubscribe
+
+    def subscriber_count(self):
+        with self.lock:
+            return len(self.subscriptions)
+
+    def subscribe(self, client, msg, data):
+        event_types = msg.get("events", EVENT_TYPES)
+        if not isinstance(event_types, list) or len([t for t in \
+                event_types if not t in EVENT_TYPES]) > 0:
+            return make_response(msg, "error",
+                error_info="invalid event types, valid are: " +\
+                ", ".join(EVENT_TYPES))
+        subscription = EventSubscription(next(self._subscription_ids),
+            client, set(event_types))
+        with self.lock:
+            self.subscriptions[subscription.subscription_id] = subscription
+        client.add_close_callback(lambda: self._remove(subscription))
+        return make_response(msg, subscription_id=\
+            subscription.subscription_id, daemon_state="running")
+
+    def unsubscribe(self, client, msg, data):
+        with self.lock:
+            subscription = self.subscriptions.get(
+                msg.get("subscription_id", None), None)
+        if subscription == None or subscription.client != client:
+            return make_response(msg, "error",
+                error_info="no such subscription")
+        self._remove(subscription)
+        return make_response(msg)
+
+    def _remove(self, subscription):
+        with self.lock:
+            subscription.closed = True
+            if subscription.subscription_id in self.subscriptions:
+                del(self.subscriptions[subscription.subscription_id])
+
+    def publish(self, event_type, key=None, **info):
+        """ Publish an event of the given type to all subscribers. Events of
+            the same type with the same key replace each other until they
+            are sent. This may be called from any thread.
+        """
+        if not event_type in EVENT_TYPES:
+            raise ValueError("unknown event type: " + str(event_type))
+        event = dict(info)
+        event["event"] = event_type
+        # plus the separator in the list of events:
+        size = len(json.dumps(event)) + 2
+        schedule = False
+        with self.lock:
+            for subscription in self.subscriptions.values():
+                if not event_type in subscription.event_types or \
+                        subscription.overflowed:
+                    continue
+                pending_key = (event_type, key)
+                pending_size = subscription.pending_size + size
+                replaced = subscription.pending.get(pending_key, None)
+                if replaced != None:
+                    pending_size -= len(json.dumps(replaced)) + 2
+                if (replaced == None and len(subscription.pending) >= \
+                        self.max_pending) or \
+                        pending_size > self.max_events_size:
+                    subscription.pending = dict()
+                    subscription.pending_size = 0
+                    subscription.overflowed = True
+                    continue
+                if replaced != None:
+                    subscription.coalesced += 1
+                subscription.pending[pending_key] = event
+                subscription.pending_size = pending_size
+            if not self.flush_scheduled:
+                self.flush_scheduled = True
+                schedule = True
+        if schedule:
+            self.scheduler.call_later(self.coalesce_delay, self.flush)
+
+    def flush(self):
+        """ Send out all pending events. This is called by the scheduler
+            coalesce_delay seconds after the first event of a burst.
+        """
+        with self.lock:
+            self.flush_scheduled = False
+            sends = []
+            for subscription in self.subscriptions.values():
+                if subscription.overflowed:
+                    events = [{"event" : "resync"}]
+                elif len(subscription.pending) > 0:
+                    events = list(subscription.pending.values())
+                else:
+                    continue
+                sends.append((subscription, events, subscription.coalesced))
+                subscription.pending = dict()
+                subscription.pending_size = 0
+                subscription.overflowed = False
+                subscription.coalesced = 0
+        for (subscription, events, coalesced) in sends:
+            if subscription.closed:
+                continue
+            if not subscription.client.respond({"action" : "event",
+                    "subscription_id" : subscription.subscription_id,
+                    "events" : events, "coalesced" : coalesced}):
+                self._remove(subscription)
@@ -0,0 +1,202 @@
+'''
+information-node - an advanced tool for data synchronization
+Copyright (C) 2015  Information Node Development Team (see AUTHORS.md)
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 2 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+
+import json
+import os
+import threading
+
+from informationnode.daemon.apiserver import make_response
+
+ACCESS_TYPES = ["read", "write-modify"]
+
+class PeerPermissions(object):
+    """ The tag-list permissions of remote nodes, identified by their
+        fingerprint. A remote node may read (or modify) an item as soon as
+        it has that permission on at least one tag the item is tagged with.
+
+        The rules are stored in permissions.json in the node folder, and
+        checked against the bitmaps of the node's TagIndex.
+
+        If a storage_writer is given, changes are saved through it, so they
+        can be part of a StorageTransaction (e.g. of an atomic batch).
+
+        This class is thread-safe.
+    """
+    def __init__(self, node_path, tag_index, metadata_index,
+            storage_writer=None):
+        self.path = os.path.join(node_path, "permissions.json")
+        self.tag_index = tag_index
+        self.metadata_index = metadata_index
+        self.storage_writer = storage_writer
+        self.lock = threading.Lock()
+
+        # fingerprint -> access type -> set of tags:
+        self.rules = dict()
+        if os.path.exists(self.path):
+            with open(self.path, "r") as f:
+                for (fingerprint, access) in json.loads(f.read()).items():
+                    self.rules[fingerprint] = dict([(access_type, set(tags))
+                        for (access_type, tags) in access.items()])
+
+    def register_actions(self, actions):
+        actions["allow-read"] = lambda client, msg, data: \
+            self.action_change(msg, "read", True)
+        actions["revoke-read"] = lambda client, msg, data: \
+            self.action_change(msg, "read", False)
+        actions["allow-write-modify"] = lambda client, msg, data: \
+            self.action_change(msg, "write-modify", True)
+        actions["revoke-write-modify"] = lambda client, msg, data: \
+            self.action_change(msg, "write-modify", False)
+        actions["check-permission"] = self.action_check_permission
+
+    def _save(self):
+        rules = dict()
+        for (fingerprint, access) in self.rules.items():
+            rules[fingerprint] = dict([(access_type, sorted(tags))
+                for (access_type, tags) in access.items()])
+        temp_path = self.path + ".tmp"
+        with open(temp_path, "w") as f:
+            f.write(json.dumps(rules, indent=4, sort_keys=True))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, self.path)
+
+    def _copy_rules(self):
+        return dict([(fingerprint, dict([(access_type, set(tags))
+            for (access_type, tags) in access.items()]))
+            for (fingerprint, access) in self.rules.items()])
+
+    def _change(self, change_func):
+        """ Apply change_func() to the rules and save them. With a
+            transaction running, this happens when it is committed.
+        """
+        old_rules = []
+        def apply():
+            with self.lock:
+                old_rules.append(self._copy_rules())
+                try:
+                    change_func()
+                    self._save()
+                except Exception:
+                    self.rules = old_rules[-1]
+                    raise
+        def undo():
+            with self.lock:
+                self.rules = old_rules[-1]
+                self._save()
+        if self.storage_writer == None:
+            apply()
+        else:
+            self.storage_writer.write(apply, undo)
+
+    def allow(self, fingerprint, access_type, tags):
+        """ Give the remote node access to all items with any of the tags. """
+        if not access_type in ACCESS_TYPES:
+            raise ValueError("unknown access type " + str(access_type))
+        tags = set(tags)
+        def change():
+            access = self.rules.setdefault(fingerprint, dict())
+            access.setdefault(access_type, set()).update(tags)
+        self._change(change)
+
+    def revoke(self, fingerprint, access_type, tags):
+        """ Revoke access via the given tags from the remote node, or from
+            all remote nodes if fingerprint is None. If tags is None, all
+            access of that type is revoked.
+        """
+        if not access_type in ACCESS_TYPES:
+            raise ValueError("unknown access type " + str(access_type))
+        if tags != None:
+            tags = set(tags)
+        def change():
+            if fingerprint != None:
+                fingerprints = [fingerprint]
+            else:
+                fingerprints = list(self.rules.keys())
+            for revoked in fingerprints:
+                access = self.rules.get(revoked, dict())
+                if not access_type in access:
+                    continue
+                if tags == None:
+                    access[access_type] = set()
+                else:
+                    access[access_type].difference_update(tags)
+                if len(access[access_type]) == 0:
+                    del(access[access_type])
+                if len(access) == 0:
+                    del(self.rules[revoked])
+        self._change(change)
+
+    def tags(self, fingerprint, access_type):
+        with self.lock:
+            return set(self.rules.get(fingerprint, dict()).get(access_type,
+                set()))
+
+    def accessible_items(self, fingerprint, access_type="read"):
+        """ Bitmap of the ordinals of all items the remote node may access.
+        """
+        return self.tag_index.items_with_any(self.tags(fingerprint,
+            access_type))
+
+    def may_access(self, fingerprint, item_id, access_type="read"):
+        ordinal = self.metadata_index.item_ordinal(item_id)
+        if ordinal == None:
+            return False
+        return self.tag_index.item_has_any(ordinal, self.tags(fingerprint,
+            access_type))
+
+    def action_change(self, msg, access_type, allow):
+        """ The "allow-read", "revoke-read", "allow-write-modify" and
+            "revoke-write-modify" api actions, which take a "fingerprint"
+            and a list of "tags". Both are optional for revoking.
+        """
+        fingerprint = msg.get("fingerprint", None)
+        tags = msg.get("tags", None)
+        if (allow or tags != None) and (not isinstance(tags, list) or \
+                len([tag for tag in tags if not isinstance(tag, str)]) > 0):
+            return make_response(msg, "error",
+                error_info="tags need to be a list of strings")
+        if allow and not isinstance(fingerprint, str):
+            return make_response(msg, "error",
+                error_info="fingerprint required")
+        try:
+            if allow:
+                self.allow(fingerprint, access_type, tags)
+            else:
+                self.revoke(fingerprint, access_type, tags)
+        except OSError as e:
+            return make_response(msg, "error",
+                error_info="failed to save permissions: " + str(e))
+        return make_response(msg)
+
+    def action_check_permission(self, client, msg, data):
+        """ The "check-permission" api action: returns whether the remote
+            node with the given "fingerprint" has "access" (read or
+            write-modify) to the item with "item_id".
+        """
+        access_type = msg.get("access", "read")
+        if not access_type in ACCESS_TYPES:
+            return make_response(msg, "error",
+                error_info="unknown access type")
+        if not isinstance(msg.get("fingerprint", None), str) or \
+                not isinstance(msg.get("item_id", None), str):
+            return make_response(msg, "error",
+                error_info="fingerprint and item_id required")
+        return make_response(msg, allowed=self.may_access(msg["fingerprint"],
+            msg["item_id"], access_type))
@@ -0,0 +1,134 @@
+'''
+information-node - an advanced tool for data synchronization
+Copyright (C) 2015  Information Node Development Team (see AUTHORS.md)
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 2 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+class TimedAction(object):
+    """ An action registered with a Scheduler. Use cancel() to remove it
+        again.
+    """
+    def __init__(self, scheduler, due, func, args, interval=None):
+        self.scheduler = scheduler
+        self.due = due
+        self.func = func
+        self.args = args
+        self.interval = interval
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+        self.scheduler.wakeup()
+
+class Scheduler(object):
+    """ Runs timed actions in the thread that calls run(), based on a heap of
+        due times. The thread sleeps until the next action is due, or until
+        woken up by a newly added action or terminate() - it never wakes up
+        periodically just to check.
+
+        terminate() may also be called from a signal handler.
+    """
+    def __init__(self):
+        self._timers = []
+        self._counter = itertools.count()
+        self._condition = threading.Condition()
+        self._terminate = False
+
+    def _add(self, action):
+        with self._condition:
+            heapq.heappush(self._timers, (action.due, next(self._counter),
+                action))
+            self._condition.notify()
+        return action
+
+    def call_later(self, delay, func, *args):
+        """ Run func(*args) once after delay seconds. """
+        return self._add(TimedAction(self, time.monotonic() + delay,
+            func, args))
+
+    def call_soon(self, func, *args):
+        """ Run func(*args) in the scheduler thread as soon as possible. """
+        return self.call_later(0, func, *args)
+
+    def call_every(self, interval, func, *args):
+        """ Run func(*args) every interval seconds, the first time after one
+            interval has passed.
+        """
+        if interval <= 0:
+            raise ValueError("interval needs to be positive")
+        return self._add(TimedAction(self, time.monotonic() + interval,
+            func, args, interval=interval))
+
+    def pending(self):
+        """ Amount of actions that are still scheduled. """
+        with self._condition:
+            return len([t for t in self._timers if not t[2].cancelled])
+
+    def wakeup(self):
+        with self._condition:
+            self._condition.notify()
+
+    def terminate(self):
+        """ Make run() return as soon as the currently running action (if
+            any) is done.
+        """
+        self._terminate = True
+        self.wakeup()
+
+    def terminated(self):
+        return self._terminate
+
+    def _next_due_action(self):
+        """ Wait until an action is due and return it, or return None if the
+            scheduler was terminated.
+        """
+        with self._condition:
+            while not self._terminate:
+                if len(self._timers) == 0:
+                    self._condition.wait()
+                    continue
+                (due, unused, action) = self._timers[0]
+                if action.cancelled:
+                    heapq.heappop(self._timers)
+                    continue
+                timeout = due - time.monotonic()
+                if timeout > 0:
+                    self._condition.wait(timeout)
+                    continue
+                heapq.heappop(self._timers)
+                return action
+        return None
+
+    def run(self):
+        while True:
+            action = self._next_due_action()
+            if action == None:
+                return
+            try:
+                action.func(*action.args)
+            except Exception as e:
+                logging.exception("Error in timed action " +\
+                    str(action.func) + ": " + str(e))
+            if action.interval != None and not action.cancelled:
+                action.due = max(action.due + action.interval,
+                    time.monotonic())
+                self._add(action)
@@ -0,0 +1,237 @@
+'''
+information-node - an advanced tool for data synchronization
+Copyright (C) 2015  Information Node Development Team (see AUTHORS.md)
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 2 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+
+import array
+import bisect
+import struct
+import sys
+
+# containers with more values than this are stored as bitsets:
+ARRAY_MAX_SIZE = 4096
+BITSET_BYTES = (65536 // 8)
+CONTAINER_HEADER = struct.Struct("<HBI")
+CONTAINER_ARRAY = 1
+CONTAINER_BITSET = 2
+
+def _bitset_values(bits, high):
+    values = []
+    base = high << 16
+    while bits:
+        low_bit = bits & -bits
+        values.append(base + low_bit.bit_length() - 1)
+        bits ^= low_bit
+    return values
+
+class RoaringBitmap(object):
+    """ A compressed set of non-negative integers (e.g. item ordinals) in the
+        style of Roaring bitmaps: the values are split by their upper 16 bits
+        into containers, which are either sorted arrays of the lower 16 bits
+        (for sparse containers) or bitsets of 65536 bits (for dense ones).
+
+        Bitsets are Python integers, so union and intersection of dense
+        containers are single big integer operations.
+    """
+    def __init__(self, values=None):
+        # upper 16 bits -> array('H') or int bitset:
+        self.containers = dict()
+        if values != None:
+            for value in values:
+                self.add(value)
+
+    def _set_container(self, high, container):
+        if isinstance(container, int):
+            count = bin(container).count("1")
+            if count == 0:
+                self.containers.pop(high, None)
+                return
+            if count <= ARRAY_MAX_SIZE:
+                container = array.array("H", [v & 0xFFFF for v in \
+                    _bitset_values(container, 0)])
+        elif len(container) == 0:
+            self.containers.pop(high, None)
+            return
+        elif len(container) > ARRAY_MAX_SIZE:
+            bits = 0
+            for low in container:
+                bits |= (1 << low)
+            container = bits
+        self.containers[high] = container
+
+    def add(self, value):
+        (high, low) = (value >> 16, value & 0xFFFF)
+        container = self.containers.get(high, None)
+        if container == None:
+            self.containers[high] = array.array("H", [low])
+        elif isinstance(container, int):
+            self.containers[high] = container | (1 << low)
+        else:
+            pos = bisect.bisect_left(container, low)
+            if pos < len(container) and container[pos] == low:
+                return
+            container.insert(pos, low)
+            if len(container) > ARRAY_MAX_SIZE:
+                self._set_container(high, container)
+
+    def discard(self, value):
+        (high, low) = (value >> 16, value & 0xFFFF)
+        container = self.containers.get(high, None)
+        if container == None:
+            return
+        if isinstance(container, int):
+            self._set_container(high, container & ~(1 << low))
+            return
+        pos = bisect.bisect_left(container, low)
+        if pos < len(container) and container[pos] == low:
+            del(container[pos])
+            if len(container) == 0:
+                del(self.containers[high])
+
+    def __contains__(self, value):
+        container = self.containers.get(value >> 16, None)
+        if container == None:
+            return False
+        low = value & 0xFFFF
+        if isinstance(container, int):
+            return (container >> low) & 1 == 1
+        pos = bisect.bisect_left(container, low)
+        return pos < len(container) and container[pos] == low
+
+    def __len__(self):
+        return sum([(bin(c).count("1") if isinstance(c, int) else len(c)) \
+            for c in self.containers.values()])
+
+    def __iter__(self):
+        for high in sorted(self.containers.keys()):
+            container = self.containers[high]
+            if isinstance(container, int):
+                for value in _bitset_values(container, high):
+                    yield value
+            else:
+                base = high << 16
+                for low in container:
+                    yield base + low
+
+    def __eq__(self, other):
+        return isinstance(other, RoaringBitmap) and \
+            list(self) == list(other)
+
+    @staticmethod
+    def _as_bits(container):
+        if isinstance(container, int):
+            return container
+        bits = 0
+        for low in container:
+            bits |= (1 << low)
+        return bits
+
+    def _combine(self, other, op, keep_self_only, keep_other_only):
+        result = RoaringBitmap()
+        for high in set(self.containers.keys()) | \
+                set(other.containers.keys()):
+            a = self.containers.get(high, None)
+            b = other.containers.get(high, None)
+            if b == None:
+                if keep_self_only:
+                    result._set_container(high, self._copy_container(a))
+                continue
+            if a == None:
+                if keep_other_only:
+                    result._set_container(high, self._copy_container(b))
+                continue
+            if not isinstance(a, int) and not isinstance(b, int) and \
+                    op == "and":
+                # two sparse containers: intersect without bitsets.
+                result._set_container(high, array.array("H",
+                    sorted(set(a) & set(b))))
+                continue
+            (a, b) = (self._as_bits(a), self._as_bits(b))
+            if op == "or":
+                bits = a | b
+            elif op == "and":
+                bits = a & b
+            else:
+                bits = a & ~b
+            result._set_container(high, bits)
+        return result
+
+    @staticmethod
+    def _copy_container(container):
+        if isinstance(container, int):
+            return container
+        return array.array("H", container)
+
+    def __or__(self, other):
+        return self._combine(other, "or", True, True)
+
+    def __and__(self, other):
+        return self._combine(other, "and", False, False)
+
+    def __sub__(self, other):
+        return self._combine(other, "andnot", True, False)
+
+    def copy(self):
+        return self | RoaringBitmap()
+
+    @staticmethod
+    def union(bitmaps):
+        result = RoaringBitmap()
+        for bitmap in bitmaps:
+            result = result | bitmap
+        return result
+
+    def to_bytes(self):
+        """ Serialize to a compact little-endian format. """
+        parts = []
+        for high in sorted(self.containers.keys()):
+            container = self.containers[high]
+            if isinstance(container, int):
+                parts.append(CONTAINER_HEADER.pack(high, CONTAINER_BITSET,
+                    BITSET_BYTES))
+                parts.append(container.to_bytes(BITSET_BYTES, "little"))
+                continue
+            values = array.array("H", container)
+            if sys.byteorder != "little":
+                values.byteswap()
+            parts.append(CONTAINER_HEADER.pack(high, CONTAINER_ARRAY,
+                len(values)))
+            parts.append(values.tobytes())
+        return b"".join(parts)
+
+    @staticmethod
+    def from_bytes(data):
+        result = RoaringBitmap()
+        pos = 0
+        while pos < len(data):
+            (high, container_type, size) = CONTAINER_HEADER.unpack_from(data,
+                pos)
+            pos += CONTAINER_HEADER.size
+            if container_type == CONTAINER_BITSET:
+                result.containers[high] = int.from_bytes(
+                    data[pos:pos + size], "little")
+                pos += size
+            elif container_type == CONTAINER_ARRAY:
+                values = array.array("H")
+                values.frombytes(data[pos:pos + size * 2])
+                if sys.byteorder != "little":
+                    values.byteswap()
+                result.containers[high] = values
+                pos += size * 2
+            else:
+                raise ValueError("invalid bitmap container type")
+        return result
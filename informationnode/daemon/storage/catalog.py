@@ -0,0 +1,338 @@
+'''
+information-node - an advanced tool for data synchronization
+Copyright (C) 2015  Information Node Development Team (see AUTHORS.md)
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 2 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+
+import array
+import binascii
+import datetime
+import logging
+import re
+import threading
+import uuid
+
+from informationnode.helper import parse_isoformat
+
+# identifiers made by Item are a uuid4 plus a sha224 hex digest:
+ITEM_ID_PATTERN = re.compile("^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-" +\
+    "[0-9a-f]{4}-[0-9a-f]{12}-[0-9a-f]{56}$")
+
+EPOCH = datetime.datetime(1970, 1, 1)
+ONE_MICROSECOND = datetime.timedelta(microseconds=1)
+NO_TIME = -(2 ** 63)
+
+def pack_item_id(item_id):
+    """ Get a compact bytes form of an item identifier: 45 instead of 93
+        bytes for identifiers made by Item, the UTF-8 encoding otherwise.
+    """
+    if ITEM_ID_PATTERN.match(item_id):
+        return b"\x00" + uuid.UUID(item_id[:36]).bytes +\
+            bytes.fromhex(item_id[37:])
+    return b"\x01" + item_id.encode("utf-8")
+
+def unpack_item_id(packed):
+    packed = bytes(packed)
+    if packed[0] == 0:
+        return str(uuid.UUID(bytes=packed[1:17])) + "-" +\
+            binascii.hexlify(packed[17:]).decode("ascii")
+    return packed[1:].decode("utf-8")
+
+class _InternTable(object):
+    """ Maps values which many items share (like mime types) to small
+        numbers, so each item only needs to store the number.
+    """
+    def __init__(self):
+        self.values = []
+        self.numbers = dict()
+
+    def number(self, value):
+        number = self.numbers.get(value, None)
+        if number == None:
+            number = len(self.values)
+            self.values.append(value)
+            self.numbers[value] = number
+        return number
+
+    def __getitem__(self, number):
+        return self.values[number]
+
+class ItemCatalog(object):
+    """ Compact in-memory catalog of the metadata of the latest content
+        version of each item, so the daemon can keep all of it in memory
+        without the cost of an Item (or a dict) per item. The daemon
+        rebuilds it on start and updates it with the MetadataIndex.
+
+        The metadata is stored in columns of typed arrays, one row per item:
+        identifiers packed into one bytes buffer, times as integer
+        microseconds, and mime types, classifications and tag sets as
+        numbers into intern tables, since few distinct ones exist. Rows are
+        found through an open addressing hash table in another array. This
+        takes about 130 bytes per item instead of more than a kilobyte
+        (see scripts/benchmark-item-memory).
+
+        Removed items leave a dead row behind until there are as many dead
+        rows as live ones, then the columns are compacted. This class is
+        thread-safe, and offers the same update methods as MetadataIndex.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self._clear()
+
+    def _clear(self):
+        self.id_data = bytearray()
+        self.id_offsets = array.array("Q", [0])
+        # 0 marks a removed row, since content versions start at 1:
+        self.versions = array.array("I")
+        self.creation_times = array.array("q")
+        self.modification_times = array.array("q")
+        self.mime_types = array.array("I")
+        self.classifications = array.array("I")
+        self.tag_sets = array.array("I")
+        self.mime_type_table = _InternTable()
+        self.classification_table = _InternTable()
+        self.tag_set_table = _InternTable()
+        # (row, field) -> time string that doesn't fit the integer form,
+        # e.g. with a time zone:
+        self.odd_times = dict()
+        self.live_count = 0
+        self.dead_count = 0
+        # row + 1 for each used slot, 0 for free ones:
+        self.table = array.array("q", bytes(8 * 16))
+        self.table_used = 0
+
+    def __len__(self):
+        return self.live_count
+
+    def __contains__(self, item_id):
+        with self.lock:
+            return self._find_row(pack_item_id(item_id)) != None
+
+    def _row_key(self, row):
+        return self.id_data[self.id_offsets[row]:self.id_offsets[row + 1]]
+
+    def _find_row(self, key):
+        mask = len(self.table) - 1
+        slot = hash(key) & mask
+        while self.table[slot] != 0:
+            row = self.table[slot] - 1
+            if self.versions[row] != 0 and self._row_key(row) == key:
+                return row
+            slot = (slot + 1) & mask
+        return None
+
+    def _insert_slot(self, key, row):
+        mask = len(self.table) - 1
+        slot = hash(key) & mask
+        while self.table[slot] != 0:
+            slot = (slot + 1) & mask
+        self.table[slot] = row + 1
+
+    def _rebuild_table(self):
+        """ Rebuild the hash table for the live rows, sized so at most a
+            quarter of the slots are used.
+        """
+        size = 16
+        while size < (self.live_count + 1) * 4:
+            size *= 2
+        self.table = array.array("q", bytes(8 * size))
+        for row in range(len(self.versions)):
+            if self.versions[row] != 0:
+                self._insert_slot(bytes(self._row_key(row)), row)
+        self.table_used = self.live_count
+
+    @staticmethod
+    def _time_to_int(value):
+        if value == None or value == "":
+            return (NO_TIME, None)
+        try:
+            time = parse_isoformat(value)
+        except (TypeError, ValueError):
+            return (NO_TIME, value)
+        if time.tzinfo != None or time.isoformat() != value:
+            return (NO_TIME, value)
+        return ((time - EPOCH) // ONE_MICROSECOND, None)
+
+    @staticmethod
+    def _int_to_time(value):
+        if value == NO_TIME:
+            return None
+        return (EPOCH + value * ONE_MICROSECOND).isoformat()
+
+    def _set_row(self, row, content_version, record):
+        self.versions[row] = content_version
+        self.mime_types[row] = self.mime_type_table.number(
+            record.get("mime_type", None))
+        self.classifications[row] = self.classification_table.number(
+            record.get("classification", None))
+        self.tag_sets[row] = self.tag_set_table.number(
+            tuple(sorted(set(record.get("tags", [])))))
+        for (field, column) in [("creation_time", self.creation_times),
+                ("modification_time", self.modification_times)]:
+            (column[row], odd) = self._time_to_int(record.get(field, None))
+            if odd != None:
+                self.odd_times[(row, field)] = odd
+            else:
+                self.odd_times.pop((row, field), None)
+
+    def update_from_record(self, item_id, content_version, record):
+        """ Store the metadata of the given content version record (see
+            ItemChunkManager.save) as the item's current metadata.
+        """
+        if content_version < 1:
+            raise ValueError("invalid content version " +\
+                str(content_version))
+        key = pack_item_id(item_id)
+        with self.lock:
+            row = self._find_row(key)
+            if row == None:
+                row = len(self.versions)
+                self.id_data += key
+                self.id_offsets.append(len(self.id_data))
+                for column in [self.versions, self.creation_times,
+                        self.modification_times, self.mime_types,
+                        self.classifications, self.tag_sets]:
+                    column.append(0)
+                self.versions[row] = content_version
+                self.live_count += 1
+                if (self.table_used + 1) * 2 > len(self.table):
+                    self._rebuild_table()
+                else:
+                    self._insert_slot(key, row)
+                    self.table_used += 1
+            self._set_row(row, content_version, record)
+
+    def remove_item(self, item_id):
+        with self.lock:
+            row = self._find_row(pack_item_id(item_id))
+            if row == None:
+                return
+            self.versions[row] = 0
+            self.odd_times.pop((row, "creation_time"), None)
+            self.odd_times.pop((row, "modification_time"), None)
+            self.live_count -= 1
+            self.dead_count += 1
+            if self.dead_count > max(1024, self.live_count):
+                self._compact()
+
+    def _compact(self):
+        """ Drop the dead rows from all columns. """
+        old = (self.id_data, self.id_offsets, self.versions,
+            self.creation_times, self.modification_times, self.mime_types,
+            self.classifications, self.tag_sets, self.odd_times)
+        (id_data, id_offsets, versions, creation_times, modification_times,
+            mime_types, classifications, tag_sets, odd_times) = old
+        self.id_data = bytearray()
+        self.id_offsets = array.array("Q", [0])
+        self.odd_times = dict()
+        columns = []
+        for column in old[2:8]:
+            columns.append(array.array(column.typecode))
+        (self.versions, self.creation_times, self.modification_times,
+            self.mime_types, self.classifications, self.tag_sets) = columns
+        for row in range(len(versions)):
+            if versions[row] == 0:
+                continue
+            new_row = len(self.versions)
+            self.id_data += id_data[id_offsets[row]:id_offsets[row + 1]]
+            self.id_offsets.append(len(self.id_data))
+            for (column, old_column) in zip(columns, old[2:8]):
+                column.append(old_column[row])
+            for field in ["creation_time", "modification_time"]:
+                if (row, field) in odd_times:
+                    self.odd_times[(new_row, field)] = \
+                        odd_times[(row, field)]
+        self.dead_count = 0
+        self._rebuild_table()
+
+    def _row_to_info(self, row):
+        info = {"item_id" : unpack_item_id(self._row_key(row)),
+            "content_version" : self.versions[row],
+            "mime_type" : self.mime_type_table[self.mime_types[row]],
+            "classification" : self.classification_table[
+                self.classifications[row]],
+            "tags" : list(self.tag_set_table[self.tag_sets[row]])}
+        for (field, column) in [("creation_time", self.creation_times),
+                ("modification_time", self.modification_times)]:
+            info[field] = self.odd_times.get((row, field),
+                self._int_to_time(column[row]))
+        return info
+
+    def get(self, item_id):
+        """ Get the metadata of an item, or None if it isn't known. """
+        with self.lock:
+            row = self._find_row(pack_item_id(item_id))
+            if row == None:
+                return None
+            return self._row_to_info(row)
+
+    def find(self, mime_type=None, classification=None, tag=None):
+        """ Get the identifiers of all items with the given mime type,
+            classification and tag (None matches any). This scans the
+            columns, so it is meant for occasional use - see MetadataIndex
+            for fast queries.
+        """
+        with self.lock:
+            wanted_mime = self.mime_type_table.numbers.get(mime_type, -1)
+            wanted_class = self.classification_table.numbers.get(
+                classification, -1)
+            tag_sets = None
+            if tag != None:
+                tag_sets = set([number for (number, tags) in enumerate(
+                    self.tag_set_table.values) if tag in tags])
+            result = []
+            for row in range(len(self.versions)):
+                if self.versions[row] == 0 or (mime_type != None and \
+                        self.mime_types[row] != wanted_mime) or \
+                        (classification != None and \
+                        self.classifications[row] != wanted_class) or \
+                        (tag_sets != None and \
+                        not self.tag_sets[row] in tag_sets):
+                    continue
+                result.append(unpack_item_id(self._row_key(row)))
+            return result
+
+    def item_ids(self):
+        with self.lock:
+            return [unpack_item_id(self._row_key(row)) for row in \
+                range(len(self.versions)) if self.versions[row] != 0]
+
+    def rebuild(self, driver):
+        """ Load all items stored by the given StorageDriver. """
+        with self.lock:
+            self._clear()
+        count = 0
+        for item_id in driver.list_items():
+            versions = driver.list_versions(item_id)
+            if len(versions) == 0:
+                continue
+            self.update_from_record(item_id, versions[-1],
+                driver.read_version(item_id, versions[-1]))
+            count += 1
+        logging.info("Loaded item catalog of " + str(count) + " items.")
+
+    def memory_usage(self):
+        """ Get the approximate size of the columns in bytes, not counting
+            the intern tables.
+        """
+        with self.lock:
+            size = len(self.id_data)
+            for column in [self.id_offsets, self.versions,
+                    self.creation_times, self.modification_times,
+                    self.mime_types, self.classifications, self.tag_sets,
+                    self.table]:
+                size += len(column) * column.itemsize
+            return size
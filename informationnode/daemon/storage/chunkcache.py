@@ -0,0 +1,127 @@
+'''
+information-node - an advanced tool for data synchronization
+Copyright (C) 2015  Information Node Development Team (see AUTHORS.md)
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 2 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+
+import collections
+import logging
+import threading
+
+class ChunkCache(object):
+    """ Keeps track of the item chunks held in memory by all items of a node,
+        and spills the least recently used ones to disk with
+        transfer_to_disk() once they take up more than max_bytes.
+
+        Chunks are registered with touch() whenever their data is accessed
+        or set. To spill a chunk, the lock of its ItemChunkManager is
+        needed - if another thread holds it right now, the chunk is kept and
+        the next least recently used one is tried instead.
+
+        This class is thread-safe.
+    """
+    def __init__(self, max_bytes=(1024 * 1024 * 64)):
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()
+        self.used_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def touch(self, chunk, hit=None):
+        """ Mark the given chunk as most recently used, and spill others if
+            the cache is over budget. hit is True if the chunk's data was
+            already in memory when it was read, False if it had to be loaded,
+            and None if the chunk wasn't read (e.g. its data was set).
+        """
+        with self.lock:
+            if hit == True:
+                self.hits += 1
+            elif hit == False:
+                self.misses += 1
+            size = chunk.size() or 0
+            old_size = self.entries.pop(chunk, None)
+            if old_size != None:
+                self.used_bytes -= old_size
+            self.entries[chunk] = size
+            self.used_bytes += size
+        self._evict(chunk)
+
+    def _evict(self, keep_chunk):
+        """ Spill the least recently used chunks until the cache is within
+            its budget again, skipping those which are in use right now.
+        """
+        skipped = set()
+        while True:
+            with self.lock:
+                if self.used_bytes <= self.max_bytes:
+                    return
+                victim = None
+                for chunk in self.entries:
+                    if chunk != keep_chunk and not chunk in skipped:
+                        victim = chunk
+                        break
+                if victim == None:
+                    return
+                size = self.entries.pop(victim)
+                self.used_bytes -= size
+            if not self._spill(victim, size):
+                skipped.add(victim)
+
+    def _spill(self, chunk, size):
+        """ Returns True if the chunk was spilled, otherwise it is put back
+            as least recently used.
+        """
+        if chunk.item.lock.acquire(blocking=False):
+            try:
+                chunk.transfer_to_disk()
+                with self.lock:
+                    self.evictions += 1
+                return True
+            except (OSError, RuntimeError, ValueError) as e:
+                logging.error("failed to spill chunk " + str(chunk.no) +\
+                    " of item " + str(chunk.item.identifier) +\
+                    " to disk: " + str(e))
+            finally:
+                chunk.item.lock.release()
+
+        # in use or not spillable right now:
+        with self.lock:
+            if not chunk in self.entries:
+                self.entries[chunk] = size
+                self.entries.move_to_end(chunk, last=False)
+                self.used_bytes += size
+        return False
+
+    def remove(self, chunk):
+        """ Forget about a chunk whose data was deleted. """
+        with self.lock:
+            size = self.entries.pop(chunk, None)
+            if size != None:
+                self.used_bytes -= size
+
+    def stats(self):
+        """ Get JSON serializable info about the cache's use. """
+        with self.lock:
+            requests = self.hits + self.misses
+            return {"max_bytes" : self.max_bytes,
+                "used_bytes" : self.used_bytes,
+                "chunks" : len(self.entries),
+                "hits" : self.hits, "misses" : self.misses,
+                "evictions" : self.evictions,
+                "hit_ratio" : (round(self.hits / float(requests), 4) \
+                    if requests > 0 else None)}
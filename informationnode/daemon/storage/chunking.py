@@ -0,0 +1,261 @@
+'''
+information-node - an advanced tool for data synchronization
+Copyright (C) 2015  Information Node Development Team (see AUTHORS.md)
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 2 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+
+import hashlib
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+HASH_MASK = (2 ** 64) - 1
+
+# the gear table maps each byte value to a pseudo-random 64-bit number. It
+# must never change, since chunk boundaries (and with them deduplication
+# against already stored chunks) depend on it:
+GEAR = [int.from_bytes(hashlib.sha256(b"information-node gear " +\
+    bytes([i])).digest()[:8], "big") for i in range(256)]
+if numpy != None:
+    GEAR_ARRAY = numpy.array(GEAR, dtype=numpy.uint64)
+
+def has_fast_path():
+    """ Whether content-defined chunking can use numpy. Without it, the
+        pure Python rolling hash only manages a few MB/s.
+    """
+    return numpy != None
+
+# below this size the vectorised path isn't worth its setup:
+NUMPY_MIN_SIZE = (1024 * 64)
+HASH_BLOCK_SIZE = (1024 * 64)
+
+class FixedSizeChunker(object):
+    """ Splits contents into chunks of chunk_size bytes (the last one may be
+        shorter).
+    """
+    mode = "fixed"
+
+    def __init__(self, chunk_size):
+        if chunk_size < 1:
+            raise ValueError("chunk size needs to be positive")
+        self.chunk_size = chunk_size
+        self.max_size = chunk_size
+
+    def describe(self):
+        return {"mode" : self.mode, "chunk_size" : self.chunk_size}
+
+    def cut_points(self, data, final=True):
+        """ Get the end offsets of all chunks in data. If final is False,
+            more data follows, and the trailing bytes which don't form a
+            complete chunk yet are left out.
+        """
+        cuts = list(range(self.chunk_size, len(data) + 1, self.chunk_size))
+        if final and (len(cuts) == 0 or cuts[-1] < len(data)) and \
+                len(data) > 0:
+            cuts.append(len(data))
+        return cuts
+
+    def split(self, data):
+        """ Split bytes-like data into a list of chunks. """
+        data = memoryview(data)
+        chunks = []
+        start = 0
+        for cut in self.cut_points(data):
+            chunks.append(data[start:cut])
+            start = cut
+        return chunks
+
+    def iter_file(self, f, read_size=(1024 * 1024 * 4)):
+        """ Read a file object to the end and yield its chunks as bytes,
+            while holding only about read_size + max_size bytes in memory.
+        """
+        read_size = max(read_size, self.max_size)
+        buf = bytearray()
+        while True:
+            data = f.read(read_size)
+            final = (not data)
+            if data:
+                buf += data
+                if len(buf) < self.max_size:
+                    continue
+            start = 0
+            for cut in self.cut_points(buf, final=final):
+                yield bytes(buf[start:cut])
+                start = cut
+            del(buf[:start])
+            if final:
+                return
+
+class ContentDefinedChunker(FixedSizeChunker):
+    """ Splits contents at boundaries chosen by the data itself (FastCDC),
+        so inserting or removing bytes only changes the chunks around the
+        edit instead of shifting all following chunks.
+
+        A 64 byte gear rolling hash is computed over the data. Between
+        min_size and avg_size bytes into a chunk, a boundary needs a harder
+        mask to match, and after avg_size an easier one, which keeps the
+        chunk sizes close to avg_size. Chunks never exceed max_size.
+
+        If numpy is available, the rolling hash is computed for a whole
+        buffer at once with vectorised operations. Both paths find exactly
+        the same boundaries.
+    """
+    mode = "cdc"
+
+    def __init__(self, min_size=(1024 * 32), avg_size=(1024 * 100),
+            max_size=(1024 * 400)):
+        if min_size < 64:
+            raise ValueError("minimum chunk size needs to be at least 64")
+        if not (min_size < avg_size < max_size):
+            raise ValueError("chunk sizes need to be min < avg < max")
+        self.min_size = min_size
+        self.avg_size = avg_size
+        self.max_size = max_size
+        self.chunk_size = max_size
+        bits = max(4, int(round(avg_size.bit_length() - 1)))
+        # the upper bits of the hash depend on the most bytes:
+        self.mask_small = ((1 << (bits + 2)) - 1) << (64 - (bits + 2))
+        self.mask_large = ((1 << (bits - 2)) - 1) << (64 - (bits - 2))
+
+    def describe(self):
+        return {"mode" : self.mode, "min_size" : self.min_size,
+            "avg_size" : self.avg_size, "max_size" : self.max_size}
+
+    def _find_cut(self, data, pos, end, final):
+        """ Find the end of the chunk starting at pos with plain Python.
+            Returns None if more data is needed.
+        """
+        limit = min(pos + self.max_size, end)
+        normal = min(pos + self.avg_size, limit)
+        first_check = pos + self.min_size - 1
+        h = 0
+        i = pos + self.min_size - 64
+        while i < first_check and i < limit:
+            h = ((h << 1) + GEAR[data[i]]) & HASH_MASK
+            i += 1
+        mask = (self.mask_small if i < normal else self.mask_large)
+        while i < limit:
+            if i == normal:
+                mask = self.mask_large
+            h = ((h << 1) + GEAR[data[i]]) & HASH_MASK
+            i += 1
+            if h & mask == 0:
+                return i
+        if pos + self.max_size <= end:
+            return pos + self.max_size
+        if final:
+            return end
+        return None
+
+    def _window_hashes(self, values, out, temp):
+        """ Compute the gear hash of the 64 bytes ending at each position of
+            the byte array values into out, in log2(64) vectorised steps: the
+            hash of a window of 2w bytes is the hash of its last w bytes plus
+            the shifted hash of the w bytes before.
+        """
+        numpy.take(GEAR_ARRAY, values, out=out)
+        size = len(values)
+        width = 1
+        while width < 64:
+            numpy.left_shift(out[:size - width], numpy.uint64(width),
+                out=temp[:size - width])
+            numpy.add(out[width:], temp[:size - width], out=out[width:])
+            width *= 2
+
+    def _candidates(self, data):
+        """ Get the positions where the rolling hash matches the small and
+            the large mask. The data is hashed in blocks that fit into the
+            CPU cache, which is several times faster than one big pass.
+        """
+        values = numpy.frombuffer(data, dtype=numpy.uint8)
+        (mask_small, mask_large) = (numpy.uint64(self.mask_small),
+            numpy.uint64(self.mask_large))
+        hashes = numpy.empty(HASH_BLOCK_SIZE + 63, dtype=numpy.uint64)
+        temp = numpy.empty(HASH_BLOCK_SIZE + 63, dtype=numpy.uint64)
+        small = []
+        large = []
+        for start in range(0, len(values), HASH_BLOCK_SIZE):
+            # include the 63 bytes before, which are part of the windows:
+            window_start = max(0, start - 63)
+            block = values[window_start:start + HASH_BLOCK_SIZE]
+            block_hashes = hashes[:len(block)]
+            self._window_hashes(block, block_hashes, temp)
+            block_hashes = block_hashes[start - window_start:]
+            small.append(numpy.flatnonzero((block_hashes & mask_small) == 0)
+                + start)
+            large.append(numpy.flatnonzero((block_hashes & mask_large) == 0)
+                + start)
+        if len(small) == 0:
+            return (numpy.empty(0, dtype=numpy.intp),
+                numpy.empty(0, dtype=numpy.intp))
+        return (numpy.concatenate(small), numpy.concatenate(large))
+
+    def _cut_points_numpy(self, data, final):
+        (small, large) = self._candidates(data)
+        end = len(data)
+        cuts = []
+        pos = 0
+        while pos < end:
+            limit = min(pos + self.max_size, end)
+            normal = min(pos + self.avg_size, limit)
+            first_check = pos + self.min_size - 1
+            cut = None
+            k = numpy.searchsorted(small, first_check)
+            if k < len(small) and small[k] < normal:
+                cut = int(small[k]) + 1
+            else:
+                k = numpy.searchsorted(large, max(first_check, normal))
+                if k < len(large) and large[k] < limit:
+                    cut = int(large[k]) + 1
+                elif pos + self.max_size <= end:
+                    cut = pos + self.max_size
+                elif final:
+                    cut = end
+            if cut == None:
+                break
+            cuts.append(cut)
+            pos = cut
+        return cuts
+
+    def cut_points(self, data, final=True):
+        if numpy != None and len(data) >= NUMPY_MIN_SIZE:
+            return self._cut_points_numpy(data, final)
+        cuts = []
+        pos = 0
+        while pos < len(data):
+            cut = self._find_cut(data, pos, len(data), final)
+            if cut == None:
+                break
+            cuts.append(cut)
+            pos = cut
+        return cuts
+
+CHUNKERS = {
+    "fixed" : FixedSizeChunker,
+    "cdc" : ContentDefinedChunker,
+}
+
+def chunker_from_description(description):
+    """ Create the chunker described by a chunker's describe() output, e.g.
+        as stored in a content version record.
+    """
+    args = dict(description)
+    mode = args.pop("mode", "fixed")
+    if not mode in CHUNKERS:
+        raise ValueError("unknown chunking mode " + str(mode))
+    return CHUNKERS[mode](**args)
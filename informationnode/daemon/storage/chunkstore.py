@@ -0,0 +1,438 @@
+'''
+information-node - an advanced tool for data synchronization
+Copyright (C) 2015  Information Node Development Team (see AUTHORS.md)
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 2 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+
+import collections
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+
+from informationnode.daemon.storage.drivers import open_storage_driver
+from informationnode.daemon.storage.journal import Journal
+
+class VersionLease(object):
+    """ Keeps the chunks of a content version from being deleted while it
+        is read, see ChunkStore.lease_version(). Released by release(), or
+        once it is garbage collected.
+    """
+    def __init__(self, chunk_store, item_id, content_version):
+        self.chunk_store = chunk_store
+        self.item_id = item_id
+        self.content_version = content_version
+        self.released = False
+
+    def release(self):
+        if self.released:
+            return
+        self.released = True
+        self.chunk_store._end_lease(self.item_id, self.content_version)
+
+    def __del__(self):
+        self.release()
+
+class ChunkStore(object):
+    """ Content-addressed store for item chunks, shared by all items and
+        content versions of a node. Each chunk is stored once under the
+        SHA-256 hash of its data, no matter how many item versions use it.
+
+        The store counts references to each chunk in a SQLite database:
+        put() adds a reference (and only writes the data if the chunk isn't
+        stored yet), add_ref() adds one for a chunk known by its hash, and
+        release() drops one. A chunk is deleted when its last reference is
+        released.
+
+        Note that chunks of encrypted items are stored encrypted, and
+        therefore only deduplicate within the same item.
+
+        The chunk data itself is kept by the given StorageDriver, by default
+        the one the storage folder was created with.
+
+        Content version records are saved with commit_version(). With
+        use_journal, they go through a write-ahead Journal, and a store
+        that wasn't closed properly is recovered when it is opened again:
+        recovered_items then lists the items whose saves were replayed.
+
+        Readers of a content version take a lease_version() on it: if the
+        version is deleted meanwhile (e.g. pruned), its chunks are only
+        released once the last lease ends.
+
+        This class is thread-safe.
+    """
+    def __init__(self, storage_path, driver=None, use_journal=False):
+        self.storage_path = storage_path
+        if driver == None:
+            driver = open_storage_driver(storage_path)
+        self.driver = driver
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(os.path.join(storage_path, "chunks.db"),
+            check_same_thread=False, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS chunk_refs (" +\
+            "chunk_hash TEXT PRIMARY KEY, size INTEGER NOT NULL, " +\
+            "refcount INTEGER NOT NULL)")
+        self.journal = None
+        self.recovered_items = []
+        self.closed = False
+        # (item id, content version) -> number of active leases:
+        self.leases = collections.Counter()
+        # (item id, content version) -> chunk hashes of deleted versions
+        # whose release waits for their leases to end:
+        self.deferred_releases = dict()
+        # chunk hash -> [lock, number of put_many calls] for the chunks
+        # which are being written outside of self.lock:
+        self.writing = dict()
+        if use_journal:
+            self.journal = Journal(storage_path, self.driver)
+            if self.journal.needs_recovery:
+                self.recover()
+
+    @staticmethod
+    def chunk_hash(data):
+        return hashlib.sha256(data).hexdigest()
+
+    def put(self, data):
+        """ Store the given chunk data and return its hash. """
+        return self.put_many([data])[0]
+
+    def put_many(self, chunks, hashes=None):
+        """ Store all the given chunks and return the list of their hashes.
+            If the caller already computed the hashes with chunk_hash(), they
+            can be passed as hashes.
+
+            Only the reference counting happens under the store lock. The
+            data of new chunks is written outside of it, so several threads
+            can store chunks at the same time, and a chunk which is being
+            written is never deleted by release() or sweep_orphans().
+        """
+        if hashes == None:
+            hashes = [self.chunk_hash(data) for data in chunks]
+        # reference the chunks which are stored already, and reserve the
+        # others for writing:
+        referenced = []
+        missing = []
+        with self.lock:
+            self.db.execute("BEGIN")
+            try:
+                for (chunk_hash, data) in zip(hashes, chunks):
+                    if self.db.execute("UPDATE chunk_refs SET refcount = " +\
+                            "refcount + 1 WHERE chunk_hash = ?",
+                            (chunk_hash,)).rowcount == 0:
+                        missing.append((chunk_hash, data))
+                    else:
+                        referenced.append(chunk_hash)
+                self.db.execute("COMMIT")
+            except BaseException:
+                self.db.execute("ROLLBACK")
+                raise
+            write_locks = dict()
+            for (chunk_hash, data) in missing:
+                if not chunk_hash in write_locks:
+                    write_locks[chunk_hash] = self._begin_write(chunk_hash)
+        if len(missing) == 0:
+            return hashes
+        try:
+            for (chunk_hash, data) in missing:
+                # another thread may have written the same chunk meanwhile:
+                with write_locks[chunk_hash]:
+                    if not self.driver.has_chunk(chunk_hash):
+                        self.driver.put_chunk(chunk_hash, data)
+            with self.lock:
+                self.db.execute("BEGIN")
+                try:
+                    for (chunk_hash, data) in missing:
+                        if self.db.execute("UPDATE chunk_refs SET " +\
+                                "refcount = refcount + 1 WHERE " +\
+                                "chunk_hash = ?", (chunk_hash,)).rowcount \
+                                == 0:
+                            self.db.execute("INSERT INTO chunk_refs " +\
+                                "(chunk_hash, size, refcount) VALUES " +\
+                                "(?, ?, 1)", (chunk_hash, len(data)))
+                    self.db.execute("COMMIT")
+                except BaseException:
+                    self.db.execute("ROLLBACK")
+                    raise
+        except BaseException:
+            self.release(referenced)
+            raise
+        finally:
+            with self.lock:
+                for chunk_hash in write_locks:
+                    self._end_write(chunk_hash)
+        return hashes
+
+    def _begin_write(self, chunk_hash):
+        """ Mark the chunk as being written, and get the lock its writers
+            take. Call with self.lock held.
+        """
+        entry = self.writing.get(chunk_hash, None)
+        if entry == None:
+            entry = [threading.Lock(), 0]
+            self.writing[chunk_hash] = entry
+        entry[1] += 1
+        return entry[0]
+
+    def _end_write(self, chunk_hash):
+        """ Call with self.lock held. """
+        entry = self.writing[chunk_hash]
+        entry[1] -= 1
+        if entry[1] == 0:
+            del self.writing[chunk_hash]
+
+    def add_ref(self, chunk_hashes):
+        """ Add a reference to each of the given already stored chunks. """
+        with self.lock:
+            self.db.execute("BEGIN")
+            try:
+                for chunk_hash in chunk_hashes:
+                    if self.db.execute("UPDATE chunk_refs SET refcount = " +\
+                            "refcount + 1 WHERE chunk_hash = ?",
+                            (chunk_hash,)).rowcount == 0:
+                        raise ValueError("no chunk with hash " +\
+                            str(chunk_hash))
+                self.db.execute("COMMIT")
+            except BaseException:
+                self.db.execute("ROLLBACK")
+                raise
+
+    def release(self, chunk_hashes):
+        """ Drop a reference to each of the given chunks, and delete the
+            chunks which are no longer referenced.
+        """
+        deleted = []
+        with self.lock:
+            self.db.execute("BEGIN")
+            try:
+                for chunk_hash in chunk_hashes:
+                    self.db.execute("UPDATE chunk_refs SET refcount = " +\
+                        "refcount - 1 WHERE chunk_hash = ?", (chunk_hash,))
+                    row = self.db.execute("SELECT refcount FROM chunk_refs " +\
+                        "WHERE chunk_hash = ?", (chunk_hash,)).fetchone()
+                    if row != None and row[0] <= 0:
+                        self.db.execute("DELETE FROM chunk_refs WHERE " +\
+                            "chunk_hash = ?", (chunk_hash,))
+                        deleted.append(chunk_hash)
+                self.db.execute("COMMIT")
+            except BaseException:
+                self.db.execute("ROLLBACK")
+                raise
+            # only remove the data once the database no longer refers to it,
+            # and leave it to a put_many() that is storing it again:
+            for chunk_hash in deleted:
+                if not chunk_hash in self.writing:
+                    self.driver.delete_chunk(chunk_hash)
+
+    def get(self, chunk_hash):
+        return self.driver.get_chunk(chunk_hash)
+
+    def get_view(self, chunk_hash):
+        """ Get the chunk data as a read-only memoryview, which maps the
+            stored data directly if the storage driver supports it.
+        """
+        return self.driver.get_chunk_view(chunk_hash)
+
+    def refcount(self, chunk_hash):
+        with self.lock:
+            row = self.db.execute("SELECT refcount FROM chunk_refs WHERE " +\
+                "chunk_hash = ?", (chunk_hash,)).fetchone()
+        if row == None:
+            return 0
+        return row[0]
+
+    def stats(self):
+        """ Get JSON serializable info about the stored chunks. The
+            referenced_size is how much space they would take up without
+            deduplication.
+        """
+        with self.lock:
+            (count, stored_size, referenced_size) = self.db.execute(
+                "SELECT COUNT(*), SUM(size), SUM(size * refcount) FROM " +\
+                "chunk_refs").fetchone()
+        return {"chunk_count" : count, "stored_size" : stored_size or 0,
+            "referenced_size" : referenced_size or 0}
+
+    def begin_version(self, item_id, content_version):
+        """ Note that a new writable content version was started. """
+        if self.journal != None:
+            self.journal.begin_version(item_id, content_version)
+
+    def commit_version(self, item_id, content_version, record):
+        """ Durably store the record of a content version, after the chunks
+            it uses were stored.
+        """
+        if self.journal != None:
+            self.journal.commit_version(item_id, content_version, record)
+            return
+        self.driver.write_version(item_id, content_version, record)
+        self.driver.sync()
+
+    def delete_version(self, item_id, content_version):
+        """ Delete the record of a content version and drop its references
+            to its chunks. Chunks shared with other versions or items stay
+            untouched, the others are deleted. Returns the deleted record.
+        """
+        record = self.driver.read_version(item_id, content_version)
+        # the record goes first: if the node stops in between, the
+        # references are merely leaked until the next recovery recounts them.
+        if self.journal != None:
+            self.journal.delete_version(item_id, content_version)
+        else:
+            self.driver.delete_version(item_id, content_version)
+            self.driver.sync()
+        key = (item_id, content_version)
+        with self.lock:
+            if self.leases[key] > 0:
+                self.deferred_releases.setdefault(key, []).extend(
+                    record["chunk_hashes"])
+                return record
+        self.release(record["chunk_hashes"])
+        return record
+
+    def lease_version(self, item_id, content_version):
+        """ Keep the chunks of the given content version until the returned
+            VersionLease is released, even if the version is deleted
+            meanwhile. Take it before reading the version's record.
+        """
+        with self.lock:
+            self.leases[(item_id, content_version)] += 1
+        return VersionLease(self, item_id, content_version)
+
+    def _end_lease(self, item_id, content_version):
+        key = (item_id, content_version)
+        with self.lock:
+            self.leases[key] -= 1
+            if self.leases[key] > 0:
+                return
+            del(self.leases[key])
+            chunk_hashes = self.deferred_releases.pop(key, None)
+            if chunk_hashes == None or self.closed:
+                return
+        self.release(chunk_hashes)
+
+    def sweep_orphans(self, chunk_hashes):
+        """ Delete those of the given stored chunks which have no references,
+            e.g. because a transaction failed after the driver stored them.
+            Returns how many were deleted.
+        """
+        deleted = 0
+        with self.lock:
+            for chunk_hash in chunk_hashes:
+                # written by a put_many() which isn't done yet:
+                if chunk_hash in self.writing:
+                    continue
+                if self.db.execute("SELECT 1 FROM chunk_refs WHERE " +\
+                        "chunk_hash = ?", (chunk_hash,)).fetchone() != None:
+                    continue
+                if self.driver.has_chunk(chunk_hash):
+                    self.driver.delete_chunk(chunk_hash)
+                    deleted += 1
+        return deleted
+
+    def recover(self):
+        """ Recover after the node stopped without closing the store: all
+            saves in the journal are written again, and the chunk references
+            are counted anew from the stored content version records. This
+            drops the references of content versions which were never
+            saved, and deletes the chunks only they used.
+        """
+        entries = self.journal.read_entries()
+        started = set()
+        committed = dict()
+        for entry in entries:
+            key = (entry["item_id"], entry["version"])
+            if entry["type"] == "begin":
+                started.add(key)
+            elif entry["type"] == "commit":
+                committed[key] = entry["record"]
+            elif entry["type"] == "delete":
+                committed.pop(key, None)
+                if key[1] in self.driver.list_versions(key[0]):
+                    self.driver.delete_version(key[0], key[1])
+        for ((item_id, version), record) in sorted(committed.items()):
+            self.driver.write_version(item_id, version, record)
+        self.driver.sync()
+        incomplete = [key for key in started if not key in committed \
+            and not key[1] in self.driver.list_versions(key[0])]
+
+        counts = collections.Counter()
+        for item_id in self.driver.list_items():
+            for version in self.driver.list_versions(item_id):
+                counts.update(self.driver.read_version(item_id,
+                    version)["chunk_hashes"])
+        deleted = []
+        with self.lock:
+            self.db.execute("BEGIN")
+            try:
+                known = set()
+                for (chunk_hash,) in self.db.execute("SELECT chunk_hash " +\
+                        "FROM chunk_refs").fetchall():
+                    known.add(chunk_hash)
+                    if counts[chunk_hash] == 0:
+                        self.db.execute("DELETE FROM chunk_refs WHERE " +\
+                            "chunk_hash = ?", (chunk_hash,))
+                        deleted.append(chunk_hash)
+                    else:
+                        self.db.execute("UPDATE chunk_refs SET refcount = " +\
+                            "? WHERE chunk_hash = ?", (counts[chunk_hash],
+                            chunk_hash))
+                for (chunk_hash, count) in counts.items():
+                    if not chunk_hash in known:
+                        # the reference to it got lost in the crash:
+                        self.db.execute("INSERT INTO chunk_refs (" +\
+                            "chunk_hash, size, refcount) VALUES (?, ?, ?)",
+                            (chunk_hash, len(self.driver.get_chunk(
+                            chunk_hash)), count))
+                self.db.execute("COMMIT")
+            except BaseException:
+                self.db.execute("ROLLBACK")
+                raise
+            # chunks stored just before the crash which nothing refers to:
+            for chunk_hash in self.driver.list_chunks():
+                if counts[chunk_hash] == 0 and not chunk_hash in deleted:
+                    deleted.append(chunk_hash)
+            for chunk_hash in deleted:
+                self.driver.delete_chunk(chunk_hash)
+        self.journal.reset()
+        self.recovered_items = sorted(set([item_id for (item_id, version) \
+            in committed.keys()]))
+        logging.warning("Recovered storage after unclean shutdown: " +\
+            "replayed " + str(len(committed)) + " saves, discarded " +\
+            str(len(incomplete)) + " unfinished content versions and " +\
+            str(len(deleted)) + " unused chunks.")
+
+    def sync(self):
+        self.driver.sync()
+
+    def close(self):
+        # nothing can read anymore, so drop what the leases kept:
+        with self.lock:
+            deferred = list(self.deferred_releases.values())
+            self.deferred_releases = dict()
+        # chunk hash -> [lock, number of put_many calls] for the chunks
+        # which are being written outside of self.lock:
+        self.writing = dict()
+        for chunk_hashes in deferred:
+            self.release(chunk_hashes)
+        if self.journal != None:
+            self.journal.close()
+        with self.lock:
+            self.closed = True
+            self.db.close()
+        self.driver.close()
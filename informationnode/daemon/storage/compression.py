@@ -0,0 +1,147 @@
+'''
+information-node - an advanced tool for data synchronization
+Copyright (C) 2015  Information Node Development Team (see AUTHORS.md)
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 2 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+
+import bz2
+import lzma
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+class Codec(object):
+    """ A compression algorithm for chunks. The codec_id is stored in front
+        of every compressed chunk, so it must never change.
+    """
+    def __init__(self, name, codec_id, compress, decompress, default_level):
+        self.name = name
+        self.codec_id = codec_id
+        self.default_level = default_level
+        self._compress = compress
+        self._decompress = decompress
+
+    def compress(self, data, level=None):
+        if level == None:
+            level = self.default_level
+        return self._compress(data, level)
+
+    def decompress(self, data):
+        return self._decompress(data)
+
+# codec id -> Codec. Codecs whose module isn't installed are left out, but
+# keep their id reserved:
+CODECS = dict()
+
+def register_codec(codec):
+    CODECS[codec.codec_id] = codec
+
+register_codec(Codec("none", 0, lambda data, level: bytes(data),
+    lambda data: bytes(data), None))
+register_codec(Codec("zlib", 1, lambda data, level: zlib.compress(data,
+    level), zlib.decompress, 6))
+register_codec(Codec("bz2", 2, lambda data, level: bz2.compress(data,
+    level), bz2.decompress, 9))
+register_codec(Codec("lzma", 3, lambda data, level: lzma.compress(data,
+    preset=level), lzma.decompress, 6))
+if zstandard != None:
+    register_codec(Codec("zstd", 4, lambda data, level:
+        zstandard.ZstdCompressor(level=level).compress(data),
+        lambda data: zstandard.ZstdDecompressor().decompress(data), 3))
+CODEC_NAMES = {4 : "zstd"}
+for codec in CODECS.values():
+    CODEC_NAMES[codec.codec_id] = codec.name
+
+def get_codec(name):
+    for codec in CODECS.values():
+        if codec.name == name:
+            return codec
+    raise ValueError("compression " + str(name) + " isn't available")
+
+# mime types whose data is compressed already:
+INCOMPRESSIBLE_MIME_PREFIXES = ["image/", "video/", "audio/"]
+INCOMPRESSIBLE_MIME_TYPES = ["application/zip", "application/gzip",
+    "application/x-gzip", "application/x-bzip2", "application/x-xz",
+    "application/x-7z-compressed", "application/x-rar-compressed",
+    "application/zstd", "application/vnd.rar", "application/x-lzma"]
+# exceptions to the prefixes above which compress well:
+COMPRESSIBLE_MIME_TYPES = ["image/svg+xml", "image/bmp", "image/x-ms-bmp",
+    "image/x-portable-pixmap", "audio/wav", "audio/x-wav"]
+
+def is_incompressible_mime_type(mime_type):
+    if mime_type == None:
+        return False
+    mime_type = mime_type.lower()
+    if mime_type in COMPRESSIBLE_MIME_TYPES:
+        return False
+    if mime_type in INCOMPRESSIBLE_MIME_TYPES:
+        return True
+    for prefix in INCOMPRESSIBLE_MIME_PREFIXES:
+        if mime_type.startswith(prefix):
+            return True
+    return False
+
+class ChunkCompressor(object):
+    """ Compresses chunks with the given codec (see CODECS) before they are
+        encrypted and stored. Every encoded chunk starts with one byte for
+        the codec id it was compressed with, 0 for none.
+
+        Compression is skipped for mime types which are compressed already,
+        and for chunks where a quick trial compression of the first
+        sample_size bytes doesn't get below max_ratio of the original size,
+        so incompressible data costs little time.
+    """
+    def __init__(self, codec="zlib", level=None, max_ratio=0.9,
+            sample_size=(1024 * 8)):
+        self.codec = get_codec(codec)
+        self.level = level
+        self.max_ratio = max_ratio
+        self.sample_size = sample_size
+
+    def encode(self, data, mime_type=None):
+        """ Get the framed, possibly compressed form of the chunk data. """
+        codec = self.codec
+        if codec.codec_id == 0 or len(data) < 64 or \
+                is_incompressible_mime_type(mime_type):
+            return bytes([0]) + bytes(data)
+        if len(data) > self.sample_size * 2:
+            sample = bytes(data[:self.sample_size])
+            if len(zlib.compress(sample, 1)) > \
+                    len(sample) * self.max_ratio:
+                return bytes([0]) + bytes(data)
+        compressed = codec.compress(data, self.level)
+        if len(compressed) > len(data) * self.max_ratio:
+            return bytes([0]) + bytes(data)
+        return bytes([codec.codec_id]) + compressed
+
+def decode_chunk(data):
+    """ Get the original data of a chunk encoded by ChunkCompressor. For an
+        uncompressed chunk given as a memoryview, a view is returned
+        without copying.
+    """
+    codec_id = data[0]
+    if codec_id == 0:
+        if isinstance(data, memoryview):
+            return data[1:]
+        return bytes(data[1:])
+    if not codec_id in CODECS:
+        raise RuntimeError("chunk is compressed with " +\
+            CODEC_NAMES.get(codec_id, "unknown codec " + str(codec_id)) +\
+            ", which isn't available")
+    return CODECS[codec_id].decompress(data[1:])
@@ -0,0 +1,934 @@
+'''
+information-node - an advanced tool for data synchronization
+Copyright (C) 2015  Information Node Development Team (see AUTHORS.md)
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 2 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+
+import hashlib
+import json
+import logging
+import mmap
+import os
+import platform
+import shutil
+import struct
+import threading
+import time
+import zlib
+
+class StorageDriver(object):
+    """ Interface of the storage layouts for the data of a node's storage
+        folder: chunks (by hash), and one record per item content version
+        with its metadata and list of chunk hashes.
+
+        Use open_storage_driver() to get the driver a node was created with.
+    """
+    name = None
+    # how many items migrate_step() moved so far:
+    migrated_items = 0
+
+    def has_chunk(self, chunk_hash):
+        raise NotImplementedError()
+
+    def put_chunk(self, chunk_hash, data):
+        raise NotImplementedError()
+
+    def get_chunk(self, chunk_hash):
+        """ Returns the chunk data, or raises a ValueError if there is no
+            chunk with that hash.
+        """
+        raise NotImplementedError()
+
+    def get_chunk_view(self, chunk_hash):
+        """ Like get_chunk, but returns a read-only memoryview. Drivers which
+            can, return a view of the memory-mapped file the chunk is stored
+            in, so reading it doesn't copy the data.
+        """
+        return memoryview(self.get_chunk(chunk_hash))
+
+    def delete_chunk(self, chunk_hash):
+        raise NotImplementedError()
+
+    def list_chunks(self):
+        """ Returns the hashes of all stored chunks. """
+        raise NotImplementedError()
+
+    def write_version(self, item_id, content_version, record):
+        """ Store the given JSON serializable record for a content version of
+            an item, replacing the previous one if any.
+        """
+        raise NotImplementedError()
+
+    def read_version(self, item_id, content_version):
+        """ Returns the record of a content version of an item, or raises a
+            ValueError if there is no such content version.
+        """
+        raise NotImplementedError()
+
+    def list_versions(self, item_id):
+        """ Returns the sorted list of stored content versions of an item.
+        """
+        raise NotImplementedError()
+
+    def delete_version(self, item_id, content_version):
+        raise NotImplementedError()
+
+    def list_items(self):
+        """ Returns the identifiers of all items with stored versions. """
+        raise NotImplementedError()
+
+    def compact_step(self, max_bytes):
+        """ Reclaim some space taken up by deleted data, copying at most
+            about max_bytes of live data to do so. Returns a tuple
+            (io_bytes, freed_bytes) of the bytes copied or freed and of the
+            bytes actually freed, (0, 0) if there is nothing to do right now.
+        """
+        return (0, 0)
+
+    def migrate_step(self, max_items, leftover_age=3600.0):
+        """ Move at most max_items items from an older on-disk layout to
+            the current one, while the driver stays in use. Returns
+            (moved, skipped), where skipped items can't be moved right now
+            (e.g. since a write to them is in progress) and are tried again
+            once the others are done. (0, 0) once nothing is left to
+            migrate.
+
+            Leftovers of interrupted writes older than leftover_age seconds
+            are removed. Without a running data server, nothing can be in
+            progress, so 0 removes all of them.
+        """
+        return (0, 0)
+
+    def sync(self):
+        """ Make sure everything written so far is on disk. """
+        pass
+
+    def close(self):
+        pass
+
+# mapped files can't be deleted or truncated on windows, so don't map them
+# there:
+USE_MMAP = (platform.system().lower() != "windows")
+
+def _check_item_id(item_id):
+    if len(item_id) == 0 or item_id.find("/") >= 0 or \
+            item_id.find("\\") >= 0 or item_id.startswith("."):
+        raise ValueError("invalid item identifier: " + str(item_id))
+
+class DirectoryStorageDriver(StorageDriver):
+    """ Stores each chunk as a file named by its hash in storage/chunks,
+        spread over subfolders by the first two hex digits of the hash so no
+        single folder gets too large. Each item is a folder with a
+        subfolder per content version holding its record. Item folders are
+        spread over two levels of subfolders of storage/item-shards by the
+        SHA-256 hash of the identifier, e.g. item-shards/3f/a0/<item id>,
+        so even millions of items give small folders.
+
+        Nodes created before had all item folders directly in
+        storage/items. Those are still found there, and migrate_step()
+        moves them over a few at a time while the node is running: every
+        version folder is moved with a single rename, and lookups check
+        the new place again after the old one, so they never miss a
+        version that moved in between.
+
+        This is simple to inspect, but needs many small files. With sync,
+        the files written since the last sync() are all synced by it,
+        instead of each one right away.
+    """
+    name = "directory"
+
+    def __init__(self, storage_path, sync=True):
+        self.storage_path = storage_path
+        self.chunks_path = os.path.join(storage_path, "chunks")
+        self.shards_path = os.path.join(storage_path, "item-shards")
+        # the flat item folders of the old layout, if any:
+        self.items_path = os.path.join(storage_path, "items")
+        self.sync_writes = sync
+        self.unsynced_lock = threading.Lock()
+        self.unsynced_paths = set()
+        # the chunk subfolder compact_step() looked at last:
+        self.compact_folder_no = -1
+        self.migrated_items = 0
+        # items left to migrate (None if not listed yet), and those the
+        # migration has to come back to later:
+        self.migration_queue = None
+        self.skipped_items = []
+        for path in [self.chunks_path, self.shards_path]:
+            if not os.path.exists(path):
+                os.mkdir(path)
+
+    def _write_file(self, path, data):
+        folder = os.path.dirname(path)
+        if not os.path.exists(folder):
+            os.makedirs(folder, exist_ok=True)
+        # write to a temporary file first, so a crash never leaves a file
+        # with partial contents behind:
+        temp_path = path + ".tmp-" + str(threading.get_ident())
+        with open(temp_path, "wb") as f:
+            f.write(data)
+        os.replace(temp_path, path)
+        if self.sync_writes:
+            with self.unsynced_lock:
+                self.unsynced_paths.add(path)
+
+    def sync(self):
+        with self.unsynced_lock:
+            paths = self.unsynced_paths
+            self.unsynced_paths = set()
+        folders = set()
+        for path in paths:
+            try:
+                fd = os.open(path, os.O_RDONLY | getattr(os, "O_BINARY", 0))
+            except FileNotFoundError:
+                # deleted again in the meantime.
+                continue
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+            folders.add(os.path.dirname(path))
+        self._sync_folders(folders)
+
+    def _chunk_path(self, chunk_hash):
+        return os.path.join(self.chunks_path, chunk_hash[:2], chunk_hash)
+
+    def has_chunk(self, chunk_hash):
+        return os.path.exists(self._chunk_path(chunk_hash))
+
+    def put_chunk(self, chunk_hash, data):
+        self._write_file(self._chunk_path(chunk_hash), data)
+
+    def get_chunk(self, chunk_hash):
+        try:
+            with open(self._chunk_path(chunk_hash), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            raise ValueError("no chunk with hash " + str(chunk_hash))
+
+    def get_chunk_view(self, chunk_hash):
+        if not USE_MMAP:
+            return memoryview(self.get_chunk(chunk_hash))
+        try:
+            with open(self._chunk_path(chunk_hash), "rb") as f:
+                if os.fstat(f.fileno()).st_size == 0:
+                    return memoryview(b"")
+                return memoryview(mmap.mmap(f.fileno(), 0,
+                    access=mmap.ACCESS_READ))
+        except FileNotFoundError:
+            raise ValueError("no chunk with hash " + str(chunk_hash))
+
+    def delete_chunk(self, chunk_hash):
+        try:
+            os.remove(self._chunk_path(chunk_hash))
+        except FileNotFoundError:
+            pass
+
+    def list_chunks(self):
+        chunk_hashes = []
+        for folder in os.listdir(self.chunks_path):
+            folder_path = os.path.join(self.chunks_path, folder)
+            if len(folder) != 2 or not os.path.isdir(folder_path):
+                continue
+            chunk_hashes += [name for name in os.listdir(folder_path) \
+                if name.find(".tmp-") < 0]
+        return chunk_hashes
+
+    def compact_step(self, max_bytes, min_age=3600.0):
+        """ Deleted chunks and versions free their files right away, so this
+            only removes temporary files which were left behind by a crash,
+            one chunk subfolder per call.
+        """
+        folders = sorted(os.listdir(self.chunks_path))
+        if len(folders) == 0:
+            return (0, 0)
+        self.compact_folder_no = (self.compact_folder_no + 1) % len(folders)
+        folder_path = os.path.join(self.chunks_path,
+            folders[self.compact_folder_no])
+        if not os.path.isdir(folder_path):
+            return (0, 0)
+        freed = 0
+        for name in os.listdir(folder_path):
+            if name.find(".tmp-") < 0:
+                continue
+            path = os.path.join(folder_path, name)
+            try:
+                info = os.stat(path)
+                if info.st_mtime < time.time() - min_age:
+                    os.remove(path)
+                    freed += info.st_size
+            except OSError:
+                pass
+        return (freed, freed)
+
+    def _item_path(self, item_id):
+        _check_item_id(item_id)
+        shard = hashlib.sha256(item_id.encode("utf-8")).hexdigest()
+        return os.path.join(self.shards_path, shard[:2], shard[2:4],
+            item_id)
+
+    def _flat_item_path(self, item_id):
+        _check_item_id(item_id)
+        return os.path.join(self.items_path, item_id)
+
+    def _version_path(self, item_id, content_version):
+        return os.path.join(self._item_path(item_id),
+            str(int(content_version)), "version.json")
+
+    def _find_version_path(self, item_id, content_version):
+        """ Get the path of a stored version record in either layout, or
+            None if it doesn't exist.
+        """
+        path = self._version_path(item_id, content_version)
+        if os.path.exists(path):
+            return path
+        flat_path = os.path.join(self._flat_item_path(item_id),
+            str(int(content_version)), "version.json")
+        if os.path.exists(flat_path):
+            return flat_path
+        # it may have been migrated since the first check:
+        if os.path.exists(path):
+            return path
+        return None
+
+    def write_version(self, item_id, content_version, record):
+        self._write_file(self._version_path(item_id, content_version),
+            json.dumps(record).encode("utf-8"))
+
+    def read_version(self, item_id, content_version):
+        path = self._find_version_path(item_id, content_version)
+        try:
+            if path == None:
+                raise FileNotFoundError(content_version)
+            with open(path, "rb") as f:
+                return json.loads(f.read().decode("utf-8"))
+        except FileNotFoundError:
+            raise ValueError("no content version " + str(content_version) +\
+                " of item " + str(item_id))
+
+    def _version_names(self, item_path):
+        try:
+            names = os.listdir(item_path)
+        except FileNotFoundError:
+            return set()
+        return set([int(name) for name in names if name.isdigit() and \
+            os.path.exists(os.path.join(item_path, name, "version.json"))])
+
+    def list_versions(self, item_id):
+        # old folder first, so versions moved in between are still seen:
+        versions = self._version_names(self._flat_item_path(item_id))
+        versions |= self._version_names(self._item_path(item_id))
+        return sorted(versions)
+
+    def list_items(self):
+        item_ids = set()
+        if os.path.exists(self.items_path):
+            for item_id in os.listdir(self.items_path):
+                if not item_id.startswith(".") and \
+                        len(self.list_versions(item_id)) > 0:
+                    item_ids.add(item_id)
+        for first in os.listdir(self.shards_path):
+            first_path = os.path.join(self.shards_path, first)
+            if len(first) != 2 or not os.path.isdir(first_path):
+                continue
+            for second in os.listdir(first_path):
+                second_path = os.path.join(first_path, second)
+                if len(second) != 2 or not os.path.isdir(second_path):
+                    continue
+                for item_id in os.listdir(second_path):
+                    if len(self._version_names(os.path.join(second_path,
+                            item_id))) > 0:
+                        item_ids.add(item_id)
+        return list(item_ids)
+
+    def _remove_version_folder(self, item_path, content_version):
+        try:
+            os.remove(os.path.join(item_path, str(int(content_version)),
+                "version.json"))
+            os.rmdir(os.path.join(item_path, str(int(content_version))))
+            os.rmdir(item_path)
+        except OSError:
+            pass
+
+    def delete_version(self, item_id, content_version):
+        # in the same order as lookups, so a concurrent migration can't
+        # move the version out of the way:
+        self._remove_version_folder(self._flat_item_path(item_id),
+            content_version)
+        self._remove_version_folder(self._item_path(item_id),
+            content_version)
+
+    def migrate_step(self, max_items, leftover_age=3600.0):
+        """ Move up to max_items item folders from storage/items to their
+            shard folder. Removes storage/items once it is empty. Items with
+            a write in progress are skipped until the others are moved.
+        """
+        if not os.path.exists(self.items_path):
+            return (0, 0)
+        if self.migration_queue == None:
+            # listed once, since nothing new is added to the old folder.
+            # Taken from the end, so items are moved in order:
+            self.migration_queue = sorted([name for name in \
+                os.listdir(self.items_path) if not name.startswith(".")],
+                reverse=True)
+        if len(self.migration_queue) == 0 and len(self.skipped_items) > 0:
+            # give them another try:
+            self.migration_queue = list(reversed(self.skipped_items))
+            self.skipped_items = []
+        if len(self.migration_queue) == 0:
+            self.migration_queue = None
+            try:
+                os.rmdir(self.items_path)
+                logging.info("Moved all items to the sharded layout.")
+            except OSError:
+                pass
+            return (0, 0)
+        item_ids = self.migration_queue[-max_items:]
+        del(self.migration_queue[-max_items:])
+        moved = 0
+        for item_id in item_ids:
+            if self._migrate_item(item_id, leftover_age):
+                self.migrated_items += 1
+                moved += 1
+            else:
+                self.skipped_items.append(item_id)
+        return (moved, len(self.skipped_items))
+
+    def _migrate_item(self, item_id, leftover_age):
+        """ Move the versions of an item to its shard folder. Returns False
+            if that has to wait for a write in progress. Versions deleted
+            meanwhile are simply gone, not an error.
+        """
+        old_path = self._flat_item_path(item_id)
+        new_path = self._item_path(item_id)
+        try:
+            names = os.listdir(old_path)
+        except FileNotFoundError:
+            return True
+        os.makedirs(new_path, exist_ok=True)
+        for name in names:
+            old_version = os.path.join(old_path, name)
+            new_version = os.path.join(new_path, name)
+            if not name.isdigit() or not os.path.exists(os.path.join(
+                    old_version, "version.json")):
+                # leftovers like temporary files from a crash, or a version
+                # deleted meanwhile:
+                if os.path.isdir(old_version):
+                    shutil.rmtree(old_version, ignore_errors=True)
+                else:
+                    try:
+                        os.remove(old_version)
+                    except FileNotFoundError:
+                        pass
+                continue
+            if os.path.exists(os.path.join(new_version, "version.json")):
+                # written again since, so the new one is newer:
+                shutil.rmtree(old_version, ignore_errors=True)
+                continue
+            if os.path.exists(new_version):
+                # a write of this version to the new place is in progress,
+                # or was interrupted by a crash:
+                try:
+                    for leftover in os.listdir(new_version):
+                        path = os.path.join(new_version, leftover)
+                        if os.stat(path).st_mtime <= \
+                                time.time() - leftover_age:
+                            os.remove(path)
+                    os.rmdir(new_version)
+                except FileNotFoundError:
+                    pass
+                except OSError:
+                    # still in progress, try again later.
+                    return False
+            try:
+                os.replace(old_version, new_version)
+            except FileNotFoundError:
+                # deleted meanwhile.
+                pass
+        self._sync_folders([new_path, os.path.dirname(new_path)])
+        try:
+            os.rmdir(old_path)
+        except FileNotFoundError:
+            pass
+        return True
+
+    def _sync_folders(self, folders):
+        if platform.system().lower() == "windows":
+            # folders can't be opened for syncing there.
+            return
+        for folder in folders:
+            fd = os.open(folder, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+
+class PackfileStorageDriver(StorageDriver):
+    """ Appends chunks and content version records to large segment files
+        in storage/packs, so a node with millions of items doesn't need
+        millions of files. Each record is:
+
+        RECORD_HEADER (type, key length, value length, CRC32), key, value
+
+        Records are never changed in place: deleting or replacing something
+        appends a new record, and the space of the old one becomes dead
+        until the segment is compacted. An in-memory index maps each key to
+        the offset of its current value.
+
+        Once a segment reaches max_segment_size, it is sealed and its index
+        is written next to it, so opening the storage only needs to scan
+        the last segment. A torn record at the end of the last segment (e.g.
+        after a crash) is cut off.
+
+        compact_step() compacts the sealed segment with the most dead space
+        a piece at a time: its live records are appended again, and once
+        all are, the segment is retired. Retired segments are only removed
+        after retire_delay seconds, so reads which looked up a location in
+        them just before can still finish.
+    """
+    name = "packfile"
+    RECORD_HEADER = struct.Struct("!BHII")
+    RECORD_CHUNK = 1
+    RECORD_VERSION = 2
+    RECORD_DELETE_CHUNK = 3
+    RECORD_DELETE_VERSION = 4
+    INDEX_ENTRY = struct.Struct("!BHQI")
+
+    def __init__(self, storage_path, max_segment_size=(1024 * 1024 * 256),
+            min_dead_ratio=0.3, retire_delay=60.0):
+        self.storage_path = storage_path
+        self.packs_path = os.path.join(storage_path, "packs")
+        self.max_segment_size = max_segment_size
+        self.min_dead_ratio = min_dead_ratio
+        self.retire_delay = retire_delay
+        if not os.path.exists(self.packs_path):
+            os.mkdir(self.packs_path)
+        self.lock = threading.Lock()
+
+        # key -> (segment_no, value offset, value length). Chunk keys are
+        # hashes, version keys are "<item id>/<content version>":
+        self.chunk_index = dict()
+        self.version_index = dict()
+        self.item_versions = dict()
+        self.dead_bytes = dict()
+
+        self.read_fds = dict()
+        self.read_locks = dict()
+        self.maps = dict()
+        # [segment no, index entries, next entry, older segments exist] of
+        # the segment being compacted, if any:
+        self.compaction = None
+        # segment no -> time it was retired by compaction:
+        self.retired = dict()
+        segments = self._segment_numbers()
+        for segment_no in segments[:-1]:
+            self._load_segment(segment_no, sealed=True)
+        self.active_no = 1
+        active_entries = []
+        if len(segments) > 0:
+            self.active_no = segments[-1]
+            active_entries = self._load_segment(self.active_no,
+                sealed=False)
+        self._open_active(active_entries)
+
+    def _segment_path(self, segment_no, ending=".pack"):
+        return os.path.join(self.packs_path, "segment-" +\
+            ("%08d" % segment_no) + ending)
+
+    def _segment_numbers(self):
+        result = []
+        for name in os.listdir(self.packs_path):
+            if name.startswith("segment-") and name.endswith(".pack"):
+                try:
+                    result.append(int(name[len("segment-"):-len(".pack")]))
+                except ValueError:
+                    pass
+        return sorted(result)
+
+    def _apply_record(self, record_type, key, segment_no, offset, length):
+        """ Update the in-memory index for a record at the given location.
+        """
+        if record_type in [self.RECORD_CHUNK, self.RECORD_DELETE_CHUNK]:
+            index = self.chunk_index
+        else:
+            index = self.version_index
+        old = index.pop(key, None)
+        if old != None:
+            self.dead_bytes[old[0]] = self.dead_bytes.get(old[0], 0) +\
+                old[2]
+        if record_type in [self.RECORD_CHUNK, self.RECORD_VERSION]:
+            index[key] = (segment_no, offset, length)
+        if record_type in [self.RECORD_VERSION, self.RECORD_DELETE_VERSION]:
+            (item_id, version) = key.rsplit("/", 1)
+            versions = self.item_versions.setdefault(item_id, set())
+            if record_type == self.RECORD_VERSION:
+                versions.add(int(version))
+            else:
+                versions.discard(int(version))
+                if len(versions) == 0:
+                    del(self.item_versions[item_id])
+
+    def _load_segment(self, segment_no, sealed):
+        """ Add the records of a segment to the in-memory index, and return
+            their index entries.
+        """
+        if sealed and os.path.exists(self._segment_path(segment_no, ".idx")):
+            return self._load_index_file(segment_no)
+        path = self._segment_path(segment_no)
+        entries = []
+        offset = 0
+        with open(path, "rb") as f:
+            while True:
+                header = f.read(self.RECORD_HEADER.size)
+                if len(header) < self.RECORD_HEADER.size:
+                    break
+                (record_type, key_len, value_len, crc) = \
+                    self.RECORD_HEADER.unpack(header)
+                body = f.read(key_len + value_len)
+                if len(body) < key_len + value_len or \
+                        zlib.crc32(body) != crc:
+                    break
+                key = body[:key_len].decode("utf-8")
+                value_offset = offset + self.RECORD_HEADER.size + key_len
+                self._apply_record(record_type, key, segment_no,
+                    value_offset, value_len)
+                entries.append((record_type, key, value_offset, value_len))
+                offset = value_offset + value_len
+        if offset < os.path.getsize(path):
+            if sealed:
+                raise RuntimeError("packfile segment " + path + " is " +\
+                    "damaged at offset " + str(offset))
+            logging.warning("cutting off torn record at the end of " +\
+                "packfile segment " + path)
+            with open(path, "r+b") as f:
+                f.truncate(offset)
+        if sealed:
+            self._write_index_file(segment_no, entries)
+        return entries
+
+    def _write_index_file(self, segment_no, entries):
+        parts = []
+        for (record_type, key, offset, length) in entries:
+            key = key.encode("utf-8")
+            parts.append(self.INDEX_ENTRY.pack(record_type, len(key), offset,
+                length))
+            parts.append(key)
+        path = self._segment_path(segment_no, ".idx")
+        with open(path + ".tmp", "wb") as f:
+            f.write(b"".join(parts))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + ".tmp", path)
+
+    def _read_index_file(self, segment_no):
+        """ Get the (record type, key, value offset, value length) of all
+            records of a sealed segment.
+        """
+        with open(self._segment_path(segment_no, ".idx"), "rb") as f:
+            data = f.read()
+        entries = []
+        pos = 0
+        while pos < len(data):
+            (record_type, key_len, offset, length) = \
+                self.INDEX_ENTRY.unpack_from(data, pos)
+            pos += self.INDEX_ENTRY.size
+            key = data[pos:pos + key_len].decode("utf-8")
+            pos += key_len
+            entries.append((record_type, key, offset, length))
+        return entries
+
+    def _load_index_file(self, segment_no):
+        entries = self._read_index_file(segment_no)
+        for (record_type, key, offset, length) in entries:
+            self._apply_record(record_type, key, segment_no, offset, length)
+        return entries
+
+    def _open_active(self, entries=None):
+        """ Open the active segment for appending. The entries are those of
+            the records it already has, which its index needs once sealed.
+        """
+        path = self._segment_path(self.active_no)
+        flags = os.O_WRONLY | os.O_CREAT | os.O_APPEND
+        if hasattr(os, "O_BINARY"):
+            flags |= os.O_BINARY
+        self.active_fd = os.open(path, flags, 0o600)
+        self.active_size = os.path.getsize(path)
+        self.active_entries = list(entries or [])
+
+    def _seal_active(self):
+        """ Finish the active segment and start a new one. """
+        os.fsync(self.active_fd)
+        os.close(self.active_fd)
+        self._write_index_file(self.active_no, self.active_entries)
+        self.active_no += 1
+        self._open_active()
+
+    def _append(self, record_type, key, value=b""):
+        with self.lock:
+            self._append_locked(record_type, key, value)
+
+    def _append_locked(self, record_type, key, value=b""):
+        """ Append a record to the active segment. Needs the lock. """
+        key_bytes = key.encode("utf-8")
+        header = self.RECORD_HEADER.pack(record_type, len(key_bytes),
+            len(value), zlib.crc32(value, zlib.crc32(key_bytes)))
+        if self.active_size > 0 and self.active_size + len(header) +\
+                len(key_bytes) + len(value) > self.max_segment_size:
+            self._seal_active()
+        if hasattr(os, "writev"):
+            # avoids copying the value into one joined buffer first:
+            written = os.writev(self.active_fd, [header, key_bytes, value])
+        else:
+            written = os.write(self.active_fd, b"".join([header,
+                key_bytes, value]))
+        if written != len(header) + len(key_bytes) + len(value):
+            raise OSError("short write to packfile segment")
+        value_offset = self.active_size + len(header) + len(key_bytes)
+        self.active_size = value_offset + len(value)
+        self._apply_record(record_type, key, self.active_no,
+            value_offset, len(value))
+        self.active_entries.append((record_type, key, value_offset,
+            len(value)))
+
+    def _read_fd(self, segment_no):
+        """ Get the read-only file descriptor of a segment. Needs the lock.
+        """
+        if not segment_no in self.read_fds:
+            flags = os.O_RDONLY
+            if hasattr(os, "O_BINARY"):
+                flags |= os.O_BINARY
+            self.read_fds[segment_no] = os.open(
+                self._segment_path(segment_no), flags)
+            self.read_locks[segment_no] = threading.Lock()
+        return self.read_fds[segment_no]
+
+    def _view(self, location):
+        """ Get a memoryview of the given value location in the memory-mapped
+            segment. The active segment is mapped again when it has grown
+            past the mapped size. Views of older mappings stay valid.
+        """
+        (segment_no, offset, length) = location
+        if length == 0:
+            return memoryview(b"")
+        if not USE_MMAP:
+            return memoryview(self._read(location))
+        with self.lock:
+            mapped = self.maps.get(segment_no, None)
+            if mapped == None or len(mapped) < offset + length:
+                mapped = mmap.mmap(self._read_fd(segment_no), 0,
+                    access=mmap.ACCESS_READ)
+                self.maps[segment_no] = mapped
+        return memoryview(mapped)[offset:offset + length]
+
+    def _read(self, location):
+        (segment_no, offset, length) = location
+        with self.lock:
+            fd = self._read_fd(segment_no)
+        if hasattr(os, "pread"):
+            return os.pread(fd, length, offset)
+        # e.g. on windows.
+        with self.read_locks[segment_no]:
+            os.lseek(fd, offset, os.SEEK_SET)
+            return os.read(fd, length)
+
+    def has_chunk(self, chunk_hash):
+        with self.lock:
+            return chunk_hash in self.chunk_index
+
+    def put_chunk(self, chunk_hash, data):
+        self._append(self.RECORD_CHUNK, chunk_hash, data)
+
+    def get_chunk(self, chunk_hash):
+        with self.lock:
+            location = self.chunk_index.get(chunk_hash, None)
+        if location == None:
+            raise ValueError("no chunk with hash " + str(chunk_hash))
+        return self._read(location)
+
+    def get_chunk_view(self, chunk_hash):
+        with self.lock:
+            location = self.chunk_index.get(chunk_hash, None)
+        if location == None:
+            raise ValueError("no chunk with hash " + str(chunk_hash))
+        return self._view(location)
+
+    def delete_chunk(self, chunk_hash):
+        if self.has_chunk(chunk_hash):
+            self._append(self.RECORD_DELETE_CHUNK, chunk_hash)
+
+    def list_chunks(self):
+        with self.lock:
+            return list(self.chunk_index.keys())
+
+    def write_version(self, item_id, content_version, record):
+        _check_item_id(item_id)
+        self._append(self.RECORD_VERSION, item_id + "/" +\
+            str(int(content_version)), json.dumps(record).encode("utf-8"))
+
+    def read_version(self, item_id, content_version):
+        with self.lock:
+            location = self.version_index.get(item_id + "/" +\
+                str(int(content_version)), None)
+        if location == None:
+            raise ValueError("no content version " + str(content_version) +\
+                " of item " + str(item_id))
+        return json.loads(self._read(location).decode("utf-8"))
+
+    def list_versions(self, item_id):
+        with self.lock:
+            return sorted(self.item_versions.get(item_id, set()))
+
+    def list_items(self):
+        with self.lock:
+            return list(self.item_versions.keys())
+
+    def delete_version(self, item_id, content_version):
+        key = item_id + "/" + str(int(content_version))
+        with self.lock:
+            if not key in self.version_index:
+                return
+        self._append(self.RECORD_DELETE_VERSION, key)
+
+    def _pick_segment(self):
+        """ Get the sealed segment with the largest share of dead space, if
+            it is at least min_dead_ratio, or None.
+        """
+        best = None
+        best_ratio = self.min_dead_ratio
+        for segment_no in self._segment_numbers():
+            if segment_no >= self.active_no or segment_no in self.retired:
+                continue
+            size = os.path.getsize(self._segment_path(segment_no))
+            ratio = self.dead_bytes.get(segment_no, 0) / max(size, 1)
+            if ratio >= best_ratio and size > 0:
+                (best, best_ratio) = (segment_no, ratio)
+        return best
+
+    def _remove_retired(self):
+        for (segment_no, retired_time) in list(self.retired.items()):
+            if retired_time + self.retire_delay > time.monotonic():
+                continue
+            with self.lock:
+                fd = self.read_fds.pop(segment_no, None)
+                self.read_locks.pop(segment_no, None)
+                # its mapping is closed once no views of it are left:
+                self.maps.pop(segment_no, None)
+                self.dead_bytes.pop(segment_no, None)
+                del(self.retired[segment_no])
+            if fd != None:
+                os.close(fd)
+            for ending in [".pack", ".idx"]:
+                try:
+                    os.remove(self._segment_path(segment_no, ending))
+                except FileNotFoundError:
+                    pass
+            logging.info("Removed compacted packfile segment " +\
+                str(segment_no))
+
+    def compact_step(self, max_bytes):
+        freed = 0
+        if len(self.retired) > 0:
+            self._remove_retired()
+        if self.compaction == None:
+            segment_no = self._pick_segment()
+            if segment_no == None:
+                return (0, 0)
+            older_exist = (min(self._segment_numbers()) < segment_no)
+            self.compaction = [segment_no,
+                self._read_index_file(segment_no), 0, older_exist]
+        (segment_no, entries, pos, older_exist) = self.compaction
+        copied = 0
+        while pos < len(entries) and copied < max_bytes:
+            (record_type, key, offset, length) = entries[pos]
+            pos += 1
+            if record_type in [self.RECORD_CHUNK, self.RECORD_DELETE_CHUNK]:
+                index = self.chunk_index
+            else:
+                index = self.version_index
+            if record_type in [self.RECORD_CHUNK, self.RECORD_VERSION]:
+                location = (segment_no, offset, length)
+                with self.lock:
+                    if index.get(key, None) != location:
+                        continue
+                value = self._read(location)
+                with self.lock:
+                    # unless it was replaced or deleted while reading:
+                    if index.get(key, None) == location:
+                        self._append_locked(record_type, key, value)
+                        copied += len(value)
+            elif older_exist:
+                # deletions may still hide records in older segments, unless
+                # the key was stored again since:
+                with self.lock:
+                    if not key in index:
+                        self._append_locked(record_type, key)
+            copied += self.RECORD_HEADER.size + len(key)
+        self.compaction[2] = pos
+        if pos >= len(entries):
+            with self.lock:
+                # the copies need to be on disk before the originals go:
+                os.fsync(self.active_fd)
+                freed = os.path.getsize(self._segment_path(segment_no))
+                self.retired[segment_no] = time.monotonic()
+            self.compaction = None
+            logging.info("Compacted packfile segment " + str(segment_no))
+        return (max(copied, freed), freed)
+
+    def stats(self):
+        with self.lock:
+            return {"segments" : self.active_no,
+                "active_segment_size" : self.active_size,
+                "dead_bytes" : sum(self.dead_bytes.values()),
+                "retired_segments" : len(self.retired)}
+
+    def sync(self):
+        with self.lock:
+            os.fsync(self.active_fd)
+
+    def close(self):
+        with self.lock:
+            os.close(self.active_fd)
+            for fd in self.read_fds.values():
+                os.close(fd)
+            self.read_fds = dict()
+            # the mappings are closed once no views of them are left:
+            self.maps = dict()
+
+STORAGE_DRIVERS = {"directory" : DirectoryStorageDriver,
+    "packfile" : PackfileStorageDriver}
+
+def create_storage(storage_path, driver_name="packfile"):
+    """ Set up a new, empty storage folder to use the given driver. """
+    if not driver_name in STORAGE_DRIVERS:
+        raise ValueError("unknown storage driver: " + str(driver_name))
+    if not os.path.exists(storage_path):
+        os.mkdir(storage_path)
+    with open(os.path.join(storage_path, "driver"), "w") as f:
+        f.write(driver_name + "\n")
+
+def open_storage_driver(storage_path):
+    """ Open the storage folder with the driver it was created with. Nodes
+        created before there was a choice use the directory layout.
+    """
+    driver_name = "directory"
+    try:
+        with open(os.path.join(storage_path, "driver"), "r") as f:
+            driver_name = f.read().strip()
+    except FileNotFoundError:
+        pass
+    if not driver_name in STORAGE_DRIVERS:
+        raise RuntimeError("unknown storage driver: " + str(driver_name))
+    return STORAGE_DRIVERS[driver_name](storage_path)
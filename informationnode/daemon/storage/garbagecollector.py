@@ -0,0 +1,137 @@
+'''
+information-node - an advanced tool for data synchronization
+Copyright (C) 2015  Information Node Development Team (see AUTHORS.md)
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 2 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+
+import collections
+import logging
+import threading
+import time
+
+class GarbageCollector(object):
+    """ Reclaims storage space in the background, in small steps:
+
+        - the storage driver's compact_step() copies the live data out of
+          packfile segments with much dead space (left by pruned versions,
+          removed items and replaced chunks), and then removes them,
+        - every sweep_interval seconds, all stored chunks are checked in
+          batches of sweep_batch for ones without any reference, which are
+          deleted.
+
+        The work is throttled to about bytes_per_second of I/O, and whenever
+        is_busy() returns True (e.g. while api requests are queued), the
+        collector pauses for busy_pause seconds before checking again. So
+        even reclaiming a lot of space never competes with the viewers for
+        the disk for long.
+
+        References leaked by a crash are not recounted here, since chunks
+        of content versions which are still being written have references
+        but no record yet. ChunkStore.recover() does that on start.
+    """
+    def __init__(self, chunk_store, is_busy=None,
+            bytes_per_second=(1024 * 1024 * 8), step_bytes=(1024 * 1024),
+            busy_pause=1.0, idle_interval=60.0, sweep_interval=(3600 * 24),
+            sweep_batch=256):
+        self.chunk_store = chunk_store
+        if is_busy == None:
+            is_busy = lambda: False
+        self.is_busy = is_busy
+        self.bytes_per_second = bytes_per_second
+        self.step_bytes = step_bytes
+        self.busy_pause = busy_pause
+        self.idle_interval = idle_interval
+        self.sweep_interval = sweep_interval
+        self.sweep_batch = sweep_batch
+
+        self.sweep_queue = collections.deque()
+        self.last_sweep = None
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.lock = threading.Lock()
+        self.reclaimed_bytes = 0
+        self.orphans_deleted = 0
+        self.steps = 0
+        self.pauses = 0
+
+    def step(self):
+        """ Do one increment of work. Returns roughly how many bytes of I/O
+            it took, or 0 if there was nothing to do.
+        """
+        if len(self.sweep_queue) > 0:
+            batch = [self.sweep_queue.popleft() for i in \
+                range(min(self.sweep_batch, len(self.sweep_queue)))]
+            deleted = self.chunk_store.sweep_orphans(batch)
+            with self.lock:
+                self.orphans_deleted += deleted
+                self.steps += 1
+            if deleted > 0:
+                logging.info("Deleted " + str(deleted) +\
+                    " unreferenced chunks.")
+            # database lookups, count them as a small read each:
+            return len(batch) * 4096
+        if self.last_sweep == None or time.monotonic() - self.last_sweep >\
+                self.sweep_interval:
+            self.last_sweep = time.monotonic()
+            self.sweep_queue.extend(self.chunk_store.driver.list_chunks())
+            return max(1, len(self.sweep_queue)) * 64
+        (amount, freed) = self.chunk_store.driver.compact_step(
+            self.step_bytes)
+        with self.lock:
+            # copying live data out of a segment doesn't reclaim anything:
+            self.reclaimed_bytes += freed
+            if amount > 0:
+                self.steps += 1
+        return amount
+
+    def _run(self):
+        delay = self.idle_interval
+        while not self.stop_event.wait(delay):
+            if self.is_busy():
+                with self.lock:
+                    self.pauses += 1
+                delay = self.busy_pause
+                continue
+            started = time.monotonic()
+            try:
+                amount = self.step()
+            except Exception as e:
+                logging.exception("Garbage collection step failed: " +\
+                    str(e))
+                amount = 0
+            if amount == 0:
+                delay = self.idle_interval
+                continue
+            # keep to the I/O rate on average:
+            delay = max(0.01, amount / float(self.bytes_per_second) -\
+                (time.monotonic() - started))
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread != None:
+            self.thread.join()
+            self.thread = None
+
+    def stats(self):
+        with self.lock:
+            return {"reclaimed_bytes" : self.reclaimed_bytes,
+                "orphans_deleted" : self.orphans_deleted,
+                "steps" : self.steps, "pauses" : self.pauses,
+                "pending_sweep" : len(self.sweep_queue)}
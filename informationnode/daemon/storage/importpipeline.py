@@ -0,0 +1,175 @@
+'''
+information-node - an advanced tool for data synchronization
+Copyright (C) 2015  Information Node Development Team (see AUTHORS.md)
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 2 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+
+import collections
+import concurrent.futures
+import multiprocessing
+import queue
+import threading
+
+class ImportPipeline(object):
+    """ Imports contents into an ItemChunkManager as a streaming pipeline:
+
+        1. a reader thread reads the file with readinto() into a fixed set
+           of reused buffers,
+        2. the calling thread cuts the data into chunks with the manager's
+           chunker,
+        3. a pool of worker threads compresses, encrypts and hashes the
+           chunks in parallel (zlib, lzma, bz2 and hashlib don't hold the
+           GIL while they work on large buffers),
+        4. the calling thread writes the finished chunks to the chunk store
+           in order, in batches of write_batch chunks.
+
+        Every stage hands over through a bounded queue: at most buffers
+        read buffers and max_in_flight chunks exist at a time, so importing
+        a file of any size takes constant memory while keeping the disk
+        and all workers busy.
+    """
+    def __init__(self, content, workers=None, read_size=(1024 * 1024),
+            buffers=4, max_in_flight=None, write_batch=16):
+        self.content = content
+        if workers == None:
+            try:
+                workers = min(8, multiprocessing.cpu_count())
+            except NotImplementedError:
+                workers = 1
+        self.workers = workers
+        self.read_size = max(read_size, 1)
+        self.buffers = max(buffers, 2)
+        if max_in_flight == None:
+            max_in_flight = max(4, workers * 2)
+        self.max_in_flight = max_in_flight
+        self.write_batch = max(write_batch, 1)
+        self.executor = None
+
+    def _process(self, data):
+        """ Worker stage: get (length, stored data, hash) of a chunk. """
+        encoded = self.content._encode_chunk(data)
+        chunk_hash = None
+        if self.content.chunk_store != None:
+            chunk_hash = self.content.chunk_store.chunk_hash(encoded)
+        return (len(data), encoded, chunk_hash)
+
+    def _submit(self, data):
+        if self.executor == None:
+            future = concurrent.futures.Future()
+            future.set_result(self._process(data))
+            return future
+        return self.executor.submit(self._process, data)
+
+    def _run(self, chunks):
+        """ Process the chunks from the given iterable and write them out.
+            Returns the amount of chunks.
+        """
+        in_flight = collections.deque()
+        finished = []
+        chunk_no = 0
+
+        def write_out():
+            entries = [(no,) + future.result() for (no, future) in finished]
+            del(finished[:])
+            self.content._set_stored_chunks(entries)
+
+        if self.workers > 0:
+            self.executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.workers)
+        try:
+            for data in chunks:
+                in_flight.append((chunk_no, self._submit(data)))
+                chunk_no += 1
+                # write out what is done, and wait if too much is queued:
+                while len(in_flight) > 0 and (in_flight[0][1].done() or \
+                        len(in_flight) > self.max_in_flight):
+                    finished.append(in_flight.popleft())
+                    if len(finished) >= self.write_batch:
+                        write_out()
+            while len(in_flight) > 0:
+                finished.append(in_flight.popleft())
+                if len(finished) >= self.write_batch:
+                    write_out()
+            write_out()
+        finally:
+            if self.executor != None:
+                for (no, future) in in_flight:
+                    future.cancel()
+                self.executor.shutdown(wait=True)
+                self.executor = None
+        return chunk_no
+
+    def import_bytes(self, data):
+        """ Import bytes-like data. Returns the amount of chunks. """
+        return self._run(self.content.chunker.split(data))
+
+    def import_file(self, f):
+        """ Import the contents of a binary file object from its current
+            position to the end. Returns the amount of chunks.
+        """
+        return self._run(self._file_chunks(f))
+
+    def _read_file(self, f, free_buffers, filled_buffers, stop):
+        """ Reader stage: fill free buffers and pass them on as
+            (buffer, amount), with an amount of 0 at the end of the file,
+            or an exception if reading failed.
+        """
+        try:
+            while not stop.is_set():
+                buf = free_buffers.get()
+                if buf == None:
+                    return
+                amount = f.readinto(buf)
+                filled_buffers.put((buf, amount or 0))
+                if not amount:
+                    return
+        except BaseException as e:
+            filled_buffers.put((None, e))
+
+    def _file_chunks(self, f):
+        """ Chunking stage: yield the chunks of the file as bytes. """
+        chunker = self.content.chunker
+        free_buffers = queue.Queue()
+        for i in range(self.buffers):
+            free_buffers.put(bytearray(self.read_size))
+        filled_buffers = queue.Queue()
+        stop = threading.Event()
+        reader = threading.Thread(target=self._read_file,
+            args=(f, free_buffers, filled_buffers, stop), daemon=True)
+        reader.start()
+        try:
+            pending = bytearray()
+            while True:
+                (buf, amount) = filled_buffers.get()
+                if buf == None:
+                    raise amount
+                final = (amount == 0)
+                if not final:
+                    pending += memoryview(buf)[:amount]
+                free_buffers.put(buf)
+                if not final and len(pending) < chunker.max_size:
+                    continue
+                start = 0
+                for cut in chunker.cut_points(pending, final=final):
+                    yield bytes(pending[start:cut])
+                    start = cut
+                del(pending[:start])
+                if final:
+                    return
+        finally:
+            stop.set()
+            free_buffers.put(None)
+            reader.join()
@@ -25,23 +25,37 @@ import os
 import struct
 import uuid
 
-from informationnode.daemon.storage import ItemChunkManager 
+from informationnode.daemon.storage.itemdata import ItemChunkManager
+from informationnode.daemon.storage.itemio import open_content
+from informationnode.helper import parse_isoformat
 
 class Item(object):
     """ This item structure is the base for all user data stored in an
         information node.
 
-        Each item maps to a folder in the node's storage directory. In there,
-        it has a separate subfolder for each content_version, where the actual
-        data, encryption details etc are stored.
+        Each content_version of an item has a record with its metadata and
+        chunk list, stored by the node's StorageDriver - either in a folder
+        per item with a subfolder per content_version, or appended to large
+        packfile segments. The actual data is kept in the node's ChunkStore,
+        where content versions and items share the chunks they have in
+        common.
 
         Use a QueryItems instance to manage those items.
     """
     CHUNK_SIZE=(1024 * 100)
     def __init__(self, suggested_identifier, \
-            encryption=None, content_version=1):
+            encryption=None, content_version=1, chunk_store=None,
+            identifier=None, chunk_cache=None, metadata_index=None,
+            chunker=None, compressor=None):
+        """ Create a new item if suggested_identifier is given, otherwise
+            load the content version of the item with the given identifier
+            from the chunk_store's storage.
+        """
+        self.item_chunk_manager = None
         self.mime_type = "text/plain"
         self.classification = "file"
+        self.tags = set()
+        self.metadata_index = metadata_index
         self.encryption = encryption
         self.identifier = None
         self.content_version_id = content_version
@@ -55,27 +69,83 @@ class Item(object):
         if suggested_identifier != None:  # this is a new item:
             # this should be pretty free of collisions, given the
             # suggested identifier:
-            self.identifier = uuid.uuid4() + "-" +\
-                hashlib.sha224(suggested_identifier).hexdigest()
+            self.identifier = str(uuid.uuid4()) + "-" +\
+                hashlib.sha224(suggested_identifier.encode("utf-8")).\
+                hexdigest()
 
             # new item that isn't finalized:
             self.contents_finalized = False
         else: # initialize item from disk
-            pass
+            self.identifier = identifier
 
         self.item_chunk_manager = ItemChunkManager(\
             self.CHUNK_SIZE, self.identifier, self.encryption,
-            content_version=self.content_version_id)
+            content_version=self.content_version_id,
+            chunk_store=chunk_store, chunk_cache=chunk_cache,
+            chunker=chunker, compressor=compressor)
+        self.item_chunk_manager.mime_type = self.mime_type
         self.item_chunk_manager.contents_finalized = self.contents_finalized 
+        if suggested_identifier == None and identifier != None:
+            self._refresh_contents()
+
+    @property
+    def mime_type(self):
+        return self._mime_type
+
+    @mime_type.setter
+    def mime_type(self, value):
+        # the chunk manager uses it to decide whether to compress:
+        self._mime_type = value
+        if self.item_chunk_manager != None:
+            self.item_chunk_manager.mime_type = value
 
     def save(self):
         if self.raw_chunk_data == None or self.identifier == None:
             raise RuntimeError("this is not a proper item with "+\
                 "content - did you use Item.create_from_content?")
-        raise RuntimeError("needs storage driver implementation")
+        self.modification_time = datetime.datetime.now()
+        record = self.item_chunk_manager.save(info={
+            "mime_type" : self.mime_type,
+            "classification" : self.classification,
+            "tags" : sorted(self.tags),
+            "creation_time" : self.creation_time.isoformat(),
+            "modification_time" : self.modification_time.isoformat()})
+        self.contents_finalized = True
+        if self.metadata_index != None:
+            self.metadata_index.update_from_record(self.identifier,
+                self.content_version_id, record)
+
+    def new_content_version(self):
+        """ Get a new, writable Item for the next content version of this
+            one. It starts with the same contents and metadata, and shares
+            all chunks with this version until they are changed.
+        """
+        if not self.contents_finalized:
+            raise RuntimeError("item isn't saved yet. save it before "+\
+                "starting a new content version")
+        item = Item(None, encryption=self.encryption,
+            content_version=self.content_version_id + 1,
+            metadata_index=self.metadata_index)
+        item.identifier = self.identifier
+        item.item_chunk_manager = \
+            self.item_chunk_manager.new_content_version()
+        item.mime_type = self.mime_type
+        item.classification = self.classification
+        item.tags = set(self.tags)
+        item.creation_time = self.creation_time
+        item.contents_finalized = False
+        return item
 
     def _refresh_contents(self):
-        raise RuntimeError("needs storage driver implementation")
+        record = self.item_chunk_manager._refresh_contents()
+        self.mime_type = record.get("mime_type", self.mime_type)
+        self.classification = record.get("classification",
+            self.classification)
+        self.tags = set(record.get("tags", []))
+        for name in ["creation_time", "modification_time"]:
+            if name in record:
+                setattr(self, name, parse_isoformat(record[name]))
+        self.contents_finalized = True
 
     def unlock_encryption_with_password(self, password):
         """ Required for password-protected items to read or modify them.
@@ -99,9 +169,16 @@ class Item(object):
         """
         self.encryption.lock()
 
-    def open(self):
-        """ Return a file-like object to read and write on this item.
+    def close(self):
+        """ Done with this item: its content version may be pruned from
+            now on.
+        """
+        self.item_chunk_manager.close()
+
+    def open(self, mode="rb"):
+        """ Return a file-like object to read and write on this item. It is
+            buffered and seekable, see itemio.open_content for the modes.
         """
-        return
+        return open_content(self.item_chunk_manager, mode)
 
 
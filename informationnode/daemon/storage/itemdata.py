@@ -23,71 +23,320 @@ import hashlib
 import json
 import os
 import struct
+import threading
 import uuid
 
 from informationnode.daemon.encryption.item_encryption import \
     PasswordEncryption, TargetNodeEncryption
+from informationnode.daemon.storage.chunking import FixedSizeChunker, \
+    chunker_from_description
+from informationnode.daemon.storage.compression import decode_chunk
+from informationnode.daemon.storage.importpipeline import ImportPipeline
+
+def _readonly_view(data):
+    """ Get a read-only memoryview of the given bytes-like data. Writable
+        data is only copied where memoryview.toreadonly() is missing
+        (before Python 3.8).
+    """
+    view = memoryview(data)
+    if view.readonly:
+        return view
+    if hasattr(view, "toreadonly"):
+        return view.toreadonly()
+    return memoryview(bytes(view))
 
 class ItemChunk(object):
-    def __init__(self, item, no):
+    """ One chunk of an item's contents. Its data is either held in memory,
+        or in the node's ChunkStore under the chunk_hash - or both.
+
+        A chunk with a chunk_hash holds one reference to that chunk in the
+        store on behalf of its content version.
+
+        If the item has a chunk_cache, the chunk registers with it whenever
+        its data is used, and the cache decides when to spill it to disk.
+    """
+    # large items have thousands of chunks, so skip the per-instance dict:
+    __slots__ = ("item", "no", "chunk_hash", "data", "on_disk")
+
+    def __init__(self, item, no, chunk_hash=None):
         self.item = item
         self.no = no
-        self.on_disk = False
+        self.chunk_hash = chunk_hash
+        self.data = None
+        self.on_disk = (chunk_hash != None)
 
     def transfer_to_disk(self):
-        """ Transfer the chunk data from memory to disk.
+        """ Transfer the chunk data from memory to disk. Only data that isn't
+            in the chunk store yet is written.
         """
         if self.on_disk:
             return
+        if self.item.chunk_store == None:
+            # nowhere to put it, keep it in memory.
+            return
+        if self.chunk_hash == None:
+            self.chunk_hash = self.item.chunk_store.put(self.data)
         self.on_disk = True
-        del(self.data)
+        self.data = None
 
     def transfer_from_disk(self):
         """ Load chunk data from disk.
         """
         if not self.on_disk:
             return
+        self.data = self.item.chunk_store.get(self.chunk_hash)
         self.on_disk = False
 
+    def _release(self):
+        if self.chunk_hash != None:
+            self.item.chunk_store.release([self.chunk_hash])
+            self.chunk_hash = None
+
     def delete_data(self):
         """ Delete this chunk's data, including from disk if any.
         """
-        raise RuntimeError("not implemented yet")
+        self._release()
+        self.on_disk = False
+        self.data = None
+        if self.item.chunk_cache != None:
+            self.item.chunk_cache.remove(self)
 
     def size(self):
         """ Size of the data contained in thus chunk, or None if not currently
             known.
         """
-        return None
+        if self.data == None:
+            return None
+        return len(self.data)
 
     def set_data(self, value):
-        if self.on_disk:
-            self.on_disk = False
+        if self.chunk_hash != None and \
+                self.item.chunk_store.chunk_hash(value) == self.chunk_hash:
+            # unchanged.
+            return
+        self._release()
+        self.on_disk = False
         self.data = value
+        if self.item.chunk_cache != None:
+            self.item.chunk_cache.touch(self)
 
     def get_data(self):
-        return self.data
+        was_in_memory = not self.on_disk
+        self.transfer_from_disk()
+        data = self.data
+        if self.item.chunk_cache != None:
+            self.item.chunk_cache.touch(self, was_in_memory)
+        return data
+
+    def get_view(self):
+        """ Get the data as a read-only memoryview. If the chunk is on disk,
+            it isn't loaded into memory: the view maps the stored data
+            instead, so no copy is made.
+        """
+        if self.on_disk:
+            return self.item.chunk_store.get_view(self.chunk_hash)
+        data = self.data
+        if self.item.chunk_cache != None:
+            self.item.chunk_cache.touch(self, True)
+        return _readonly_view(data)
+
+# fields of a content version record which describe its chunks, as opposed
+# to the item's metadata:
+CHUNK_RECORD_FIELDS = ["chunk_size", "chunking", "compressed_chunks",
+    "chunk_lengths", "chunk_hashes", "encrypted"]
 
 class ItemChunkManager(object):
+    """ Manages the chunks of one content version of an item.
+
+        If a chunk_store is given, the chunks are kept in it and shared with
+        all other items and content versions that have the same chunk data.
+        chunk_hashes are the hashes of an existing content version's chunks
+        in order, which are loaded from the store on demand.
+
+        If a chunk_cache is given, it limits how many of the chunks stay in
+        memory. Chunk access needs to hold the manager's lock, which the
+        cache uses to spill chunks safely from other threads.
+
+        The chunker decides how imported contents are split into chunks
+        (see chunking.py), by default into chunks of chunk_size. With a
+        content-defined chunker, chunks vary in size up to its max_size,
+        which is then used as chunk_size.
+
+        If a compressor is given, the chunks of new items are compressed by
+        it before they are encrypted (see compression.py), and mime_type
+        is used as a hint whether that is worth it. Content versions keep
+        whether their chunks are compressed in their record.
+
+        While a manager has a saved content version loaded, it holds a lease
+        on it in the chunk store, so pruning the version doesn't delete its
+        chunks under a reader. close() ends the lease early.
+    """
     def __init__(self, chunk_size, identifier, \
-            encryption=None, content_version=1):
+            encryption=None, content_version=1, chunk_store=None,
+            chunk_hashes=None, chunk_cache=None, chunker=None,
+            compressor=None, compressed_chunks=None):
+        if chunker == None:
+            chunker = FixedSizeChunker(chunk_size)
+        self.chunker = chunker
+        self.chunk_size = chunker.max_size
         self.encryption = encryption
-        self.identifier = None
+        self.identifier = identifier
         self.content_version_id = content_version
         self.contents_finalized = False
+        self.chunk_store = chunk_store
+        self.chunk_cache = chunk_cache
+        self.compressor = compressor
+        if compressed_chunks == None:
+            compressed_chunks = (compressor != None)
+        self.compressed_chunks = compressed_chunks
+        self.mime_type = None
+        self.lease = None
+        if chunk_store == None:
+            # without a store, there is nowhere to spill chunks to:
+            self.chunk_cache = None
+        self.lock = threading.RLock()
         
         # actual data chunks:
         self.raw_chunk_data = dict()
         self.chunk_count = 0
-
-    def save(self):
+        # chunk no -> length of the original chunk data, where known:
+        self.chunk_lengths = dict()
+        # item metadata stored with the content version:
+        self.info = dict()
+        if chunk_hashes != None:
+            for (chunk_no, chunk_hash) in enumerate(chunk_hashes):
+                self.raw_chunk_data[chunk_no] = ItemChunk(self, chunk_no,
+                    chunk_hash)
+            self.chunk_count = len(chunk_hashes)
+
+    def new_content_version(self):
+        """ Start a new, writable content version based on this one. It
+            starts as a copy of this version's chunk list and shares all
+            chunks with it, so content_set_chunk only replaces the entries
+            that are touched and saving it only writes those chunks. The
+            item metadata of this version is kept unless changed on save.
+        """
+        self.store_chunks()
+        chunk_hashes = self.chunk_hashes()
+        if self.chunk_store != None:
+            self.chunk_store.add_ref(chunk_hashes)
+            self.chunk_store.begin_version(self.identifier,
+                self.content_version_id + 1)
+        manager = ItemChunkManager(self.chunk_size, self.identifier,
+            self.encryption, self.content_version_id + 1,
+            chunk_store=self.chunk_store, chunk_hashes=chunk_hashes,
+            chunk_cache=self.chunk_cache, chunker=self.chunker,
+            compressor=self.compressor,
+            compressed_chunks=self.compressed_chunks)
+        manager.mime_type = self.mime_type
+        manager.chunk_lengths = dict(self.chunk_lengths)
+        manager.info = dict(self.info)
+        return manager
+
+    def store_chunks(self):
+        """ Write all chunks that aren't in the chunk store yet to it. """
+        if self.chunk_store == None:
+            raise RuntimeError("no chunk store to save contents to")
+        with self.lock:
+            new_chunks = [chunk for chunk in self.raw_chunk_data.values() \
+                if chunk.chunk_hash == None]
+            hashes = self.chunk_store.put_many([chunk.data for chunk in \
+                new_chunks])
+            for (chunk, chunk_hash) in zip(new_chunks, hashes):
+                chunk.chunk_hash = chunk_hash
+
+    def chunk_hashes(self):
+        """ The hashes of all chunks in order, as stored by store_chunks().
+        """
+        for chunk_no in range(self.chunk_count):
+            if not chunk_no in self.raw_chunk_data or \
+                    self.raw_chunk_data[chunk_no].chunk_hash == None:
+                raise RuntimeError("chunk " + str(chunk_no) + " isn't " +\
+                    "stored")
+        return [self.raw_chunk_data[chunk_no].chunk_hash \
+            for chunk_no in range(self.chunk_count)]
+
+    def save(self, info=None):
+        """ Store the chunks and the record of this content version, which
+            also contains the given JSON serializable info if any, on top of
+            the info of the version this one is based on. Afterwards the
+            contents are finalized.
+
+            Returns the record.
+        """
         if self.raw_chunk_data == None or self.identifier == None:
             raise RuntimeError("this is not a proper item with "+\
                 "content - did you use Item.create_from_content?")
-        raise RuntimeError("needs storage driver implementation")
+        self.store_chunks()
+        record = dict(self.info)
+        record["modification_time"] = datetime.datetime.now().isoformat()
+        if info != None:
+            record.update(info)
+        record["chunk_size"] = self.chunk_size
+        record["chunking"] = self.chunker.describe()
+        record["compressed_chunks"] = self.compressed_chunks
+        record["chunk_lengths"] = self.content_chunk_lengths()
+        record["chunk_hashes"] = self.chunk_hashes()
+        record["encrypted"] = (self.encryption != None)
+        self.chunk_store.commit_version(self.identifier,
+            self.content_version_id, record)
+        self._take_lease()
+        self.contents_finalized = True
+        self.info = dict([(key, value) for (key, value) in record.items() \
+            if not key in CHUNK_RECORD_FIELDS])
+        return record
 
     def _refresh_contents(self):
-        raise RuntimeError("needs storage driver implementation")
+        """ Load the chunk list of this content version from storage, and
+            return its record.
+        """
+        if self.chunk_store == None:
+            raise RuntimeError("no chunk store to load contents from")
+        had_lease = (self.lease != None)
+        # leased first, so the version can't be pruned in between:
+        self._take_lease()
+        try:
+            record = self.chunk_store.driver.read_version(self.identifier,
+                self.content_version_id)
+        except ValueError:
+            if not had_lease:
+                self.close()
+            raise
+        with self.lock:
+            if self.chunk_cache != None:
+                for chunk in self.raw_chunk_data.values():
+                    self.chunk_cache.remove(chunk)
+            if "chunking" in record:
+                self.chunker = chunker_from_description(record["chunking"])
+            else:
+                self.chunker = FixedSizeChunker(record["chunk_size"])
+            self.chunk_size = record["chunk_size"]
+            self.compressed_chunks = record.get("compressed_chunks", False)
+            self.mime_type = record.get("mime_type", None)
+            self.info = dict([(key, value) for (key, value) in \
+                record.items() if not key in CHUNK_RECORD_FIELDS])
+            self.chunk_lengths = dict(enumerate(record.get("chunk_lengths",
+                [])))
+            self.raw_chunk_data = dict()
+            for (chunk_no, chunk_hash) in enumerate(record["chunk_hashes"]):
+                self.raw_chunk_data[chunk_no] = ItemChunk(self, chunk_no,
+                    chunk_hash)
+            self.chunk_count = len(record["chunk_hashes"])
+            self.contents_finalized = True
+        return record
+
+    def _take_lease(self):
+        if self.lease == None and self.chunk_store != None:
+            self.lease = self.chunk_store.lease_version(self.identifier,
+                self.content_version_id)
+
+    def close(self):
+        """ Stop reading this content version, so its chunks can be
+            deleted once it is pruned.
+        """
+        if self.lease != None:
+            self.lease.release()
+            self.lease = None
 
     def unlock_encryption_with_password(self, password):
         """ Required for password-protected items to read or modify them.
@@ -114,61 +363,196 @@ class ItemChunkManager(object):
     def content_chunk_count(self):
         return self.chunk_count
 
+    def content_chunk_lengths(self):
+        """ Get the length of each chunk's original data in order, e.g. to
+            find the chunk at a given offset. Lengths which aren't known
+            from the record yet are found by reading the chunks.
+        """
+        lengths = []
+        for chunk_no in range(self.chunk_count):
+            with self.lock:
+                length = self.chunk_lengths.get(chunk_no, None)
+            if length == None:
+                length = len(self.content_get_chunk(chunk_no))
+                with self.lock:
+                    self.chunk_lengths[chunk_no] = length
+            lengths.append(length)
+        return lengths
+
     def content_get_chunk(self, chunk_no):
         if chunk_no >= self.chunk_count or chunk_no < 0:
             raise ValueError('no chunk with id ' + str(chunk_no))
 
-        # load up chunk if not there:
-        if not chunk_no in self.raw_chunk_data:
-            self.raw_chunk_data = ItemChunk(self, chunk_no)
+        with self.lock:
+            # load up chunk if not there:
+            if not chunk_no in self.raw_chunk_data:
+                self.raw_chunk_data[chunk_no] = ItemChunk(self, chunk_no)
 
-        # get data:
-        data = self.raw_chunk_data[chunk_no].get_data()
+            # get data:
+            data = self.raw_chunk_data[chunk_no].get_data()
 
         # decrypt if necessary:
         if self.encryption != None:
             data = self.encryption.decrypt(data)
+        if self.compressed_chunks:
+            data = decode_chunk(data)
         return data
 
-    def content_set_chunk(self, chunk_no, data):
-        # only allow write access if content hasn't been finalized:
-        if self.contents_finalized:
-            raise RuntimeError('item has been finalized. open a new one '+\
-                'with a newer content version instead.')
+    def content_get_chunk_view(self, chunk_no):
+        """ Like content_get_chunk, but returns a read-only memoryview which
+            avoids copying the data where possible, e.g. for sending it.
+        """
+        if chunk_no >= self.chunk_count or chunk_no < 0:
+            raise ValueError('no chunk with id ' + str(chunk_no))
+        with self.lock:
+            if not chunk_no in self.raw_chunk_data:
+                self.raw_chunk_data[chunk_no] = ItemChunk(self, chunk_no)
+            view = self.raw_chunk_data[chunk_no].get_view()
+
+        # decryption needs to produce new data anyway:
+        if self.encryption != None:
+            view = memoryview(self.encryption.decrypt(view))
+        if self.compressed_chunks:
+            view = _readonly_view(decode_chunk(view))
+        return view
+
+    def _encode_chunk(self, data):
+        """ Get the form of the chunk data which is stored. This doesn't
+            touch the manager's state, so it may run in other threads.
+        """
+        # compress before encrypting, since encrypted data doesn't compress:
+        if self.compressed_chunks:
+            if self.compressor != None:
+                data = self.compressor.encode(data, self.mime_type)
+            else:
+                data = bytes([0]) + bytes(data)
 
         # deal with encryption
         if self.encryption != None:
             #
             pass
+        return bytes(data)
 
-        # increase total chunk count if necessary:
-        self.chunk_count = max(self.chunk_count, chunk_no - 1)
-        if chunk_no in self.raw_chunk_data:
-            self.raw_chunk_data[chunk_no].set_data(data)
+    def _set_stored_chunks(self, entries):
+        """ Set chunks which were encoded with _encode_chunk already, given
+            as a list of (chunk_no, length, encoded data, chunk_hash). With a
+            chunk store they are written to it right away.
+        """
+        if self.contents_finalized:
+            raise RuntimeError('item has been finalized. open a new one '+\
+                'with a newer content version instead.')
+        if len(entries) == 0:
             return
+        if self.chunk_store != None:
+            self.chunk_store.put_many([entry[2] for entry in entries],
+                hashes=[entry[3] for entry in entries])
+        with self.lock:
+            for (chunk_no, length, data, chunk_hash) in entries:
+                self.chunk_count = max(self.chunk_count, chunk_no + 1)
+                self.chunk_lengths[chunk_no] = length
+                if chunk_no in self.raw_chunk_data:
+                    # after the new reference was added, so a chunk that
+                    # stays the same isn't deleted in between:
+                    self.raw_chunk_data[chunk_no].delete_data()
+                if self.chunk_store != None:
+                    chunk = ItemChunk(self, chunk_no, chunk_hash=chunk_hash)
+                    self.raw_chunk_data[chunk_no] = chunk
+                else:
+                    chunk = ItemChunk(self, chunk_no)
+                    self.raw_chunk_data[chunk_no] = chunk
+                    chunk.set_data(data)
 
-        # create new chunk:
-        chunk = ItemChunk(self, chunk_no)
-        chunk.set_data(value)
-        self.raw_chunk_data[chunk_no] = chunk
+    def content_set_chunk(self, chunk_no, data):
+        # only allow write access if content hasn't been finalized:
+        if self.contents_finalized:
+            raise RuntimeError('item has been finalized. open a new one '+\
+                'with a newer content version instead.')
+
+        length = len(data)
+        data = self._encode_chunk(data)
+
+        with self.lock:
+            if self.contents_finalized:
+                # discarded meanwhile.
+                raise RuntimeError("item content version was discarded")
+            # increase total chunk count if necessary:
+            self.chunk_count = max(self.chunk_count, chunk_no + 1)
+            self.chunk_lengths[chunk_no] = length
+            if chunk_no in self.raw_chunk_data:
+                self.raw_chunk_data[chunk_no].set_data(data)
+                return
+
+            # create new chunk:
+            chunk = ItemChunk(self, chunk_no)
+            self.raw_chunk_data[chunk_no] = chunk
+            chunk.set_data(data)
+
+    def discard(self):
+        """ Drop this unsaved content version, e.g. after an aborted
+            upload: the references its chunks hold in the chunk store are
+            released, and it can't be written to or saved anymore.
+        """
+        if self.contents_finalized:
+            raise RuntimeError("can't discard a saved content version")
+        with self.lock:
+            chunk_hashes = []
+            for chunk in self.raw_chunk_data.values():
+                if chunk.chunk_hash != None:
+                    chunk_hashes.append(chunk.chunk_hash)
+                    chunk.chunk_hash = None
+                if self.chunk_cache != None:
+                    self.chunk_cache.remove(chunk)
+            self.raw_chunk_data = dict()
+            self.chunk_lengths = dict()
+            self.chunk_count = 0
+            self.contents_finalized = True
+        if len(chunk_hashes) > 0:
+            self.chunk_store.release(chunk_hashes)
 
     def crop_chunks(self, chunk_amount):
         # only allow write access if content hasn't been finalized:
         if self.contents_finalized:
             raise RuntimeError('item has been finalized. open a new one '+\
                 'with a newer content version instead.')
-
-    def content_set_from_file(self, file_path):
+        with self.lock:
+            for chunk_no in list(self.raw_chunk_data.keys()):
+                if chunk_no >= chunk_amount:
+                    self.raw_chunk_data[chunk_no].delete_data()
+                    del(self.raw_chunk_data[chunk_no])
+            for chunk_no in list(self.chunk_lengths.keys()):
+                if chunk_no >= chunk_amount:
+                    del(self.chunk_lengths[chunk_no])
+            self.chunk_count = min(self.chunk_count, chunk_amount)
+
+    def content_set_from_file(self, file_path, workers=None):
+        """ Replace the contents with those of the given file. Chunks are
+            compressed, encrypted and hashed by worker threads (None for
+            one per CPU core, up to 8) and written to the chunk store as they
+            are done, in constant memory - see importpipeline.py.
+        """
         # only allow write access if content hasn't been finalized:
         if self.contents_finalized:
             raise RuntimeError('item has been finalized. open a new one '+\
                 'with a newer content version instead.')
-
-    def content_set_from_bytes(self, bytes):
+        with open(file_path, "rb", buffering=0) as f:
+            chunk_count = ImportPipeline(self, workers=workers).\
+                import_file(f)
+        self.crop_chunks(chunk_count)
+
+    def content_set_from_bytes(self, bytes, workers=None):
+        """ Replace the contents with the given bytes-like data, like
+            content_set_from_file.
+        """
         # only allow write access if content hasn't been finalized:
         if self.contents_finalized:
             raise RuntimeError('item has been finalized. open a new one '+\
                 'with a newer content version instead.') 
+        if len(bytes) <= self.chunker.max_size:
+            # a single chunk isn't worth starting threads for:
+            workers = 0
+        chunk_count = ImportPipeline(self, workers=workers).\
+            import_bytes(bytes)
+        self.crop_chunks(chunk_count)
 
 
 
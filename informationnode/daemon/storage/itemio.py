@@ -0,0 +1,290 @@
+'''
+information-node - an advanced tool for data synchronization
+Copyright (C) 2015  Information Node Development Team (see AUTHORS.md)
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 2 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+
+import bisect
+import collections
+import concurrent.futures
+import io
+
+class ItemRawIO(io.RawIOBase):
+    """ Unbuffered file object over the chunks of an ItemChunkManager (or
+        anything with the same content_* interface). Use open_content() to
+        get a buffered one.
+
+        A table of chunk offsets makes seeking to any position O(1) (plus
+        a binary search to find the chunk). When chunks are read in order,
+        the next readahead chunks are loaded by a background thread.
+
+        Written data is collected per chunk, and a chunk is only passed to
+        the content once it is written up to its end, or once more than
+        write_behind chunks are pending, or on flush() - so sequential
+        writes store each chunk exactly once.
+    """
+    def __init__(self, content, writable=False, readahead=4,
+            write_behind=4):
+        super().__init__()
+        self.content = content
+        self._writable = writable
+        self.readahead = readahead
+        self.write_behind = max(1, write_behind)
+        self.chunk_size = content.chunk_size
+
+        lengths = content.content_chunk_lengths()
+        self.offsets = [0]
+        for length in lengths:
+            self.offsets.append(self.offsets[-1] + length)
+        self.pos = 0
+
+        # chunk no -> bytearray of chunk data not passed to the content yet:
+        self.pending = collections.OrderedDict()
+        # chunk no -> Future of the chunk data being read ahead:
+        self.prefetched = dict()
+        self.executor = None
+        self.last_read_chunk = None
+
+    def readable(self):
+        return True
+
+    def writable(self):
+        return self._writable
+
+    def seekable(self):
+        return True
+
+    def _size(self):
+        return self.offsets[-1]
+
+    def _chunk_count(self):
+        return len(self.offsets) - 1
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            pos = offset
+        elif whence == io.SEEK_CUR:
+            pos = self.pos + offset
+        elif whence == io.SEEK_END:
+            pos = self._size() + offset
+        else:
+            raise ValueError("invalid whence " + str(whence))
+        if pos < 0:
+            raise ValueError("negative seek position " + str(pos))
+        self.pos = pos
+        return pos
+
+    def tell(self):
+        return self.pos
+
+    def _chunk_at(self, pos):
+        return bisect.bisect_right(self.offsets, pos) - 1
+
+    def _load_chunk(self, chunk_no):
+        if hasattr(self.content, "content_get_chunk_view"):
+            return self.content.content_get_chunk_view(chunk_no)
+        return memoryview(self.content.content_get_chunk(chunk_no))
+
+    def _read_ahead(self, chunk_no):
+        """ Drop read ahead chunks which weren't used, and start loading the
+            ones after chunk_no.
+        """
+        for other_no in list(self.prefetched.keys()):
+            if other_no <= chunk_no or other_no > chunk_no + self.readahead:
+                self.prefetched.pop(other_no).cancel()
+        if self.readahead <= 0:
+            return
+        if self.executor == None:
+            self.executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=1)
+        for other_no in range(chunk_no + 1, min(chunk_no + 1 +\
+                self.readahead, self._chunk_count())):
+            if not other_no in self.prefetched and \
+                    not other_no in self.pending:
+                self.prefetched[other_no] = self.executor.submit(
+                    self._load_chunk, other_no)
+
+    def _get_chunk(self, chunk_no):
+        if chunk_no in self.pending:
+            return memoryview(self.pending[chunk_no])
+        future = self.prefetched.pop(chunk_no, None)
+        if future != None:
+            data = future.result()
+        else:
+            data = self._load_chunk(chunk_no)
+        if self.last_read_chunk != None and \
+                chunk_no == self.last_read_chunk + 1:
+            self._read_ahead(chunk_no)
+        self.last_read_chunk = chunk_no
+        return data
+
+    def readinto(self, buf):
+        if self.closed:
+            raise ValueError("I/O operation on closed file")
+        if self.pos >= self._size():
+            return 0
+        chunk_no = self._chunk_at(self.pos)
+        data = self._get_chunk(chunk_no)
+        start = self.pos - self.offsets[chunk_no]
+        target = memoryview(buf).cast("B")
+        amount = min(len(target), len(data) - start)
+        target[:amount] = data[start:start + amount]
+        self.pos += amount
+        return amount
+
+    def _pending_chunk(self, chunk_no, new):
+        if chunk_no in self.pending:
+            self.pending.move_to_end(chunk_no)
+            return self.pending[chunk_no]
+        future = self.prefetched.pop(chunk_no, None)
+        if future != None:
+            future.cancel()
+        if not new:
+            chunk = bytearray(self._load_chunk(chunk_no))
+        else:
+            chunk = bytearray()
+        self.pending[chunk_no] = chunk
+        return chunk
+
+    def _store_chunk(self, chunk_no):
+        self.content.content_set_chunk(chunk_no,
+            bytes(self.pending.pop(chunk_no)))
+
+    def _write_some(self, data):
+        """ Write as much of data as fits into the chunk at the current
+            position. Returns the amount of bytes written.
+        """
+        size = self._size()
+        new = False
+        if self.pos < size:
+            chunk_no = self._chunk_at(self.pos)
+        else:
+            # append to the last chunk if it isn't full, or start a new one:
+            chunk_no = self._chunk_count() - 1
+            if chunk_no < 0 or self.offsets[-1] - self.offsets[-2] >= \
+                    self.chunk_size:
+                chunk_no = self._chunk_count()
+                self.offsets.append(size)
+                new = True
+        chunk = self._pending_chunk(chunk_no, new)
+        start = self.pos - self.offsets[chunk_no]
+        is_last = (chunk_no == self._chunk_count() - 1)
+        if is_last:
+            # the last chunk may grow up to the chunk size:
+            end = max(len(chunk), self.chunk_size)
+        else:
+            end = len(chunk)
+        amount = min(len(data), end - start)
+        chunk[start:start + amount] = data[:amount]
+        if is_last:
+            self.offsets[-1] = self.offsets[chunk_no] + len(chunk)
+        self.pos += amount
+
+        if start + amount >= end:
+            # the chunk is complete:
+            self._store_chunk(chunk_no)
+        while len(self.pending) > self.write_behind:
+            self._store_chunk(next(iter(self.pending)))
+        return amount
+
+    def write(self, buf):
+        if self.closed:
+            raise ValueError("I/O operation on closed file")
+        if not self._writable:
+            raise io.UnsupportedOperation("not writable")
+        data = memoryview(buf).cast("B")
+        if self.pos > self._size():
+            # writing past the end fills the gap with zeros:
+            target = self.pos
+            self.pos = self._size()
+            while self.pos < target:
+                self._write_some(memoryview(bytes(min(target - self.pos,
+                    self.chunk_size))))
+        written = 0
+        while written < len(data):
+            written += self._write_some(data[written:])
+        return written
+
+    def flush(self):
+        if self.closed:
+            return
+        for chunk_no in sorted(self.pending.keys()):
+            self._store_chunk(chunk_no)
+        super().flush()
+
+    def truncate(self, size=None):
+        if not self._writable:
+            raise io.UnsupportedOperation("not writable")
+        if size == None:
+            size = self.pos
+        self.flush()
+        if size >= self._size():
+            pos = self.pos
+            if size > self._size():
+                self.seek(size - 1)
+                self.write(b"\0")
+            self.seek(pos)
+            self.flush()
+            return size
+        chunk_no = self._chunk_at(size)
+        start = self.offsets[chunk_no]
+        data = None
+        if size > start:
+            data = bytes(self._load_chunk(chunk_no)[:size - start])
+            self.content.crop_chunks(chunk_no + 1)
+            self.content.content_set_chunk(chunk_no, data)
+            self.offsets = self.offsets[:chunk_no + 2]
+            self.offsets[-1] = size
+        else:
+            self.content.crop_chunks(chunk_no)
+            self.offsets = self.offsets[:chunk_no + 1]
+        for future in self.prefetched.values():
+            future.cancel()
+        self.prefetched = dict()
+        return size
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            self.flush()
+        finally:
+            if self.executor != None:
+                for future in self.prefetched.values():
+                    future.cancel()
+                self.executor.shutdown(wait=True)
+                self.executor = None
+            self.prefetched = dict()
+            super().close()
+
+def open_content(content, mode="rb", readahead=4, write_behind=4):
+    """ Get a buffered file object for the contents of an ItemChunkManager.
+        mode is "rb" for reading, "r+b" for reading and writing, or "wb"
+        or "w+b" for writing after truncating the contents.
+    """
+    if not mode in ["rb", "r+b", "wb", "w+b"]:
+        raise ValueError("unsupported mode " + str(mode))
+    writable = (mode != "rb")
+    if writable and getattr(content, "contents_finalized", False):
+        raise RuntimeError('item has been finalized. open a new one '+\
+            'with a newer content version instead.')
+    raw = ItemRawIO(content, writable=writable, readahead=readahead,
+        write_behind=write_behind)
+    if mode.startswith("w"):
+        raw.truncate(0)
+    if not writable:
+        return io.BufferedReader(raw, buffer_size=content.chunk_size)
+    return io.BufferedRandom(raw, buffer_size=content.chunk_size)
@@ -0,0 +1,190 @@
+'''
+information-node - an advanced tool for data synchronization
+Copyright (C) 2015  Information Node Development Team (see AUTHORS.md)
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 2 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+
+import json
+import logging
+import os
+import struct
+import threading
+import zlib
+
+class Journal(object):
+    """ Write-ahead journal for content version saves, in journal.log in the
+        storage folder.
+
+        A save appends the version record to the journal, and returns once
+        the journal and the chunks written by the driver are on disk. All
+        saves that arrive while one fsync is running are made durable
+        together by the next one (group commit), so many concurrent saves
+        cost a few fsyncs instead of one per save or even per chunk.
+        Afterwards, the record is written by the driver without syncing, as
+        the journal already has it.
+
+        The journal only exists while the node is running: close() syncs
+        the driver and removes it. If it is there on start, the node didn't
+        shut down cleanly and needs_recovery is True - see
+        ChunkStore.recover().
+    """
+    ENTRY_HEADER = struct.Struct("!II")
+
+    def __init__(self, storage_path, driver, max_size=(1024 * 1024 * 16)):
+        self.path = os.path.join(storage_path, "journal.log")
+        self.driver = driver
+        self.max_size = max_size
+        self.condition = threading.Condition()
+        self.needs_recovery = (os.path.exists(self.path) and \
+            os.path.getsize(self.path) > 0)
+        self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT | os.O_APPEND |\
+            getattr(os, "O_BINARY", 0), 0o600)
+        self.size = os.path.getsize(self.path)
+
+        self.written = 0
+        self.synced = 0
+        self.syncing = False
+        self.unapplied = 0
+        self.fsyncs = 0
+        self.commits = 0
+
+    def _encode(self, entry):
+        data = json.dumps(entry, separators=(",", ":")).encode("utf-8")
+        return self.ENTRY_HEADER.pack(len(data), zlib.crc32(data)) + data
+
+    def _append(self, entry):
+        data = self._encode(entry)
+        if os.write(self.fd, data) != len(data):
+            raise OSError("short write to journal")
+        self.size += len(data)
+        self.written += 1
+        return self.written
+
+    def read_entries(self):
+        """ Get all complete entries in the journal. Reading stops at a torn
+            or corrupt entry, which was never acknowledged as committed.
+        """
+        entries = []
+        with open(self.path, "rb") as f:
+            data = f.read()
+        pos = 0
+        while pos + self.ENTRY_HEADER.size <= len(data):
+            (length, crc) = self.ENTRY_HEADER.unpack_from(data, pos)
+            payload = data[pos + self.ENTRY_HEADER.size:pos +\
+                self.ENTRY_HEADER.size + length]
+            if len(payload) < length or zlib.crc32(payload) != crc:
+                logging.warning("journal: ignoring torn entry at " +\
+                    str(pos))
+                break
+            entries.append(json.loads(payload.decode("utf-8")))
+            pos += self.ENTRY_HEADER.size + length
+        return entries
+
+    def begin_version(self, item_id, content_version):
+        """ Note that a writable content version was started. This isn't
+            synced, it only helps to report versions that were never
+            finished after a crash.
+        """
+        with self.condition:
+            self._append({"type" : "begin", "item_id" : item_id,
+                "version" : content_version})
+
+    def commit_version(self, item_id, content_version, record):
+        """ Durably store the record of a content version, together with all
+            chunks written to the driver before.
+        """
+        self._write_durably({"type" : "commit", "item_id" : item_id,
+            "version" : content_version, "record" : record},
+            lambda: self.driver.write_version(item_id, content_version,
+            record))
+        with self.condition:
+            self.commits += 1
+
+    def delete_version(self, item_id, content_version):
+        """ Durably note that a content version is deleted, so a commit of
+            it which is still in the journal isn't replayed on recovery, and
+            delete its record.
+        """
+        self._write_durably({"type" : "delete", "item_id" : item_id,
+            "version" : content_version},
+            lambda: self.driver.delete_version(item_id, content_version))
+
+    def _write_durably(self, entry, apply):
+        """ Append the entry, wait until it is synced together with the
+            driver (sharing the fsync with concurrent callers), and then
+            call apply() to make the change in the storage itself.
+        """
+        with self.condition:
+            seq = self._append(entry)
+            self.unapplied += 1
+            try:
+                while self.synced < seq:
+                    if self.syncing:
+                        self.condition.wait()
+                        continue
+                    # no sync running: do one for everything written so far.
+                    self.syncing = True
+                    target = self.written
+                    self.condition.release()
+                    try:
+                        self.driver.sync()
+                        os.fsync(self.fd)
+                    finally:
+                        self.condition.acquire()
+                        self.syncing = False
+                        self.condition.notify_all()
+                    self.synced = max(self.synced, target)
+                    self.fsyncs += 1
+            except BaseException:
+                self.unapplied -= 1
+                raise
+        try:
+            apply()
+        finally:
+            with self.condition:
+                self.unapplied -= 1
+                if self.size > self.max_size and self.unapplied == 0 and \
+                        not self.syncing:
+                    self._checkpoint()
+
+    def _checkpoint(self):
+        """ Sync the driver, so all records in the journal are on disk in
+            the storage itself, and empty the journal. Needs the condition
+            to be held, and no commits in progress.
+        """
+        self.driver.sync()
+        os.ftruncate(self.fd, 0)
+        os.fsync(self.fd)
+        self.size = 0
+
+    def reset(self):
+        """ Empty the journal after a recovery. """
+        with self.condition:
+            self._checkpoint()
+            self.needs_recovery = False
+
+    def stats(self):
+        with self.condition:
+            return {"size" : self.size, "commits" : self.commits,
+                "fsyncs" : self.fsyncs}
+
+    def close(self):
+        with self.condition:
+            while self.syncing or self.unapplied > 0:
+                self.condition.wait()
+            self.driver.sync()
+            os.close(self.fd)
+            os.remove(self.path)
@@ -0,0 +1,334 @@
+'''
+information-node - an advanced tool for data synchronization
+Copyright (C) 2015  Information Node Development Team (see AUTHORS.md)
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 2 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+
+import logging
+import os
+import sqlite3
+import threading
+
+class MetadataIndex(object):
+    """ Persistent index over the metadata of the latest content version of
+        each item (mime_type, classification, creation_time,
+        modification_time and tags), kept in a SQLite database in the
+        storage folder.
+
+        Each indexed field has a B-tree index together with the item
+        identifier, so lookups, range scans and sorted pagination all take
+        logarithmic time. Pagination is done with keyset cursors rather than
+        offsets, so fetching page 1000 is as fast as fetching page 1.
+
+        Every item also gets an ordinal number which is never reused, for
+        compact per-item data like tag bitmaps. If a TagIndex is given, it is
+        kept up to date with the tags of all indexed items.
+
+        This class is thread-safe.
+    """
+    FIELDS = ["mime_type", "classification", "creation_time",
+        "modification_time"]
+    ORDER_FIELDS = FIELDS + ["item_id"]
+
+    # ordinal filters up to this size are done by SQLite (through a
+    # temporary table), larger ones while reading the results:
+    MAX_SQL_ORDINALS = 10000
+
+    def __init__(self, storage_path, tag_index=None):
+        path = os.path.join(storage_path, "metadata.db")
+        self.is_new = not os.path.exists(path)
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False,
+            isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS items (" +\
+            "ordinal INTEGER PRIMARY KEY AUTOINCREMENT, " +\
+            "item_id TEXT NOT NULL UNIQUE, " +\
+            "content_version INTEGER NOT NULL, " +\
+            "mime_type TEXT, classification TEXT, " +\
+            "creation_time TEXT, modification_time TEXT)")
+        for field in self.FIELDS:
+            self.db.execute("CREATE INDEX IF NOT EXISTS items_by_" + field +\
+                " ON items (" + field + ", item_id)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS item_tags (" +\
+            "tag TEXT NOT NULL, item_id TEXT NOT NULL, " +\
+            "PRIMARY KEY (tag, item_id))")
+        self.db.execute("CREATE INDEX IF NOT EXISTS item_tags_by_item " +\
+            "ON item_tags (item_id)")
+        self.db.execute("CREATE TEMP TABLE IF NOT EXISTS query_ordinals (" +\
+            "ordinal INTEGER PRIMARY KEY)")
+        self.tag_index = tag_index
+        if tag_index != None and tag_index.needs_rebuild and \
+                not self.is_new:
+            tag_index.rebuild(self.tagged_ordinals())
+
+    def update_from_record(self, item_id, content_version, record):
+        """ Index the given content version record (see
+            ItemChunkManager.save) as the item's current metadata.
+        """
+        with self.lock:
+            self.db.execute("BEGIN")
+            try:
+                change = self._update(item_id, content_version, record)
+                self.db.execute("COMMIT")
+            except BaseException:
+                self.db.execute("ROLLBACK")
+                raise
+            if self.tag_index != None:
+                self.tag_index.update_item(*change)
+
+    def _update(self, item_id, content_version, record):
+        """ Returns (ordinal, old tags, new tags). """
+        # missing fields are indexed as "", since NULL values would break
+        # the keyset pagination:
+        values = [record.get(field, None) or "" for field in self.FIELDS]
+        if self.db.execute("UPDATE items SET content_version = ?, " +\
+                ", ".join([field + " = ?" for field in self.FIELDS]) +\
+                " WHERE item_id = ?", [content_version] + values +\
+                [item_id]).rowcount == 0:
+            self.db.execute("INSERT INTO items (item_id, content_version, " +\
+                ", ".join(self.FIELDS) + ") VALUES (?, ?, " +\
+                ", ".join(["?"] * len(self.FIELDS)) + ")",
+                [item_id, content_version] + values)
+        ordinal = self.db.execute("SELECT ordinal FROM items WHERE " +\
+            "item_id = ?", (item_id,)).fetchone()[0]
+        old_tags = self._item_tags(item_id)
+        new_tags = record.get("tags", [])
+        self.db.execute("DELETE FROM item_tags WHERE item_id = ?",
+            (item_id,))
+        self.db.executemany("INSERT OR IGNORE INTO item_tags " +\
+            "(tag, item_id) VALUES (?, ?)",
+            [(tag, item_id) for tag in new_tags])
+        return (ordinal, old_tags, new_tags)
+
+    def _item_tags(self, item_id):
+        return [r[0] for r in self.db.execute("SELECT tag FROM " +\
+            "item_tags WHERE item_id = ? ORDER BY tag", (item_id,))]
+
+    def remove_item(self, item_id):
+        with self.lock:
+            self.db.execute("BEGIN")
+            try:
+                row = self.db.execute("SELECT ordinal FROM items WHERE " +\
+                    "item_id = ?", (item_id,)).fetchone()
+                old_tags = self._item_tags(item_id)
+                self.db.execute("DELETE FROM items WHERE item_id = ?",
+                    (item_id,))
+                self.db.execute("DELETE FROM item_tags WHERE item_id = ?",
+                    (item_id,))
+                self.db.execute("COMMIT")
+            except BaseException:
+                self.db.execute("ROLLBACK")
+                raise
+            if self.tag_index != None and row != None:
+                self.tag_index.update_item(row[0], old_tags, [])
+
+    def rebuild(self, driver):
+        """ Index all items stored by the given StorageDriver, e.g. for a node
+            that didn't have an index yet.
+        """
+        count = 0
+        with self.lock:
+            self.db.execute("BEGIN")
+            try:
+                for item_id in driver.list_items():
+                    versions = driver.list_versions(item_id)
+                    if len(versions) == 0:
+                        continue
+                    self._update(item_id, versions[-1], driver.read_version(
+                        item_id, versions[-1]))
+                    count += 1
+                self.db.execute("COMMIT")
+            except BaseException:
+                self.db.execute("ROLLBACK")
+                raise
+        logging.info("Rebuilt metadata index of " + str(count) + " items.")
+        if self.tag_index != None:
+            self.tag_index.rebuild(self.tagged_ordinals())
+
+    def tagged_ordinals(self):
+        """ Get a list of (tag, ordinal) for all tags of all items. """
+        with self.lock:
+            return self.db.execute("SELECT item_tags.tag, items.ordinal " +\
+                "FROM item_tags JOIN items ON items.item_id = " +\
+                "item_tags.item_id").fetchall()
+
+    def item_ordinal(self, item_id):
+        """ Get the ordinal of an item, or None if it isn't known. """
+        with self.lock:
+            row = self.db.execute("SELECT ordinal FROM items WHERE " +\
+                "item_id = ?", (item_id,)).fetchone()
+        if row == None:
+            return None
+        return row[0]
+
+    def _row_to_info(self, row):
+        info = {"ordinal" : row[0], "item_id" : row[1],
+            "content_version" : row[2]}
+        for (field, value) in zip(self.FIELDS, row[3:]):
+            info[field] = value
+        return info
+
+    def get(self, item_id):
+        """ Get the indexed metadata of an item, or None if it isn't known.
+        """
+        with self.lock:
+            row = self.db.execute("SELECT ordinal, item_id, " +\
+                "content_version, " + ", ".join(self.FIELDS) + " FROM " +\
+                "items WHERE item_id = ?", (item_id,)).fetchone()
+            if row == None:
+                return None
+            info = self._row_to_info(row)
+            info["tags"] = self._item_tags(item_id)
+        return info
+
+    def query(self, equals=None, ranges=None, tag=None,
+            order_by="item_id", descending=False, after=None, limit=100,
+            ordinals=None):
+        """ Find items by their metadata.
+
+            equals maps fields to the value they need to have, ranges maps
+            fields to (start, end) with start <= value < end, where either
+            may be None for an open end. If tag is given, only items with
+            that tag are found. If ordinals is given (a RoaringBitmap, e.g.
+            from the TagIndex), only items with one of these ordinals are
+            found.
+
+            Results are sorted by order_by (and the item identifier), and at
+            most limit are returned. To get the next page, pass the returned
+            cursor as after.
+
+            Returns (list of item metadata, cursor or None if there are no
+            more results).
+        """
+        equals = equals or dict()
+        ranges = ranges or dict()
+        if not order_by in self.ORDER_FIELDS:
+            raise ValueError("can't order by " + str(order_by))
+        for field in list(equals.keys()) + list(ranges.keys()):
+            if not field in self.FIELDS:
+                raise ValueError("unknown field " + str(field))
+        limit = max(1, min(int(limit), 10000))
+
+        conditions = []
+        params = []
+        for (field, value) in equals.items():
+            conditions.append("items." + field + " = ?")
+            params.append(value)
+        for (field, (start, end)) in ranges.items():
+            if start != None:
+                conditions.append("items." + field + " >= ?")
+                params.append(start)
+            if end != None:
+                conditions.append("items." + field + " < ?")
+                params.append(end)
+        join = ""
+        if tag != None:
+            join = " JOIN item_tags ON item_tags.item_id = items.item_id" +\
+                " AND item_tags.tag = ?"
+            params.insert(0, tag)
+        filter_rows = False
+        sql_ordinals = None
+        if ordinals != None:
+            if len(ordinals) <= self.MAX_SQL_ORDINALS:
+                conditions.append("items.ordinal IN (SELECT ordinal FROM " +\
+                    "query_ordinals)")
+                sql_ordinals = [(ordinal,) for ordinal in ordinals]
+            else:
+                filter_rows = True
+        direction = ("DESC" if descending else "ASC")
+        comparison = ("<" if descending else ">")
+        if after != None:
+            if order_by == "item_id":
+                conditions.append("items.item_id " + comparison + " ?")
+                params.append(after[-1])
+            else:
+                (condition, condition_params) = self._after_condition(
+                    "items." + order_by, descending, after)
+                conditions.append(condition)
+                params += condition_params
+        order = "items." + order_by + " " + direction
+        if order_by != "item_id":
+            order += ", items.item_id " + direction
+        sql = "SELECT items.ordinal, items.item_id, items.content_version, " +\
+            ", ".join(["items." + f for f in self.FIELDS]) +\
+            " FROM items" + join
+        if len(conditions) > 0:
+            sql += " WHERE " + " AND ".join(conditions)
+        sql += " ORDER BY " + order
+        if not filter_rows:
+            sql += " LIMIT ?"
+            params.append(limit + 1)
+
+        with self.lock:
+            if sql_ordinals != None:
+                self.db.execute("BEGIN")
+                try:
+                    self.db.execute("DELETE FROM query_ordinals")
+                    self.db.executemany("INSERT OR IGNORE INTO " +\
+                        "query_ordinals (ordinal) VALUES (?)", sql_ordinals)
+                    rows = self.db.execute(sql, params).fetchall()
+                    self.db.execute("DELETE FROM query_ordinals")
+                    self.db.execute("COMMIT")
+                except BaseException:
+                    self.db.execute("ROLLBACK")
+                    raise
+            elif not filter_rows:
+                rows = self.db.execute(sql, params).fetchall()
+            else:
+                rows = []
+                for row in self.db.execute(sql, params):
+                    if row[0] in ordinals:
+                        rows.append(row)
+                        if len(rows) > limit:
+                            break
+        results = [self._row_to_info(row) for row in rows[:limit]]
+        cursor = None
+        if len(rows) > limit:
+            last = results[-1]
+            cursor = [last[order_by], last["item_id"]]
+        return (results, cursor)
+
+    @staticmethod
+    def _after_condition(column, descending, after):
+        """ Get the SQL condition (and its parameters) for the rows after the
+            cursor [value, item identifier] when sorting by column and the
+            item identifier. This doesn't use row values, which older SQLite
+            versions lack. SQLite sorts NULL before all other values.
+        """
+        (value, item_id) = after
+        if value == None:
+            if descending:
+                return ("(" + column + " IS NULL AND items.item_id < ?)",
+                    [item_id])
+            return ("(" + column + " IS NOT NULL OR items.item_id > ?)",
+                [item_id])
+        if descending:
+            # the first part lets SQLite use the index for the range:
+            return ("(" + column + " <= ? OR " + column + " IS NULL) AND (" +\
+                column + " < ? OR " + column + " IS NULL OR items.item_id " +\
+                "< ?)", [value, value, item_id])
+        return (column + " >= ? AND (" + column + " > ? OR " +\
+            "items.item_id > ?)", [value, value, item_id])
+
+    def item_count(self):
+        with self.lock:
+            return self.db.execute("SELECT COUNT(*) FROM items").fetchone()[0]
+
+    def close(self):
+        with self.lock:
+            self.db.close()
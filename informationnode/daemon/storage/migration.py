@@ -0,0 +1,110 @@
+'''
+information-node - an advanced tool for data synchronization
+Copyright (C) 2015  Information Node Development Team (see AUTHORS.md)
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 2 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+
+import logging
+import threading
+
+from informationnode.daemon.apiserver import make_response
+
+class StorageMigration(object):
+    """ Moves the items of a node to the current on-disk layout of its
+        storage driver (see StorageDriver.migrate_step) in a background
+        thread while the node keeps running, started by the
+        "migrate-storage" api action.
+
+        It moves items_per_step items at a time, and waits busy_pause
+        seconds whenever is_busy() returns True, so the viewers don't
+        notice it. If only items with a write in progress are left, it
+        waits retry_pause seconds before trying them again.
+    """
+    def __init__(self, driver, is_busy=None, items_per_step=64,
+            step_pause=0.05, busy_pause=1.0, retry_pause=10.0):
+        self.driver = driver
+        if is_busy == None:
+            is_busy = lambda: False
+        self.is_busy = is_busy
+        self.items_per_step = items_per_step
+        self.step_pause = step_pause
+        self.busy_pause = busy_pause
+        self.retry_pause = retry_pause
+        self.lock = threading.Lock()
+        self.thread = None
+        self.stop_event = threading.Event()
+        self.done = False
+        self.error = None
+
+    def register_actions(self, actions):
+        actions["migrate-storage"] = self.action_migrate_storage
+
+    def _run(self):
+        try:
+            while True:
+                if self.stop_event.is_set():
+                    return
+                if self.is_busy():
+                    self.stop_event.wait(self.busy_pause)
+                    continue
+                (moved, skipped) = self.driver.migrate_step(
+                    self.items_per_step)
+                if moved == 0 and skipped == 0:
+                    break
+                if moved == 0:
+                    self.stop_event.wait(self.retry_pause)
+                    continue
+                self.stop_event.wait(self.step_pause)
+            with self.lock:
+                self.done = True
+        except Exception as e:
+            logging.exception("Storage migration failed: " + str(e))
+            with self.lock:
+                self.error = str(e)
+
+    def start(self):
+        """ Start migrating unless already running. """
+        with self.lock:
+            if self.thread != None and self.thread.is_alive():
+                return
+            self.done = False
+            self.error = None
+            self.stop_event.clear()
+            self.thread = threading.Thread(target=self._run, daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread != None:
+            self.thread.join()
+
+    def status(self):
+        with self.lock:
+            return {"running" : self.thread != None and \
+                self.thread.is_alive(), "done" : self.done,
+                "error" : self.error,
+                "migrated_items" : self.driver.migrated_items}
+
+    def action_migrate_storage(self, client, msg, data):
+        """ The "migrate-storage" api action. Starts the migration unless
+            "start" is false, and returns its status.
+        """
+        if msg.get("start", True):
+            self.start()
+        status = self.status()
+        if status["error"] != None:
+            return make_response(msg, "error", error_info=status["error"])
+        return make_response(msg, **status)
@@ -18,14 +18,117 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 '''
 
+import os
+
+from informationnode.daemon.apiserver import make_response
+from informationnode.daemon.storage.chunkstore import ChunkStore
+from informationnode.daemon.storage.metadataindex import MetadataIndex
+
 class QueryItems(object):
     """ A manager to query data items from the storage with various means.
+
+        Queries over the item metadata are answered by the node's
+        MetadataIndex, so they never need to walk the storage. The metadata
+        of single items comes from the ItemCatalog instead, if one is given.
     """
-    def __init__(self, node_folder):
-        self.storage_path = os.path.normpath(\
-            os.path.join(os.path.abspath(node_folder), node_folder))
+    def __init__(self, node_folder, chunk_store=None, metadata_index=None,
+            chunk_cache=None, tag_index=None, item_catalog=None):
+        self.storage_path = os.path.join(os.path.normpath(
+            os.path.abspath(node_folder)), "storage")
+        if chunk_store == None:
+            chunk_store = ChunkStore(self.storage_path)
+        if metadata_index == None:
+            metadata_index = MetadataIndex(self.storage_path)
+            if metadata_index.is_new:
+                metadata_index.rebuild(chunk_store.driver)
+        self.chunk_store = chunk_store
+        self.metadata_index = metadata_index
+        self.chunk_cache = chunk_cache
+        self.tag_index = tag_index
+        self.item_catalog = item_catalog
+
+    def register_actions(self, actions):
+        actions["query-items"] = self.action_query_items
 
     def get_by_id(self, identifier):
         """ Get all versions of the item with this identifier. """
+        # imported here, since the item encryption needs PyCrypto:
+        from informationnode.daemon.storage.item import Item
+
         items = []
+        for version in self.chunk_store.driver.list_versions(identifier):
+            items.append(Item(None, content_version=version,
+                chunk_store=self.chunk_store, identifier=identifier,
+                chunk_cache=self.chunk_cache,
+                metadata_index=self.metadata_index))
+        return items
+
+    def get_info(self, identifier):
+        """ Get the metadata of the latest version of the item with this
+            identifier, or None if there is no such item.
+        """
+        if self.item_catalog != None:
+            return self.item_catalog.get(identifier)
+        return self.metadata_index.get(identifier)
+
+    def find(self, mime_type=None, classification=None, tag=None,
+            created=None, modified=None, order_by="item_id",
+            descending=False, after=None, limit=100, tags=None,
+            match_all_tags=False):
+        """ Find items by their metadata. created and modified are
+            (start, end) ranges of ISO 8601 times, either of which may be None.
+            See MetadataIndex.query for the sorting and pagination.
+
+            tags is a list of tags of which the items need to have any (or
+            all, if match_all_tags is set), which needs a tag index.
+
+            Returns (list of item metadata, cursor for the next page or None).
+        """
+        equals = dict()
+        if mime_type != None:
+            equals["mime_type"] = mime_type
+        if classification != None:
+            equals["classification"] = classification
+        ranges = dict()
+        if created != None:
+            ranges["creation_time"] = created
+        if modified != None:
+            ranges["modification_time"] = modified
+        ordinals = None
+        if tags != None:
+            if self.tag_index == None:
+                raise ValueError("no tag index for tag list queries")
+            if match_all_tags:
+                ordinals = self.tag_index.items_with_all(tags)
+            else:
+                ordinals = self.tag_index.items_with_any(tags)
+        return self.metadata_index.query(equals=equals, ranges=ranges,
+            tag=tag, order_by=order_by, descending=descending, after=after,
+            limit=limit, ordinals=ordinals)
 
+    def action_query_items(self, client, msg, data):
+        """ The "query-items" api action. With an "item_id", it returns the
+            metadata of that item, otherwise it takes the arguments of find()
+            and returns one page of "items" and the cursor to pass as "after"
+            for the "next" one.
+        """
+        if msg.get("item_id", None) != None:
+            info = self.get_info(msg["item_id"])
+            if info == None:
+                return make_response(msg, "error", error_info="no such item")
+            return make_response(msg, items=[info], next=None)
+        try:
+            (items, cursor) = self.find(mime_type=msg.get("mime_type", None),
+                classification=msg.get("classification", None),
+                tag=msg.get("tag", None),
+                created=msg.get("created", None),
+                modified=msg.get("modified", None),
+                order_by=msg.get("order_by", "item_id"),
+                descending=bool(msg.get("descending", False)),
+                after=msg.get("after", None),
+                limit=msg.get("limit", 100),
+                tags=msg.get("tags", None),
+                match_all_tags=bool(msg.get("match_all_tags", False)))
+        except (TypeError, ValueError) as e:
+            return make_response(msg, "error", error_info=str(e))
+        return make_response(msg, items=items, next=cursor)
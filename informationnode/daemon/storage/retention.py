@@ -0,0 +1,138 @@
+'''
+information-node - an advanced tool for data synchronization
+Copyright (C) 2015  Information Node Development Team (see AUTHORS.md)
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 2 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+
+import datetime
+import logging
+
+from informationnode.daemon.apiserver import make_response
+from informationnode.helper import parse_isoformat
+
+class RetentionPolicy(object):
+    """ Decides which old content versions of an item are pruned.
+
+        At most keep_versions versions are kept, and versions modified more
+        than keep_days days ago are pruned (None for no limit). The latest
+        version is always kept. Versions without a modification time in
+        their record are only limited by keep_versions.
+    """
+    def __init__(self, keep_versions=None, keep_days=None):
+        if keep_versions != None and keep_versions < 1:
+            raise ValueError("at least one version needs to be kept")
+        if keep_days != None and keep_days < 0:
+            raise ValueError("keep_days can't be negative")
+        self.keep_versions = keep_versions
+        self.keep_days = keep_days
+
+    def keeps_all(self):
+        return self.keep_versions == None and self.keep_days == None
+
+    def versions_to_prune(self, versions, modification_times, now=None):
+        """ Get the versions to prune out of the given ascending list of
+            versions. modification_times maps versions to their
+            modification time as a datetime, or None if unknown.
+        """
+        versions = sorted(versions)
+        if len(versions) <= 1 or self.keeps_all():
+            return []
+        if now == None:
+            now = datetime.datetime.now()
+        prune = []
+        candidates = versions[:-1]
+        if self.keep_versions != None:
+            excess = len(versions) - self.keep_versions
+            if excess > 0:
+                prune = candidates[:excess]
+                candidates = candidates[excess:]
+        if self.keep_days != None:
+            oldest = now - datetime.timedelta(days=self.keep_days)
+            for version in candidates:
+                modified = modification_times.get(version, None)
+                if modified != None and modified < oldest:
+                    prune.append(version)
+        return prune
+
+def _modification_time(record):
+    try:
+        return parse_isoformat(record["modification_time"])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+def prune_versions(chunk_store, item_id, policy, now=None):
+    """ Delete the content versions of an item which the RetentionPolicy
+        doesn't keep. Since versions share their unchanged chunks, only the
+        chunks no remaining version uses are deleted - no chunk data is
+        rewritten. Returns the list of pruned versions.
+    """
+    if policy.keeps_all():
+        return []
+    driver = chunk_store.driver
+    versions = driver.list_versions(item_id)
+    if len(versions) <= 1:
+        return []
+    times = dict()
+    if policy.keep_days != None:
+        for version in versions[:-1]:
+            times[version] = _modification_time(driver.read_version(
+                item_id, version))
+    pruned = policy.versions_to_prune(versions, times, now=now)
+    for version in pruned:
+        chunk_store.delete_version(item_id, version)
+    if len(pruned) > 0:
+        logging.debug("Pruned " + str(len(pruned)) + " old content " +\
+            "versions of item " + str(item_id))
+    return pruned
+
+class VersionRetention(object):
+    """ Applies the node's RetentionPolicy to an item whenever a new content
+        version of it is saved, and provides the "prune-versions" api
+        action.
+    """
+    def __init__(self, chunk_store, policy=None):
+        self.chunk_store = chunk_store
+        if policy == None:
+            policy = RetentionPolicy()
+        self.policy = policy
+
+    def register_actions(self, actions):
+        actions["prune-versions"] = self.action_prune_versions
+
+    def item_saved(self, item_id):
+        return self.prune(item_id, self.policy)
+
+    def prune(self, item_id, policy):
+        return prune_versions(self.chunk_store, item_id, policy)
+
+    def action_prune_versions(self, client, msg, data):
+        """ The "prune-versions" api action. Prunes the old versions of the
+            given "item_id" with the node's policy, or with the given
+            "keep_versions" and/or "keep_days" instead.
+        """
+        if not isinstance(msg.get("item_id", None), str):
+            return make_response(msg, "error", error_info="item_id missing")
+        policy = self.policy
+        if msg.get("keep_versions", None) != None or \
+                msg.get("keep_days", None) != None:
+            try:
+                policy = RetentionPolicy(
+                    keep_versions=msg.get("keep_versions", None),
+                    keep_days=msg.get("keep_days", None))
+            except (TypeError, ValueError) as e:
+                return make_response(msg, "error", error_info=str(e))
+        pruned = self.prune(msg["item_id"], policy)
+        return make_response(msg, pruned=pruned)
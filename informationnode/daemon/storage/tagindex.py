@@ -0,0 +1,182 @@
+'''
+information-node - an advanced tool for data synchronization
+Copyright (C) 2015  Information Node Development Team (see AUTHORS.md)
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 2 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+
+import logging
+import os
+import sqlite3
+import threading
+
+from informationnode.daemon.storage.bitmap import RoaringBitmap
+
+class TagIndex(object):
+    """ Keeps a compressed bitmap of item ordinals (see MetadataIndex) for
+        each tag, so tag-list checks like "does this item have any of these
+        tags" and "which items have all of these tags" are set operations
+        on bitmaps instead of table scans.
+
+        The bitmaps are held in memory and written to tags.db by flush().
+        Until then, the database is marked as dirty, so if the node stops
+        without a flush the bitmaps are rebuilt from the metadata index
+        (which remains the authoritative source of the tags).
+
+        This class is thread-safe.
+    """
+    def __init__(self, storage_path):
+        path = os.path.join(storage_path, "tags.db")
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False,
+            isolation_level=None)
+        self.db.execute("CREATE TABLE IF NOT EXISTS tag_bitmaps (" +\
+            "tag TEXT PRIMARY KEY, bitmap BLOB NOT NULL)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS state (" +\
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        row = self.db.execute("SELECT value FROM state WHERE key = 'clean'"
+            ).fetchone()
+        self.needs_rebuild = (row == None or row[0] != "1")
+        self.bitmaps = dict()
+        self.dirty_tags = set()
+        if not self.needs_rebuild:
+            for (tag, data) in self.db.execute("SELECT tag, bitmap FROM " +\
+                    "tag_bitmaps"):
+                self.bitmaps[tag] = RoaringBitmap.from_bytes(data)
+
+    def _mark_dirty(self, tag):
+        if len(self.dirty_tags) == 0:
+            self.db.execute("INSERT OR REPLACE INTO state (key, value) " +\
+                "VALUES ('clean', '0')")
+        self.dirty_tags.add(tag)
+
+    def update_item(self, ordinal, old_tags, new_tags):
+        """ Move the item with the given ordinal from old_tags to new_tags.
+        """
+        (old_tags, new_tags) = (set(old_tags), set(new_tags))
+        with self.lock:
+            for tag in old_tags - new_tags:
+                bitmap = self.bitmaps.get(tag, None)
+                if bitmap == None:
+                    continue
+                bitmap.discard(ordinal)
+                if len(bitmap.containers) == 0:
+                    del(self.bitmaps[tag])
+                self._mark_dirty(tag)
+            for tag in new_tags - old_tags:
+                if not tag in self.bitmaps:
+                    self.bitmaps[tag] = RoaringBitmap()
+                self.bitmaps[tag].add(ordinal)
+                self._mark_dirty(tag)
+
+    def rebuild(self, tagged_ordinals):
+        """ Replace all bitmaps with the given (tag, ordinal) pairs, e.g. as
+            returned by MetadataIndex.tagged_ordinals().
+        """
+        bitmaps = dict()
+        for (tag, ordinal) in tagged_ordinals:
+            if not tag in bitmaps:
+                bitmaps[tag] = RoaringBitmap()
+            bitmaps[tag].add(ordinal)
+        with self.lock:
+            self.bitmaps = bitmaps
+            self.dirty_tags = set()
+            self.db.execute("BEGIN")
+            try:
+                self.db.execute("DELETE FROM tag_bitmaps")
+                self.dirty_tags = set(bitmaps.keys())
+                self._write_dirty()
+                self.db.execute("COMMIT")
+            except BaseException:
+                self.db.execute("ROLLBACK")
+                raise
+            self.needs_rebuild = False
+        logging.info("Rebuilt tag index of " + str(len(bitmaps)) + " tags.")
+
+    def _write_dirty(self):
+        for tag in self.dirty_tags:
+            bitmap = self.bitmaps.get(tag, None)
+            if bitmap == None:
+                self.db.execute("DELETE FROM tag_bitmaps WHERE tag = ?",
+                    (tag,))
+            else:
+                self.db.execute("INSERT OR REPLACE INTO tag_bitmaps " +\
+                    "(tag, bitmap) VALUES (?, ?)", (tag, bitmap.to_bytes()))
+        self.dirty_tags = set()
+        self.db.execute("INSERT OR REPLACE INTO state (key, value) " +\
+            "VALUES ('clean', '1')")
+
+    def flush(self):
+        """ Write the bitmaps changed since the last flush to disk. """
+        with self.lock:
+            if len(self.dirty_tags) == 0:
+                return
+            self.db.execute("BEGIN")
+            try:
+                self._write_dirty()
+                self.db.execute("COMMIT")
+            except BaseException:
+                self.db.execute("ROLLBACK")
+                raise
+
+    def items_with_tag(self, tag):
+        with self.lock:
+            bitmap = self.bitmaps.get(tag, None)
+            if bitmap == None:
+                return RoaringBitmap()
+            return bitmap.copy()
+
+    def items_with_any(self, tags):
+        """ Bitmap of the ordinals of all items with at least one of the tags.
+        """
+        with self.lock:
+            return RoaringBitmap.union([self.bitmaps[tag] for tag in \
+                set(tags) if tag in self.bitmaps])
+
+    def items_with_all(self, tags):
+        """ Bitmap of the ordinals of all items with every one of the tags.
+        """
+        tags = set(tags)
+        if len(tags) == 0:
+            return RoaringBitmap()
+        with self.lock:
+            # start with the rarest tag, so the result is small right away:
+            bitmaps = sorted([self.bitmaps.get(tag, RoaringBitmap()) \
+                for tag in tags], key=len)
+            result = bitmaps[0].copy()
+            for bitmap in bitmaps[1:]:
+                if len(result.containers) == 0:
+                    break
+                result = result & bitmap
+            return result
+
+    def item_has_any(self, ordinal, tags):
+        """ Check whether the item with the given ordinal has any of the tags.
+        """
+        with self.lock:
+            for tag in tags:
+                bitmap = self.bitmaps.get(tag, None)
+                if bitmap != None and ordinal in bitmap:
+                    return True
+        return False
+
+    def tags(self):
+        with self.lock:
+            return sorted(self.bitmaps.keys())
+
+    def close(self):
+        self.flush()
+        with self.lock:
+            self.db.close()
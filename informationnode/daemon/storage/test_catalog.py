@@ -0,0 +1,78 @@
+'''
+information-node - an advanced tool for data synchronization
+Copyright (C) 2015  Information Node Development Team (see AUTHORS.md)
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 2 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+
+import unittest
+
+from informationnode.daemon.storage.catalog import ItemCatalog, \
+    pack_item_id, unpack_item_id
+
+ITEM_ID = "5f0c6e2a-8d1b-4c3e-9a7f-2b6d4e8c1a90-" + "ab" * 28
+
+class TestItemCatalog(unittest.TestCase):
+    def record(self, i):
+        return {"mime_type" : ["text/plain", "image/png"][i % 2],
+            "classification" : "file", "tags" : ["t%d" % (i % 3)],
+            "creation_time" : "2020-01-01T00:00:00",
+            "modification_time" : "2020-01-02T03:04:05.%06d" % i}
+
+    def test_item_ids(self):
+        self.assertEqual(len(pack_item_id(ITEM_ID)), 45)
+        for item_id in [ITEM_ID, "item", "äöü", ITEM_ID.upper()]:
+            self.assertEqual(unpack_item_id(pack_item_id(item_id)),
+                item_id)
+
+    def test_update_get_remove(self):
+        catalog = ItemCatalog()
+        for i in range(3000):
+            catalog.update_from_record("item%d" % i, 1, self.record(i))
+        self.assertEqual(len(catalog), 3000)
+        info = catalog.get("item7")
+        self.assertEqual(info, {"item_id" : "item7", "content_version" : 1,
+            "mime_type" : "image/png", "classification" : "file",
+            "tags" : ["t1"], "creation_time" : "2020-01-01T00:00:00",
+            "modification_time" : "2020-01-02T03:04:05.000007"})
+
+        # odd or missing values are kept as they are:
+        catalog.update_from_record("item7", 2, {"creation_time" :
+            "2020-01-01T00:00:00+02:00", "tags" : ["b", "a"]})
+        info = catalog.get("item7")
+        self.assertEqual(info["content_version"], 2)
+        self.assertEqual(info["creation_time"], "2020-01-01T00:00:00+02:00")
+        self.assertEqual(info["modification_time"], None)
+        self.assertEqual(info["mime_type"], None)
+        self.assertEqual(info["tags"], ["a", "b"])
+
+        self.assertEqual(len(catalog.find(mime_type="text/plain",
+            tag="t0")), 500)
+        # removing most items compacts the columns:
+        for i in range(2500):
+            catalog.remove_item("item%d" % i)
+        self.assertEqual(len(catalog), 500)
+        self.assertTrue(len(catalog.versions) < 2000)
+        self.assertFalse("item7" in catalog)
+        self.assertEqual(catalog.get("item2999")["modification_time"],
+            "2020-01-02T03:04:05.002999")
+        self.assertEqual(sorted(catalog.item_ids()), sorted(["item%d" % i \
+            for i in range(2500, 3000)]))
+        catalog.update_from_record("item7", 1, self.record(7))
+        self.assertEqual(catalog.get("item7")["tags"], ["t1"])
+        self.assertTrue(catalog.memory_usage() < 2000 * 120)
+
+if __name__ == '__main__':
+    unittest.main()
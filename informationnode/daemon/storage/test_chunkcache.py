@@ -0,0 +1,91 @@
+'''
+information-node - an advanced tool for data synchronization
+Copyright (C) 2015  Information Node Development Team (see AUTHORS.md)
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 2 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+
+
+import threading
+import unittest
+
+from informationnode.daemon.storage.chunkcache import ChunkCache
+
+class FakeManager(object):
+    def __init__(self):
+        self.identifier = "item"
+        self.lock = threading.RLock()
+
+class FakeChunk(object):
+    def __init__(self, item, no, size):
+        self.item = item
+        self.no = no
+        self.data = b"x" * size
+
+    def size(self):
+        if self.data == None:
+            return None
+        return len(self.data)
+
+    def transfer_to_disk(self):
+        self.data = None
+
+class TestChunkCache(unittest.TestCase):
+    def test_lru_eviction(self):
+        cache = ChunkCache(max_bytes=250)
+        manager = FakeManager()
+        chunks = [FakeChunk(manager, i, 100) for i in range(3)]
+        cache.touch(chunks[0])
+        cache.touch(chunks[1])
+        cache.touch(chunks[0], True)
+        cache.touch(chunks[2])
+        # chunk 1 was least recently used:
+        self.assertEqual([c.data != None for c in chunks],
+            [True, False, True])
+        stats = cache.stats()
+        self.assertEqual(stats["used_bytes"], 200)
+        self.assertEqual(stats["evictions"], 1)
+        self.assertEqual(stats["hits"], 1)
+
+        cache.remove(chunks[0])
+        self.assertEqual(cache.stats()["used_bytes"], 100)
+
+    def test_locked_chunks_are_kept(self):
+        cache = ChunkCache(max_bytes=250)
+        busy_manager = FakeManager()
+        busy = FakeChunk(busy_manager, 0, 100)
+        other = FakeChunk(FakeManager(), 1, 100)
+        cache.touch(busy)
+        cache.touch(other, False)
+
+        locked = threading.Event()
+        release = threading.Event()
+        def hold_lock():
+            with busy_manager.lock:
+                locked.set()
+                release.wait()
+        thread = threading.Thread(target=hold_lock)
+        thread.start()
+        locked.wait()
+        cache.touch(FakeChunk(FakeManager(), 2, 100))
+        release.set()
+        thread.join()
+        # the busy chunk is kept, the next least recently used one goes:
+        self.assertTrue(busy.data != None)
+        self.assertEqual(other.data, None)
+        self.assertEqual(cache.stats()["misses"], 1)
+
+if __name__ == '__main__':
+    unittest.main()
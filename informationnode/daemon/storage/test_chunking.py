@@ -0,0 +1,76 @@
+'''
+information-node - an advanced tool for data synchronization
+Copyright (C) 2015  Information Node Development Team (see AUTHORS.md)
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 2 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+
+import io
+import random
+import unittest
+
+from informationnode.daemon.storage import chunking
+from informationnode.daemon.storage.chunking import ContentDefinedChunker, \
+    FixedSizeChunker, chunker_from_description
+
+class TestChunking(unittest.TestCase):
+    def setUp(self):
+        rng = random.Random(17)
+        self.data = bytes([rng.getrandbits(8) for i in range(300000)]) +\
+            bytes(50000)
+        self.chunker = ContentDefinedChunker(1024, 4096, 16384)
+
+    def python_cut_points(self, data):
+        cuts = []
+        pos = 0
+        while pos < len(data):
+            pos = self.chunker._find_cut(data, pos, len(data), True)
+            cuts.append(pos)
+        return cuts
+
+    def test_boundaries(self):
+        cuts = self.python_cut_points(self.data)
+        if chunking.numpy != None:
+            self.assertEqual(self.chunker._cut_points_numpy(self.data, True),
+                cuts)
+        sizes = [end - start for (start, end) in zip([0] + cuts, cuts)]
+        self.assertTrue(min(sizes[:-1]) >= 1024)
+        self.assertTrue(max(sizes) <= 16384)
+
+        # an insertion only changes the chunk it is in (as long as the data
+        # isn't too uniform to have content-defined boundaries):
+        edited = self.data[:10000] + b"inserted" + self.data[10000:]
+        edited_cuts = set([(cut - 8 if cut > 10000 else cut) for cut in \
+            self.chunker.cut_points(edited)])
+        self.assertTrue(len([cut for cut in cuts if cut < 300000 and \
+            not cut in edited_cuts]) <= 1)
+
+        # reading a file in pieces gives the same chunks:
+        chunks = list(self.chunker.iter_file(io.BytesIO(self.data),
+            read_size=20000))
+        self.assertEqual([len(chunk) for chunk in chunks], sizes)
+        self.assertEqual(b"".join(chunks), self.data)
+
+    def test_fixed_size(self):
+        chunker = chunker_from_description(FixedSizeChunker(
+            1000).describe())
+        self.assertEqual([len(c) for c in chunker.split(b"a" * 2500)],
+            [1000, 1000, 500])
+        self.assertEqual(chunker.cut_points(b"a" * 2500, final=False),
+            [1000, 2000])
+        self.assertEqual(list(chunker.iter_file(io.BytesIO(b""))), [])
+
+if __name__ == '__main__':
+    unittest.main()
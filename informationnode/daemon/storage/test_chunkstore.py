@@ -0,0 +1,118 @@
+'''
+information-node - an advanced tool for data synchronization
+Copyright (C) 2015  Information Node Development Team (see AUTHORS.md)
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 2 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+
+
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from informationnode.daemon.storage.chunkstore import ChunkStore
+
+class TestChunkStore(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.store = ChunkStore(self.path)
+
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(self.path)
+
+    def chunk_file_count(self):
+        return sum(len(files) for (unused, unused2, files) in \
+            os.walk(os.path.join(self.path, "chunks")))
+
+    def test_deduplication(self):
+        hashes = self.store.put_many([b"a" * 100, b"b" * 100, b"a" * 100])
+        self.assertEqual(hashes[0], hashes[2])
+        self.assertEqual(self.chunk_file_count(), 2)
+        self.assertEqual(self.store.refcount(hashes[0]), 2)
+        self.assertEqual(self.store.get(hashes[1]), b"b" * 100)
+        self.assertEqual(self.store.stats(), {"chunk_count" : 2,
+            "stored_size" : 200, "referenced_size" : 300})
+
+    def test_release(self):
+        chunk_hash = self.store.put(b"data")
+        self.store.add_ref([chunk_hash])
+        self.store.release([chunk_hash])
+        self.assertEqual(self.store.get(chunk_hash), b"data")
+        self.store.release([chunk_hash])
+        self.assertEqual(self.store.refcount(chunk_hash), 0)
+        self.assertEqual(self.chunk_file_count(), 0)
+        self.assertRaises(ValueError, self.store.get, chunk_hash)
+        self.assertRaises(ValueError, self.store.add_ref, [chunk_hash])
+
+    def test_threads(self):
+        def put():
+            for i in range(50):
+                self.store.put(str(i).encode("utf-8"))
+        threads = [threading.Thread(target=put) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(self.store.stats()["chunk_count"], 50)
+        self.assertEqual(self.store.refcount(ChunkStore.chunk_hash(b"7")), 4)
+
+    def test_parallel_writes(self):
+        # both threads need to be writing at the same time to get past this:
+        barrier = threading.Barrier(2, timeout=5)
+        put_chunk = self.store.driver.put_chunk
+        def waiting_put_chunk(chunk_hash, data):
+            put_chunk(chunk_hash, data)
+            barrier.wait()
+        self.store.driver.put_chunk = waiting_put_chunk
+        errors = []
+        def put(data):
+            try:
+                self.store.put(data)
+            except threading.BrokenBarrierError as e:
+                errors.append(e)
+        threads = [threading.Thread(target=put, args=(data,)) for data in \
+            [b"first", b"second"]]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(self.store.stats()["chunk_count"], 2)
+
+    def test_sweep_while_writing(self):
+        written = threading.Event()
+        swept = threading.Event()
+        put_chunk = self.store.driver.put_chunk
+        def waiting_put_chunk(chunk_hash, data):
+            put_chunk(chunk_hash, data)
+            written.set()
+            swept.wait(5)
+        self.store.driver.put_chunk = waiting_put_chunk
+        thread = threading.Thread(target=self.store.put, args=(b"data",))
+        thread.start()
+        written.wait(5)
+        # stored, but not referenced yet:
+        chunk_hash = ChunkStore.chunk_hash(b"data")
+        self.assertEqual(self.store.sweep_orphans([chunk_hash]), 0)
+        swept.set()
+        thread.join()
+        self.assertEqual(self.store.refcount(chunk_hash), 1)
+        self.assertEqual(self.store.get(chunk_hash), b"data")
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,58 @@
+'''
+information-node - an advanced tool for data synchronization
+Copyright (C) 2015  Information Node Development Team (see AUTHORS.md)
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 2 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+
+import os
+import unittest
+
+from informationnode.daemon.storage.compression import CODECS, \
+    ChunkCompressor, decode_chunk
+
+class TestCompression(unittest.TestCase):
+    def setUp(self):
+        self.text = b"".join([("From: someone%d@example.com\r\nSubject: " +\
+            "hello\r\n\r\nsome text\r\n") .encode("ascii") % i \
+            for i in range(2000)])
+
+    def test_codecs(self):
+        for codec in CODECS.values():
+            encoded = ChunkCompressor(codec.name).encode(self.text)
+            self.assertEqual(encoded[0], codec.codec_id)
+            if codec.codec_id != 0:
+                self.assertTrue(len(encoded) < len(self.text) / 4)
+            self.assertEqual(decode_chunk(encoded), self.text)
+
+    def test_adaptive_skipping(self):
+        compressor = ChunkCompressor("lzma")
+        random_data = os.urandom(100000)
+        for (data, mime_type) in [(random_data, "text/plain"),
+                (self.text, "image/jpeg"), (b"short", None)]:
+            encoded = compressor.encode(data, mime_type)
+            self.assertEqual(encoded[0], 0)
+            self.assertEqual(decode_chunk(encoded), data)
+        self.assertNotEqual(compressor.encode(self.text, "image/svg+xml")[0],
+            0)
+
+        # uncompressed chunks are passed on as views without copying:
+        view = memoryview(compressor.encode(random_data))
+        self.assertEqual(decode_chunk(view).obj, view.obj)
+
+        self.assertRaises(RuntimeError, decode_chunk, bytes([200]) + b"abc")
+
+if __name__ == '__main__':
+    unittest.main()
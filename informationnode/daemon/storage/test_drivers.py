@@ -0,0 +1,203 @@
+'''
+information-node - an advanced tool for data synchronization
+Copyright (C) 2015  Information Node Development Team (see AUTHORS.md)
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 2 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from informationnode.daemon.storage.chunkstore import ChunkStore
+from informationnode.daemon.storage.drivers import create_storage, \
+    open_storage_driver, DirectoryStorageDriver, PackfileStorageDriver
+
+class DriverTests(object):
+    """ Tests every storage driver needs to pass. """
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.driver = self.open_driver()
+
+    def tearDown(self):
+        self.driver.close()
+        shutil.rmtree(self.path)
+
+    def reopen(self):
+        self.driver.close()
+        self.driver = self.open_driver()
+
+    def test_chunks(self):
+        self.driver.put_chunk("ab12", b"data")
+        self.assertTrue(self.driver.has_chunk("ab12"))
+        self.assertEqual(self.driver.get_chunk("ab12"), b"data")
+        view = self.driver.get_chunk_view("ab12")
+        self.assertTrue(isinstance(view, memoryview))
+        self.assertEqual(bytes(view), b"data")
+
+        # views stay valid while more is written:
+        for i in range(10):
+            self.driver.put_chunk("cd" + str(i), bytes([i]) * 30)
+        self.assertEqual(bytes(self.driver.get_chunk_view("cd9")),
+            bytes([9]) * 30)
+        self.assertEqual(bytes(view), b"data")
+        del(view)
+        self.driver.delete_chunk("ab12")
+        self.assertFalse(self.driver.has_chunk("ab12"))
+        self.assertRaises(ValueError, self.driver.get_chunk, "ab12")
+
+    def test_versions(self):
+        self.driver.write_version("item", 1, {"chunk_hashes" : ["a"]})
+        self.driver.write_version("item", 2, {"chunk_hashes" : ["b"]})
+        self.driver.write_version("item", 2, {"chunk_hashes" : ["c"]})
+        self.driver.sync()
+        self.reopen()
+        self.assertEqual(self.driver.list_versions("item"), [1, 2])
+        self.assertEqual(self.driver.read_version("item", 2),
+            {"chunk_hashes" : ["c"]})
+        self.driver.delete_version("item", 1)
+        self.assertEqual(self.driver.list_versions("item"), [2])
+        self.assertRaises(ValueError, self.driver.read_version, "item", 1)
+        self.assertRaises(ValueError, self.driver.write_version, "../x", 1,
+            {})
+
+class TestDirectoryStorageDriver(DriverTests, unittest.TestCase):
+    def open_driver(self):
+        return DirectoryStorageDriver(self.path)
+
+    def write_flat_version(self, item_id, version, record):
+        """ Write a version in the layout of older nodes. """
+        folder = os.path.join(self.path, "items", item_id, str(version))
+        os.makedirs(folder)
+        with open(os.path.join(folder, "version.json"), "w") as f:
+            json.dump(record, f)
+
+    def test_sharded_layout(self):
+        self.driver.write_version("item", 1, {"chunk_hashes" : []})
+        path = self.driver._version_path("item", 1)
+        self.assertTrue(os.path.exists(path))
+        self.assertEqual(len(os.path.relpath(path, os.path.join(self.path,
+            "item-shards")).split(os.sep)), 5)
+        self.assertFalse(os.path.exists(os.path.join(self.path, "items")))
+        self.assertEqual(self.driver.list_items(), ["item"])
+
+    def test_migration(self):
+        for i in range(10):
+            self.write_flat_version("item%d" % i, 1, {"chunk_hashes" : [i]})
+        self.write_flat_version("item0", 2, {"chunk_hashes" : ["old"]})
+        self.reopen()
+        # saved since in the new layout, while the old one is still there:
+        self.driver.write_version("item0", 2, {"chunk_hashes" : ["new"]})
+        self.driver.write_version("item0", 3, {"chunk_hashes" : []})
+        self.assertEqual(self.driver.list_versions("item0"), [1, 2, 3])
+        self.assertEqual(len(self.driver.list_items()), 10)
+        self.assertEqual(self.driver.read_version("item3", 1),
+            {"chunk_hashes" : [3]})
+
+        self.assertEqual(self.driver.migrate_step(4), (4, 0))
+        self.assertEqual(sorted(self.driver.list_items()),
+            sorted(["item%d" % i for i in range(10)]))
+        while self.driver.migrate_step(4) != (0, 0):
+            pass
+        self.assertEqual(self.driver.migrated_items, 10)
+        self.assertFalse(os.path.exists(os.path.join(self.path, "items")))
+        self.assertEqual(self.driver.list_versions("item0"), [1, 2, 3])
+        self.assertEqual(self.driver.read_version("item0", 2),
+            {"chunk_hashes" : ["new"]})
+        for i in range(10):
+            self.assertEqual(self.driver.read_version("item%d" % i, 1),
+                {"chunk_hashes" : [i]})
+
+    def test_migration_waits_for_writes(self):
+        self.write_flat_version("busy", 1, {"chunk_hashes" : []})
+        self.write_flat_version("gone", 1, {"chunk_hashes" : []})
+        self.reopen()
+        # a write of version 1 to the new place that is still going on:
+        in_progress = os.path.dirname(self.driver._version_path("busy", 1))
+        os.makedirs(in_progress)
+        with open(os.path.join(in_progress, "version.json.tmp"), "w") as f:
+            f.write("{")
+        self.assertEqual(self.driver.migrate_step(1), (0, 1))
+        # an item deleted by the node after the migration listed it:
+        self.driver.delete_version("gone", 1)
+        self.assertEqual(self.driver.migrate_step(1), (1, 1))
+        # only the busy item is left, so the caller should wait:
+        self.assertEqual(self.driver.migrate_step(1), (0, 1))
+        self.assertEqual(self.driver.read_version("busy", 1),
+            {"chunk_hashes" : []})
+
+        # without a data server running, it is a leftover of a crash:
+        self.assertEqual(self.driver.migrate_step(1, leftover_age=0),
+            (1, 0))
+        self.assertEqual(self.driver.migrate_step(1), (0, 0))
+        self.assertFalse(os.path.exists(os.path.join(self.path, "items")))
+        self.assertEqual(self.driver.list_items(), ["busy"])
+
+class TestPackfileStorageDriver(DriverTests, unittest.TestCase):
+    def open_driver(self):
+        return PackfileStorageDriver(self.path, max_segment_size=200)
+
+    def test_segments(self):
+        for i in range(20):
+            self.driver.put_chunk("chunk" + str(i), b"x" * 50)
+        self.driver.delete_chunk("chunk3")
+        self.reopen()
+        segments = os.listdir(os.path.join(self.path, "packs"))
+        self.assertTrue(len([s for s in segments if \
+            s.endswith(".idx")]) > 1)
+        self.assertFalse(self.driver.has_chunk("chunk3"))
+        self.assertEqual(self.driver.get_chunk("chunk19"), b"x" * 50)
+
+        # a torn record at the end is cut off when opening again:
+        self.driver.put_chunk("last", b"y" * 10)
+        path = self.driver._segment_path(self.driver.active_no)
+        self.driver.close()
+        with open(path, "r+b") as f:
+            f.truncate(os.path.getsize(path) - 3)
+        self.driver = self.open_driver()
+        self.assertFalse(self.driver.has_chunk("last"))
+        self.driver.put_chunk("last", b"z")
+        self.assertEqual(self.driver.get_chunk("last"), b"z")
+
+    def test_restart_before_seal(self):
+        self.driver.put_chunk("a", b"a" * 20)
+        self.driver.write_version("item", 1, {"chunk_hashes" : ["a"]})
+        self.reopen()
+        # fill the reopened active segment until it gets sealed:
+        first_segment = self.driver.active_no
+        i = 0
+        while self.driver.active_no == first_segment:
+            self.driver.put_chunk("fill" + str(i), b"x" * 50)
+            i += 1
+        self.reopen()
+        self.assertTrue("a" in self.driver.list_chunks())
+        self.assertEqual(self.driver.get_chunk("a"), b"a" * 20)
+        self.assertEqual(self.driver.list_items(), ["item"])
+        self.assertEqual(self.driver.read_version("item", 1),
+            {"chunk_hashes" : ["a"]})
+
+    def test_open_storage_driver(self):
+        create_storage(self.path, "packfile")
+        store = ChunkStore(self.path)
+        self.assertTrue(isinstance(store.driver, PackfileStorageDriver))
+        chunk_hash = store.put(b"abc")
+        self.assertEqual(store.get(chunk_hash), b"abc")
+        store.close()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,115 @@
+'''
+information-node - an advanced tool for data synchronization
+Copyright (C) 2015  Information Node Development Team (see AUTHORS.md)
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 2 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from informationnode.daemon.storage.chunkstore import ChunkStore
+from informationnode.daemon.storage.drivers import create_storage, \
+    PackfileStorageDriver
+from informationnode.daemon.storage.garbagecollector import \
+    GarbageCollector
+
+class TestGarbageCollector(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        create_storage(self.path, "packfile")
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def open_store(self):
+        driver = PackfileStorageDriver(self.path,
+            max_segment_size=(1024 * 64), retire_delay=0)
+        return ChunkStore(self.path, driver=driver)
+
+    def collect(self, collector):
+        while collector.step() > 0:
+            pass
+
+    def test_compaction(self):
+        store = self.open_store()
+        chunks = [os.urandom(1000) + bytes([i]) for i in range(200)]
+        hashes = store.put_many(chunks)
+        store.commit_version("item", 1, {"chunk_hashes" : hashes[::10]})
+        store.release([h for (i, h) in enumerate(hashes) if i % 10 != 0])
+        # stored again after it was deleted:
+        store.put(chunks[1])
+        segments = len(os.listdir(os.path.join(self.path, "packs")))
+        sizes = dict((no, os.path.getsize(store.driver._segment_path(no)))
+            for no in store.driver._segment_numbers())
+
+        collector = GarbageCollector(store, step_bytes=4096)
+        self.collect(collector)
+        self.assertTrue(collector.stats()["reclaimed_bytes"] > 150000)
+        # the live data copied along the way doesn't count as reclaimed:
+        removed = [no for no in sizes if not no in \
+            store.driver._segment_numbers()]
+        self.assertEqual(collector.stats()["reclaimed_bytes"],
+            sum(sizes[no] for no in removed))
+        # only the active segment, which isn't compacted, has dead space:
+        self.assertEqual(list(store.driver.dead_bytes.keys()),
+            [store.driver.active_no])
+        self.assertTrue(len(os.listdir(os.path.join(self.path, "packs"))) <
+            segments)
+        for i in list(range(0, 200, 10)) + [1]:
+            self.assertEqual(store.get(hashes[i]), chunks[i])
+        store.close()
+
+        # deleted chunks stay deleted when loading the compacted segments:
+        store = self.open_store()
+        self.assertEqual(sorted(store.driver.list_chunks()),
+            sorted(hashes[::10] + [hashes[1]]))
+        self.assertEqual(store.driver.read_version("item", 1),
+            {"chunk_hashes" : hashes[::10]})
+        store.close()
+
+    def test_sweep_orphans(self):
+        store = self.open_store()
+        kept = store.put(b"kept")
+        # stored by the driver, but the transaction never committed:
+        orphan = store.chunk_hash(b"orphan")
+        store.driver.put_chunk(orphan, b"orphan")
+        self.collect(GarbageCollector(store))
+        self.assertEqual(store.driver.list_chunks(), [kept])
+        store.close()
+
+    def test_pauses_while_busy(self):
+        store = self.open_store()
+        store.release(store.put_many([os.urandom(1000) for i in range(100)]))
+        busy = [True]
+        collector = GarbageCollector(store, is_busy=lambda: busy[0],
+            busy_pause=0.01, idle_interval=0.01)
+        collector.start()
+        try:
+            time.sleep(0.2)
+            self.assertTrue(collector.stats()["pauses"] > 0)
+            self.assertEqual(collector.stats()["steps"], 0)
+            busy[0] = False
+            time.sleep(0.3)
+            self.assertTrue(collector.stats()["reclaimed_bytes"] > 0)
+        finally:
+            collector.stop()
+        store.close()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,106 @@
+'''
+information-node - an advanced tool for data synchronization
+Copyright (C) 2015  Information Node Development Team (see AUTHORS.md)
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 2 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+
+import hashlib
+import io
+import os
+import threading
+import unittest
+
+from informationnode.daemon.storage.chunking import ContentDefinedChunker, \
+    FixedSizeChunker
+from informationnode.daemon.storage.importpipeline import ImportPipeline
+
+class HashingStore(object):
+    """ Stand-in for the ChunkStore parts the pipeline uses. """
+    @staticmethod
+    def chunk_hash(data):
+        return hashlib.sha256(data).hexdigest()
+
+class MemoryContent(object):
+    """ Stand-in for an ItemChunkManager, which needs PyCrypto. """
+    def __init__(self, chunker):
+        self.chunker = chunker
+        self.chunk_store = HashingStore()
+        self.chunks = dict()
+        self.batches = []
+        self.encoding_threads = set()
+
+    def _encode_chunk(self, data):
+        self.encoding_threads.add(threading.get_ident())
+        return b"!" + bytes(data)
+
+    def _set_stored_chunks(self, entries):
+        self.batches.append(len(entries))
+        for (chunk_no, length, data, chunk_hash) in entries:
+            assert(chunk_hash == self.chunk_store.chunk_hash(data))
+            assert(length == len(data) - 1)
+            self.chunks[chunk_no] = data[1:]
+
+    def contents(self):
+        return b"".join([self.chunks[no] for no in range(len(self.chunks))])
+
+class FailingFile(io.RawIOBase):
+    def readable(self):
+        return True
+
+    def readinto(self, buf):
+        raise OSError("disk on fire")
+
+class TestImportPipeline(unittest.TestCase):
+    def test_import_file(self):
+        data = os.urandom(1024 * 700) + b"text" * 100000
+        for chunker in [FixedSizeChunker(1000 * 33),
+                ContentDefinedChunker(1024 * 4, 1024 * 16, 1024 * 64)]:
+            for workers in [0, 3]:
+                content = MemoryContent(chunker)
+                pipeline = ImportPipeline(content, workers=workers,
+                    read_size=(1024 * 50), write_batch=4)
+                count = pipeline.import_file(io.BytesIO(data))
+                self.assertEqual(count, len(content.chunks))
+                self.assertEqual(content.contents(), data)
+                self.assertEqual(max(content.batches), 4)
+                self.assertEqual([len(chunk) for (no, chunk) in sorted(
+                    content.chunks.items())], [b - a for (a, b) in zip(
+                    [0] + chunker.cut_points(data), chunker.cut_points(
+                    data))])
+                if workers == 0:
+                    self.assertEqual(content.encoding_threads,
+                        set([threading.get_ident()]))
+                else:
+                    self.assertFalse(threading.get_ident() in
+                        content.encoding_threads)
+
+    def test_import_bytes(self):
+        content = MemoryContent(FixedSizeChunker(10))
+        self.assertEqual(ImportPipeline(content).import_bytes(b"x" * 95), 10)
+        self.assertEqual(content.contents(), b"x" * 95)
+        content = MemoryContent(FixedSizeChunker(10))
+        self.assertEqual(ImportPipeline(content).import_bytes(b""), 0)
+
+    def test_read_error(self):
+        content = MemoryContent(FixedSizeChunker(10))
+        threads = threading.active_count()
+        with self.assertRaises(OSError):
+            ImportPipeline(content, workers=2).import_file(FailingFile())
+        # the reader and worker threads are gone:
+        self.assertEqual(threading.active_count(), threads)
+
+if __name__ == '__main__':
+    unittest.main()
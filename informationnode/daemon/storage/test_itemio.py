@@ -0,0 +1,112 @@
+'''
+information-node - an advanced tool for data synchronization
+Copyright (C) 2015  Information Node Development Team (see AUTHORS.md)
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 2 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+
+import io
+import random
+import unittest
+
+from informationnode.daemon.storage.itemio import open_content
+
+class MemoryContent(object):
+    """ In-memory stand-in for an ItemChunkManager. """
+    def __init__(self, chunk_size, data=b""):
+        self.chunk_size = chunk_size
+        self.contents_finalized = False
+        self.chunks = dict()
+        self.stores = 0
+        for start in range(0, len(data), chunk_size):
+            self.chunks[len(self.chunks)] = data[start:start + chunk_size]
+
+    def content_chunk_lengths(self):
+        return [len(self.chunks[i]) for i in range(len(self.chunks))]
+
+    def content_get_chunk(self, chunk_no):
+        return self.chunks[chunk_no]
+
+    def content_set_chunk(self, chunk_no, data):
+        self.stores += 1
+        self.chunks[chunk_no] = data
+
+    def crop_chunks(self, chunk_amount):
+        for chunk_no in list(self.chunks.keys()):
+            if chunk_no >= chunk_amount:
+                del(self.chunks[chunk_no])
+
+    def data(self):
+        return b"".join([self.chunks[i] for i in range(len(self.chunks))])
+
+class TestItemIO(unittest.TestCase):
+    def test_read_and_seek(self):
+        data = bytes([i % 251 for i in range(10000)])
+        content = MemoryContent(1000, data)
+        f = open_content(content)
+        self.assertEqual(f.read(), data)
+        f.seek(4321)
+        self.assertEqual(f.read(2000), data[4321:6321])
+        f.seek(-10, io.SEEK_END)
+        self.assertEqual(f.read(), data[-10:])
+        buf = bytearray(2500)
+        f.seek(0)
+        self.assertEqual(f.readinto(buf), 2500)
+        self.assertEqual(bytes(buf), data[:2500])
+        self.assertRaises(io.UnsupportedOperation, f.write, b"x")
+        f.close()
+
+    def test_sequential_writes_store_chunks_once(self):
+        content = MemoryContent(1000)
+        f = open_content(content, "wb")
+        for i in range(100):
+            f.write(("%099d\n" % i).encode("ascii"))
+        f.close()
+        self.assertEqual(content.data(), b"".join([("%099d\n" % i).encode(
+            "ascii") for i in range(100)]))
+        self.assertEqual(content.content_chunk_lengths(), [1000] * 10)
+        self.assertEqual(content.stores, 10)
+
+    def test_random_operations(self):
+        rng = random.Random(3)
+        initial = bytes([rng.getrandbits(8) for i in range(5000)])
+        content = MemoryContent(700, initial)
+        f = open_content(content, "r+b")
+        reference = io.BytesIO(initial)
+        for i in range(300):
+            operation = rng.choice(["read", "write", "seek", "truncate"])
+            if operation == "read":
+                amount = rng.randint(0, 2000)
+                self.assertEqual(f.read(amount), reference.read(amount))
+            elif operation == "write":
+                data = bytes([rng.getrandbits(8) for i in range(
+                    rng.randint(1, 1500))])
+                f.write(data)
+                reference.write(data)
+            elif operation == "seek":
+                pos = rng.randint(0, len(reference.getvalue()) + 100)
+                f.seek(pos)
+                reference.seek(pos)
+            elif rng.random() < 0.2:
+                size = rng.randint(0, len(reference.getvalue()) + 500)
+                f.truncate(size)
+                reference.truncate(size)
+            self.assertEqual(f.tell(), reference.tell())
+        f.close()
+        self.assertEqual(content.data(), reference.getvalue())
+        self.assertTrue(max(content.content_chunk_lengths()) <= 700)
+
+if __name__ == '__main__':
+    unittest.main()
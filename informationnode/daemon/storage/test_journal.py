@@ -0,0 +1,94 @@
+'''
+information-node - an advanced tool for data synchronization
+Copyright (C) 2015  Information Node Development Team (see AUTHORS.md)
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 2 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from informationnode.daemon.storage.chunkstore import ChunkStore
+from informationnode.daemon.storage.drivers import create_storage
+
+class TestJournal(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        create_storage(self.path, "packfile")
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def crash(self, store):
+        """ Stop using the store without closing it properly. """
+        os.close(store.journal.fd)
+        store.db.close()
+        store.driver.close()
+
+    def save(self, store, item_id, chunks):
+        hashes = store.put_many(chunks)
+        store.commit_version(item_id, 1, {"chunk_hashes" : hashes})
+        return hashes
+
+    def test_group_commit(self):
+        store = ChunkStore(self.path, use_journal=True)
+        threads = [threading.Thread(target=self.save, args=(store,
+            "item%d" % i, [("data %d" % i).encode("ascii"),
+            b"shared"])) for i in range(40)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        stats = store.journal.stats()
+        self.assertEqual(stats["commits"], 40)
+        self.assertTrue(stats["fsyncs"] <= 40)
+        self.assertEqual(store.refcount(store.chunk_hash(b"shared")), 40)
+        store.close()
+        self.assertFalse(os.path.exists(os.path.join(self.path,
+            "journal.log")))
+
+        store = ChunkStore(self.path, use_journal=True)
+        self.assertEqual(store.recovered_items, [])
+        self.assertEqual(len(store.driver.list_items()), 40)
+        store.close()
+
+    def test_recovery(self):
+        store = ChunkStore(self.path, use_journal=True)
+        saved = self.save(store, "saved", [b"a", b"b"])
+        # a save that made it into the journal, but not into the storage:
+        hashes = store.put_many([b"b", b"c"])
+        store.journal._append({"type" : "commit", "item_id" : "journaled",
+            "version" : 1, "record" : {"chunk_hashes" : hashes}})
+        # a version that was never finished:
+        store.begin_version("unfinished", 1)
+        store.put_many([b"d", b"a"])
+        os.fsync(store.journal.fd)
+        self.crash(store)
+
+        store = ChunkStore(self.path, use_journal=True)
+        self.assertEqual(store.recovered_items, ["journaled", "saved"])
+        self.assertEqual(store.driver.read_version("journaled", 1)[
+            "chunk_hashes"], hashes)
+        self.assertEqual([store.refcount(store.chunk_hash(data)) for data in \
+            [b"a", b"b", b"c", b"d"]], [1, 2, 1, 0])
+        self.assertFalse(store.driver.has_chunk(store.chunk_hash(b"d")))
+        self.assertEqual(store.get(saved[0]), b"a")
+        store.close()
+
+if __name__ == '__main__':
+    unittest.main()
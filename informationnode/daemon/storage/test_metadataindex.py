@@ -0,0 +1,119 @@
+'''
+information-node - an advanced tool for data synchronization
+Copyright (C) 2015  Information Node Development Team (see AUTHORS.md)
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 2 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+
+
+import shutil
+import tempfile
+import unittest
+
+from informationnode.daemon.storage.drivers import PackfileStorageDriver
+from informationnode.daemon.storage.metadataindex import MetadataIndex
+
+class TestMetadataIndex(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.index = MetadataIndex(self.path)
+        for i in range(50):
+            self.index.update_from_record("item%02d" % i, 1, {
+                "mime_type" : ("text/plain" if i % 2 == 0 else "image/png"),
+                "classification" : "file",
+                "creation_time" : "2015-01-%02dT10:00:00" % (i % 28 + 1),
+                "modification_time" : "2015-02-01T10:00:%02d" % (59 - i),
+                "tags" : (["even"] if i % 2 == 0 else [])})
+
+    def tearDown(self):
+        self.index.close()
+        shutil.rmtree(self.path)
+
+    def test_lookup(self):
+        info = self.index.get("item04")
+        self.assertEqual(info["mime_type"], "text/plain")
+        self.assertEqual(info["tags"], ["even"])
+        self.index.update_from_record("item04", 2, {"mime_type" : "a/b"})
+        info = self.index.get("item04")
+        self.assertEqual((info["content_version"], info["mime_type"],
+            info["tags"]), (2, "a/b", []))
+        self.index.remove_item("item04")
+        self.assertEqual(self.index.get("item04"), None)
+
+    def test_pagination(self):
+        found = []
+        cursor = None
+        while True:
+            (items, cursor) = self.index.query(
+                equals={"mime_type" : "image/png"},
+                order_by="modification_time", after=cursor, limit=7)
+            found += items
+            if cursor == None:
+                break
+        self.assertEqual(len(found), 25)
+        times = [item["modification_time"] for item in found]
+        self.assertEqual(times, sorted(times))
+
+        (items, cursor) = self.index.query(order_by="item_id",
+            descending=True, limit=3)
+        self.assertEqual([i["item_id"] for i in items],
+            ["item49", "item48", "item47"])
+        (items, cursor) = self.index.query(order_by="item_id",
+            descending=True, after=cursor, limit=1)
+        self.assertEqual(items[0]["item_id"], "item46")
+
+    def test_pagination_over_equal_and_missing_values(self):
+        for i in range(10):
+            self.index.update_from_record("item%02d" % i, 2, {})
+        for descending in [False, True]:
+            found = []
+            cursor = None
+            while True:
+                (items, cursor) = self.index.query(order_by="mime_type",
+                    descending=descending, after=cursor, limit=4)
+                found += [(i["mime_type"] or "", i["item_id"]) for i in items]
+                if cursor == None:
+                    break
+            self.assertEqual(found, sorted(found, reverse=descending))
+            self.assertEqual(len(found), 50)
+
+    def test_ordinals(self):
+        ordinals = set([self.index.item_ordinal("item%02d" % i) for i in \
+            [3, 5, 8]])
+        (items, unused) = self.index.query(ordinals=ordinals)
+        self.assertEqual([i["item_id"] for i in items],
+            ["item03", "item05", "item08"])
+        (items, unused) = self.index.query(ordinals=set())
+        self.assertEqual(items, [])
+
+    def test_ranges_and_tags(self):
+        (items, unused) = self.index.query(ranges={"creation_time" : \
+            ("2015-01-02", "2015-01-04")}, tag="even")
+        self.assertEqual(sorted([i["item_id"] for i in items]),
+            ["item02", "item30"])
+        self.assertRaises(ValueError, self.index.query,
+            equals={"nonsense" : 1})
+
+    def test_rebuild(self):
+        driver = PackfileStorageDriver(self.path)
+        driver.write_version("a", 1, {"mime_type" : "x/y"})
+        driver.write_version("a", 2, {"mime_type" : "x/z"})
+        self.index.rebuild(driver)
+        driver.close()
+        self.assertEqual(self.index.get("a")["mime_type"], "x/z")
+        self.assertEqual(self.index.item_count(), 51)
+
+if __name__ == '__main__':
+    unittest.main()
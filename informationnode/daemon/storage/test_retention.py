@@ -0,0 +1,133 @@
+'''
+information-node - an advanced tool for data synchronization
+Copyright (C) 2015  Information Node Development Team (see AUTHORS.md)
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 2 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+
+import datetime
+import os
+import shutil
+import tempfile
+import unittest
+
+from informationnode.daemon.storage.chunkstore import ChunkStore
+from informationnode.daemon.storage.drivers import create_storage
+from informationnode.daemon.storage.retention import RetentionPolicy, \
+    prune_versions
+
+class TestRetention(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        create_storage(self.path, "packfile")
+        self.store = ChunkStore(self.path, use_journal=True)
+        self.now = datetime.datetime(2020, 6, 1)
+
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(self.path)
+
+    def save_versions(self, item_id, count):
+        """ Save versions which differ in their last chunk only, like
+            copy-on-write versions of a file that is appended to, with one
+            version per day.
+        """
+        hashes = self.store.put_many([b"shared 1", b"shared 2"])
+        for version in range(1, count + 1):
+            if version > 1:
+                self.store.add_ref(hashes)
+            data = ("change %d" % version).encode("ascii")
+            (changed,) = self.store.put_many([data])
+            modified = self.now - datetime.timedelta(days=count - version)
+            self.store.commit_version(item_id, version, {
+                "chunk_hashes" : hashes + [changed],
+                "modification_time" : modified.isoformat()})
+
+    def test_policy(self):
+        versions = [1, 2, 3, 4, 5]
+        times = dict([(v, self.now - datetime.timedelta(days=5 - v)) \
+            for v in versions])
+        self.assertEqual(RetentionPolicy().versions_to_prune(versions,
+            times, now=self.now), [])
+        self.assertEqual(RetentionPolicy(keep_versions=2).versions_to_prune(
+            versions, times, now=self.now), [1, 2, 3])
+        self.assertEqual(RetentionPolicy(keep_days=2).versions_to_prune(
+            versions, times, now=self.now), [1, 2])
+        # the latest version is kept even if it is old:
+        self.assertEqual(RetentionPolicy(keep_days=0).versions_to_prune(
+            versions, times, now=self.now + datetime.timedelta(days=9)),
+            [1, 2, 3, 4])
+        # versions without a time are only limited by count:
+        times[1] = None
+        self.assertEqual(RetentionPolicy(keep_days=2).versions_to_prune(
+            versions, times, now=self.now), [2])
+        with self.assertRaises(ValueError):
+            RetentionPolicy(keep_versions=0)
+
+    def test_prune_keeps_shared_chunks(self):
+        self.save_versions("item", 4)
+        shared = self.store.chunk_hash(b"shared 1")
+        self.assertEqual(self.store.refcount(shared), 4)
+
+        pruned = prune_versions(self.store, "item",
+            RetentionPolicy(keep_versions=2), now=self.now)
+        self.assertEqual(pruned, [1, 2])
+        self.assertEqual(self.store.driver.list_versions("item"), [3, 4])
+        self.assertEqual(self.store.refcount(shared), 2)
+        self.assertEqual(self.store.get(shared), b"shared 1")
+        # only the chunks the pruned versions had for themselves are gone:
+        self.assertEqual(self.store.refcount(self.store.chunk_hash(
+            b"change 1")), 0)
+        self.assertFalse(self.store.driver.has_chunk(self.store.chunk_hash(
+            b"change 2")))
+        self.assertEqual(self.store.stats()["chunk_count"], 4)
+
+    def test_prune_while_reading(self):
+        self.save_versions("item", 1)
+        lease = self.store.lease_version("item", 1)
+        record = self.store.driver.read_version("item", 1)
+        hashes = self.store.put_many([b"shared 1", b"shared 2", b"new"])
+        self.store.commit_version("item", 2, {"chunk_hashes" : hashes})
+        self.assertEqual(prune_versions(self.store, "item",
+            RetentionPolicy(keep_versions=1)), [1])
+        self.assertEqual(self.store.driver.list_versions("item"), [2])
+        # the reader of version 1 can still read all of its chunks:
+        changed = record["chunk_hashes"][-1]
+        self.assertEqual(self.store.get(changed), b"change 1")
+        for chunk_hash in record["chunk_hashes"]:
+            self.store.get(chunk_hash)
+        lease.release()
+        self.assertFalse(self.store.driver.has_chunk(changed))
+        self.assertEqual(self.store.refcount(self.store.chunk_hash(
+            b"shared 1")), 1)
+
+    def test_pruned_version_not_recovered(self):
+        self.save_versions("item", 3)
+        prune_versions(self.store, "item", RetentionPolicy(keep_versions=1))
+        # crash while the commits of the pruned versions are still in the
+        # journal:
+        os.close(self.store.journal.fd)
+        self.store.db.close()
+        self.store.driver.close()
+
+        self.store = ChunkStore(self.path, use_journal=True)
+        self.assertEqual(self.store.driver.list_versions("item"), [3])
+        self.assertEqual(self.store.refcount(self.store.chunk_hash(
+            b"shared 1")), 1)
+        self.assertEqual(self.store.refcount(self.store.chunk_hash(
+            b"change 1")), 0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,111 @@
+'''
+information-node - an advanced tool for data synchronization
+Copyright (C) 2015  Information Node Development Team (see AUTHORS.md)
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 2 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+
+import random
+import shutil
+import tempfile
+import unittest
+
+from informationnode.daemon.storage.bitmap import RoaringBitmap
+from informationnode.daemon.storage.metadataindex import MetadataIndex
+from informationnode.daemon.storage.tagindex import TagIndex
+
+class TestRoaringBitmap(unittest.TestCase):
+    def test_set_operations(self):
+        rng = random.Random(4)
+        # one sparse and one dense container each, plus a shared one:
+        a = set(rng.sample(range(0, 200000), 3000)) | set(range(70000, 80000))
+        b = set(rng.sample(range(0, 200000), 3000)) | set(range(75000, 76000))
+        (bitmap_a, bitmap_b) = (RoaringBitmap(a), RoaringBitmap(b))
+        self.assertEqual(len(bitmap_a), len(a))
+        self.assertEqual(list(bitmap_a | bitmap_b), sorted(a | b))
+        self.assertEqual(list(bitmap_a & bitmap_b), sorted(a & b))
+        self.assertEqual(list(bitmap_a - bitmap_b), sorted(a - b))
+        self.assertTrue(isinstance(bitmap_a.containers[1], int))
+
+        for value in range(70000, 79000):
+            bitmap_a.discard(value)
+            a.discard(value)
+        self.assertFalse(isinstance(bitmap_a.containers[1], int))
+        self.assertEqual(list(bitmap_a), sorted(a))
+        self.assertTrue(min(a) in bitmap_a)
+        self.assertFalse(200001 in bitmap_a)
+
+        restored = RoaringBitmap.from_bytes((bitmap_a | bitmap_b).to_bytes())
+        self.assertEqual(restored, bitmap_a | bitmap_b)
+
+class TestTagIndex(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def open(self):
+        tag_index = TagIndex(self.path)
+        return (MetadataIndex(self.path, tag_index=tag_index), tag_index)
+
+    def ordinals(self, index, item_ids):
+        return sorted([index.item_ordinal(item_id) for item_id in item_ids])
+
+    def test_incremental_updates(self):
+        (index, tag_index) = self.open()
+        for i in range(30):
+            tags = ["all"]
+            if i % 2 == 0:
+                tags.append("even")
+            if i % 3 == 0:
+                tags.append("three")
+            index.update_from_record("item%02d" % i, 1, {"tags" : tags})
+        self.assertEqual(list(tag_index.items_with_all(["even", "three"])),
+            self.ordinals(index, ["item%02d" % i for i in range(0, 30, 6)]))
+        self.assertEqual(len(tag_index.items_with_any(["even", "three"])), 20)
+        self.assertEqual(len(tag_index.items_with_all(["even", "none"])), 0)
+
+        index.update_from_record("item00", 2, {"tags" : ["all"]})
+        index.remove_item("item06")
+        self.assertEqual(list(tag_index.items_with_all(["even", "three"])),
+            self.ordinals(index, ["item12", "item18", "item24"]))
+        ordinal = index.item_ordinal("item01")
+        self.assertTrue(tag_index.item_has_any(ordinal, ["x", "all"]))
+        self.assertFalse(tag_index.item_has_any(ordinal, ["even"]))
+
+        (items, cursor) = index.query(ordinals=tag_index.items_with_tag(
+            "three"), limit=2)
+        self.assertEqual([i["item_id"] for i in items], ["item03", "item09"])
+        index.close()
+        tag_index.close()
+
+        # reopened from the flushed bitmaps:
+        (index, tag_index) = self.open()
+        self.assertFalse(tag_index.needs_rebuild)
+        self.assertEqual(len(tag_index.items_with_tag("all")), 29)
+
+        # changes that weren't flushed are rebuilt from the metadata index:
+        index.update_from_record("item01", 2, {"tags" : ["new"]})
+        index.close()
+        (index, tag_index) = self.open()
+        self.assertEqual(list(tag_index.items_with_tag("new")),
+            [index.item_ordinal("item01")])
+        self.assertEqual(len(tag_index.items_with_tag("all")), 28)
+        index.close()
+        tag_index.close()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,93 @@
+'''
+information-node - an advanced tool for data synchronization
+Copyright (C) 2015  Information Node Development Team (see AUTHORS.md)
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 2 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+
+import logging
+import threading
+
+class StorageTransaction(object):
+    """ Collects storage writes so they are either all applied, or none of
+        them.
+
+        A write is given as an apply function and an optional undo
+        function. Nothing is written before commit(). If applying a write
+        fails during commit(), the writes applied before are undone in
+        reverse order and the error is raised again.
+    """
+    def __init__(self):
+        self.writes = []
+        self.done = False
+
+    def add(self, apply_func, undo_func=None):
+        if self.done:
+            raise RuntimeError("transaction is already done")
+        self.writes.append((apply_func, undo_func))
+
+    def commit(self):
+        if self.done:
+            raise RuntimeError("transaction is already done")
+        self.done = True
+        applied = []
+        try:
+            for (apply_func, undo_func) in self.writes:
+                apply_func()
+                applied.append(undo_func)
+        except Exception:
+            for undo_func in reversed(applied):
+                if undo_func == None:
+                    continue
+                try:
+                    undo_func()
+                except Exception as e:
+                    logging.exception("failed to undo write of aborted " +\
+                        "transaction: " + str(e))
+            raise
+
+    def abort(self):
+        self.done = True
+        self.writes = []
+
+class StorageWriter(object):
+    """ Applies storage writes right away, unless the current thread has a
+        StorageTransaction running - then the write is added to it instead.
+    """
+    def __init__(self):
+        self._state = threading.local()
+
+    def current_transaction(self):
+        return getattr(self._state, "transaction", None)
+
+    def begin(self):
+        """ Start a transaction for the current thread and return it. """
+        if self.current_transaction() != None:
+            raise RuntimeError("a transaction is already running")
+        self._state.transaction = StorageTransaction()
+        return self._state.transaction
+
+    def end(self):
+        """ Detach the current thread's transaction without committing or
+            aborting it.
+        """
+        self._state.transaction = None
+
+    def write(self, apply_func, undo_func=None):
+        transaction = self.current_transaction()
+        if transaction == None:
+            apply_func()
+            return
+        transaction.add(apply_func, undo_func)
@@ -0,0 +1,247 @@
+'''
+information-node - an advanced tool for data synchronization
+Copyright (C) 2015  Information Node Development Team (see AUTHORS.md)
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 2 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+
+import collections
+import itertools
+import logging
+import threading
+
+from informationnode.daemon.apiserver import make_response
+
+class StreamTransfer(object):
+    """ State of one streamed upload or download of item contents. """
+    def __init__(self, stream_id, client, item_id, content, direction):
+        self.stream_id = stream_id
+        self.client = client
+        self.item_id = item_id
+        self.content = content
+        self.direction = direction
+        self.next_chunk = 0
+        self.chunks_received = 0
+
+class StreamTransfers(object):
+    """ Streams item contents of any size over the api socket in slices
+        that line up with the item's chunks, so neither side needs to hold
+        more than a few chunks in memory. This requires binary framing.
+
+        Upload:
+          1. client sends {"action" : "stream-upload", "item_id" : ...},
+             the response carries the "stream_id", the "chunk_size" and the
+             "window"
+          2. client sends {"action" : "stream-data", "stream_id" : ...,
+             "item_id" : ..., "chunk_no" : ...} frames with one chunk of data
+             attached each. Each one is answered with a "stream-ack", and
+             the client may only have "window" unacknowledged ones
+          3. client sends {"action" : "stream-end", "stream_id" : ...,
+             "item_id" : ..., "chunk_count" : ...} to finish the upload
+
+        Download:
+          1. client sends {"action" : "stream-download", "item_id" : ...},
+             the response carries the "stream_id", "chunk_size",
+             "chunk_count" and "window"
+          2. the data server sends up to "window" stream-data frames, and
+             another one for each chunk acknowledged by the client with
+             {"action" : "stream-ack", "stream_id" : ..., "item_id" : ...,
+             "count" : ...}
+          3. the data server sends {"action" : "stream-end", ...} after the
+             last chunk
+
+        All stream requests need to carry the "item_id", so they are
+        processed in order by the same internal api worker.
+
+        open_content(item_id, writable) is used to get the item contents,
+        which need to provide the ItemChunkManager interface. If given,
+        on_saved(item_id) is called after an upload was saved. An upload
+        that is aborted or whose client disconnects before "stream-end" is
+        discarded.
+    """
+    # how many finished downloads are remembered, so the client's last
+    # acks for them can be ignored:
+    FINISHED_DOWNLOADS = 1024
+
+    def __init__(self, open_content, window=8, on_saved=None):
+        self.open_content = open_content
+        self.on_saved = on_saved
+        self.window = window
+        self.streams = dict()
+        self.finished_downloads = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self._stream_ids = itertools.count(1)
+
+    def register_actions(self, actions):
+        """ Register the stream actions in the given internal api actions
+            dict.
+        """
+        actions["stream-upload"] = self.stream_upload
+        actions["stream-download"] = self.stream_download
+        actions["stream-data"] = self.stream_data
+        actions["stream-ack"] = self.stream_ack
+        actions["stream-end"] = self.stream_end
+
+    def stream_count(self):
+        with self.lock:
+            return len(self.streams)
+
+    def _add_stream(self, client, msg, content, direction):
+        stream = StreamTransfer(next(self._stream_ids), client,
+            msg["item_id"], content, direction)
+        with self.lock:
+            self.streams[stream.stream_id] = stream
+        client.add_close_callback(lambda: self._drop_stream(stream))
+        return stream
+
+    def _drop_stream(self, stream, finished=False):
+        """ Forget a stream. An upload which isn't finished is discarded.
+        """
+        with self.lock:
+            if not stream.stream_id in self.streams:
+                return
+            del(self.streams[stream.stream_id])
+            if finished and stream.direction == "download":
+                self.finished_downloads[stream.stream_id] = stream.client
+                if len(self.finished_downloads) > self.FINISHED_DOWNLOADS:
+                    self.finished_downloads.popitem(last=False)
+        if stream.direction == "download":
+            if hasattr(stream.content, "close"):
+                # the content version may be pruned again:
+                stream.content.close()
+        elif not finished and hasattr(stream.content, "discard"):
+            # releases what the unsaved content version holds in storage:
+            stream.content.discard()
+
+    def _get_stream(self, client, msg, direction):
+        """ Returns (stream, None) or (None, error_response). """
+        with self.lock:
+            stream = self.streams.get(msg.get("stream_id", None), None)
+        if stream == None or stream.client != client or \
+                stream.direction != direction:
+            return (None, make_response(msg, "error",
+                error_info="no such " + direction + " stream"))
+        return (stream, None)
+
+    def _check_request(self, client, msg):
+        """ Returns an error response if the stream can't be started. """
+        if client.framing != "binary":
+            return make_response(msg, "error",
+                error_info="streaming requires binary framing")
+        if msg.get("item_id", None) == None:
+            return make_response(msg, "error",
+                error_info="no item_id specified")
+        return None
+
+    def stream_upload(self, client, msg, data):
+        error = self._check_request(client, msg)
+        if error != None:
+            return error
+        try:
+            content = self.open_content(msg["item_id"], True)
+        except (RuntimeError, ValueError) as e:
+            return make_response(msg, "error", error_info=str(e))
+        stream = self._add_stream(client, msg, content, "upload")
+        return make_response(msg, stream_id=stream.stream_id,
+            chunk_size=content.chunk_size, window=self.window)
+
+    def stream_data(self, client, msg, data):
+        (stream, error) = self._get_stream(client, msg, "upload")
+        if error != None:
+            return error
+        chunk_no = msg.get("chunk_no", None)
+        if not isinstance(chunk_no, int) or chunk_no < 0 or data == None or \
+                len(data) > stream.content.chunk_size:
+            self._drop_stream(stream)
+            return make_response(msg, "error",
+                error_info="invalid chunk, stream aborted")
+        stream.content.content_set_chunk(chunk_no, bytes(data))
+        stream.chunks_received += 1
+        return make_response(msg, "stream-ack",
+            stream_id=stream.stream_id, chunk_no=chunk_no)
+
+    def stream_download(self, client, msg, data):
+        error = self._check_request(client, msg)
+        if error != None:
+            return error
+        try:
+            content = self.open_content(msg["item_id"], False)
+        except (RuntimeError, ValueError) as e:
+            return make_response(msg, "error", error_info=str(e))
+        stream = self._add_stream(client, msg, content, "download")
+        stream.next_chunk = max(0, int(msg.get("from_chunk", 0)))
+        client.respond(make_response(msg, stream_id=stream.stream_id,
+            chunk_size=content.chunk_size,
+            chunk_count=content.content_chunk_count(),
+            window=self.window))
+        self._send_chunks(stream, self.window)
+        return None
+
+    def stream_ack(self, client, msg, data):
+        (stream, error) = self._get_stream(client, msg, "download")
+        if error != None:
+            with self.lock:
+                if self.finished_downloads.get(msg.get("stream_id", None),
+                        None) == client:
+                    # acks for the last chunks may arrive after the end.
+                    return None
+            return error
+        self._send_chunks(stream, max(0, int(msg.get("count", 1))))
+        return None
+
+    def _send_chunks(self, stream, amount):
+        """ Send up to the given amount of chunks of a download stream, and
+            the end of the stream once all are sent.
+        """
+        chunk_count = stream.content.content_chunk_count()
+        # send views of the stored chunks where possible, so the data isn't
+        # copied on its way to the socket:
+        get_chunk = getattr(stream.content, "content_get_chunk_view",
+            stream.content.content_get_chunk)
+        while amount > 0 and stream.next_chunk < chunk_count:
+            data = get_chunk(stream.next_chunk)
+            if not stream.client.respond({"action" : "stream-data",
+                    "stream_id" : stream.stream_id,
+                    "chunk_no" : stream.next_chunk}, data):
+                self._drop_stream(stream)
+                return
+            stream.next_chunk += 1
+            amount -= 1
+        if stream.next_chunk >= chunk_count:
+            stream.client.respond({"action" : "stream-end",
+                "stream_id" : stream.stream_id,
+                "chunk_count" : chunk_count})
+            self._drop_stream(stream, finished=True)
+
+    def stream_end(self, client, msg, data):
+        (stream, error) = self._get_stream(client, msg, "upload")
+        if error != None:
+            return error
+        self._drop_stream(stream, finished=True)
+        try:
+            if isinstance(msg.get("chunk_count", None), int):
+                stream.content.crop_chunks(msg["chunk_count"])
+            stream.content.save()
+        except (RuntimeError, ValueError) as e:
+            logging.error("failed to save streamed upload of item " +\
+                str(stream.item_id) + ": " + str(e))
+            if hasattr(stream.content, "discard") and \
+                    not stream.content.contents_finalized:
+                stream.content.discard()
+            return make_response(msg, "error", error_info=str(e))
+        if self.on_saved != None:
+            self.on_saved(stream.item_id)
+        return make_response(msg, stream_id=stream.stream_id,
+            chunks_received=stream.chunks_received)
@@ -0,0 +1,144 @@
+'''
+information-node - an advanced tool for data synchronization
+Copyright (C) 2015  Information Node Development Team (see AUTHORS.md)
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 2 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
+import unittest
+
+from informationnode.daemon.apiserver import FileSocketApiServer, \
+    make_response
+from informationnode.helper import send_json, recv_json, send_frame, \
+    FrameReader, negotiate_framing
+
+class FakeDaemon(object):
+    def __init__(self):
+        self.terminated = False
+        self.api_server = None
+
+    def terminate(self):
+        self.terminated = True
+        self.api_server.terminate()
+
+    def queue_internal_request(self, client, msg, data=None):
+        # answer "sleep" requests after the given delay from another thread,
+        # and echo back attached data:
+        def process():
+            time.sleep(msg.get("delay", 0))
+            client.respond(make_response(msg), data)
+            client.request_done()
+        threading.Thread(target=process).start()
+        return (True, None)
+
+    def api_retry_after_ms(self, msg):
+        return 50
+
+class FileSocketApiServerTest(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.sock_path = os.path.join(self.temp_dir, "api_access.sock")
+        api_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        api_socket.bind(self.sock_path)
+        self.daemon = FakeDaemon()
+        self.server = FileSocketApiServer(self.daemon, api_socket)
+        self.daemon.api_server = self.server
+        self.thread = threading.Thread(target=self.server.run)
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.terminate()
+        self.thread.join(5.0)
+        self.server.api_socket.close()
+        shutil.rmtree(self.temp_dir)
+
+    def connect(self):
+        s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        s.settimeout(5.0)
+        s.connect(self.sock_path)
+        return s
+
+    def test_many_clients_one_thread(self):
+        threads_before = threading.active_count()
+        clients = [self.connect() for i in range(50)]
+        for s in clients:
+            self.assertTrue(send_json(s, {"action" : "ping"}))
+        for s in clients:
+            self.assertEqual(recv_json(s), {"action" : "pong"})
+        self.assertEqual(threading.active_count(), threads_before)
+
+        # closed clients are reaped without waiting for a new connection:
+        for s in clients:
+            s.close()
+        for i in range(100):
+            if self.server.client_count() == 0:
+                break
+            time.sleep(0.02)
+        self.assertEqual(self.server.client_count(), 0)
+
+    def test_pipelining(self):
+        s = self.connect()
+        send_json(s, {"action" : "sleep", "delay" : 0.3, "request_id" : 1})
+        send_json(s, {"action" : "sleep", "delay" : 0.0, "request_id" : 2})
+        send_json(s, {"action" : "ping", "request_id" : "p"})
+
+        # responses arrive as they are done, not in request order:
+        ids = [recv_json(s)["request_id"] for i in range(3)]
+        self.assertEqual(sorted(ids[:2], key=str), [2, "p"])
+        self.assertEqual(ids[2], 1)
+        s.close()
+
+    def test_binary_framing(self):
+        s = self.connect()
+        self.assertTrue(negotiate_framing(s, "binary"))
+        reader = FrameReader(s)
+        payload = bytes(range(256)) * 1000
+        self.assertTrue(send_frame(s, {"action" : "sleep"}, payload))
+        (msg, data) = reader.recv()
+        self.assertEqual(msg["response_type"], "success")
+        self.assertEqual(bytes(data), payload)
+        self.assertTrue(send_frame(s, {"action" : "ping"}))
+        self.assertEqual(reader.recv(), ({"action" : "pong"}, None))
+        s.close()
+
+    def test_in_flight_limit(self):
+        self.server.max_in_flight = 2
+        s = self.connect()
+        for i in range(3):
+            send_json(s, {"action" : "sleep", "delay" : 0.2,
+                "request_id" : i})
+        response = recv_json(s)
+        self.assertEqual(response["request_id"], 2)
+        self.assertEqual(response["response_type"], "busy")
+        self.assertEqual(response["retry_after_ms"], 50)
+        self.assertEqual(sorted([recv_json(s)["request_id"] \
+            for i in range(2)]), [0, 1])
+        s.close()
+
+    def test_shutdown(self):
+        s = self.connect()
+        send_json(s, {"action" : "shutdown"})
+        response = recv_json(s)
+        self.assertEqual(response["response_type"], "success")
+        self.thread.join(5.0)
+        self.assertFalse(self.thread.is_alive())
+        self.assertTrue(self.daemon.terminated)
+        s.close()
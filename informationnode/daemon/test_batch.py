@@ -0,0 +1,189 @@
+'''
+information-node - an advanced tool for data synchronization
+Copyright (C) 2015  Information Node Development Team (see AUTHORS.md)
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 2 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from informationnode.daemon.apiserver import make_response
+from informationnode.daemon.batch import BatchAction
+from informationnode.daemon.permissions import PeerPermissions
+from informationnode.daemon.storage.metadataindex import MetadataIndex
+from informationnode.daemon.storage.tagindex import TagIndex
+from informationnode.daemon.storage.transaction import StorageWriter, \
+    StorageTransaction
+
+class FakeClient(object):
+    framing = "json"
+
+    def add_close_callback(self, func):
+        pass
+
+class BatchDaemon(object):
+    """ Has a "set" action that stores a value through the storage writer,
+        and a "fail" action that always fails.
+    """
+    def __init__(self):
+        self.values = dict()
+        self.storage_writer = StorageWriter()
+        self.actions = {"set" : self.action_set, "fail" : self.action_fail}
+        self.batch = BatchAction(self, max_requests=10,
+            atomic_actions=(BatchAction.ATOMIC + ["set", "fail"]))
+        self.batch.register_actions(self.actions)
+
+    def process_internal_msg(self, client, msg, data=None):
+        if not msg["action"] in self.actions:
+            return make_response(msg, "error", error_info="unknown action")
+        return self.actions[msg["action"]](client, msg, data)
+
+    def action_set(self, client, msg, data):
+        key = msg["key"]
+        old_value = self.values.get(key, None)
+        def apply():
+            self.values[key] = msg["value"]
+        def undo():
+            self.values[key] = old_value
+        self.storage_writer.write(apply, undo)
+        return make_response(msg)
+
+    def action_fail(self, client, msg, data):
+        return make_response(msg, "error", error_info="failed")
+
+class TestBatch(unittest.TestCase):
+    def setUp(self):
+        self.daemon = BatchDaemon()
+
+    def run_batch(self, requests, atomic=False, data=None):
+        msg = {"action" : "batch", "request_id" : 1, "atomic" : atomic}
+        if requests != None:
+            msg["requests"] = requests
+        return self.daemon.process_internal_msg(FakeClient(), msg, data)
+
+    def test_results_in_order(self):
+        response = self.run_batch([
+            {"action" : "set", "key" : "a", "value" : 1, "request_id" : 1},
+            {"action" : "fail", "request_id" : 2},
+            {"action" : "set", "key" : "b", "value" : 2, "request_id" : 3},
+            {"action" : "batch", "requests" : []}])
+        self.assertEqual(response["response_type"], "success")
+        self.assertEqual(response["request_id"], 1)
+        self.assertEqual([r["response_type"] for r in response["results"]],
+            ["success", "error", "success", "error"])
+        self.assertEqual([r.get("request_id", None) for r in \
+            response["results"]], [1, 2, 3, None])
+        # not atomic, so the writes of the successful requests are done:
+        self.assertEqual(self.daemon.values, {"a" : 1, "b" : 2})
+
+    def test_atomic(self):
+        response = self.run_batch([
+            {"action" : "set", "key" : "a", "value" : 1},
+            {"action" : "fail"}], atomic=True)
+        self.assertEqual(response["response_type"], "error")
+        self.assertEqual(response["committed"], False)
+        self.assertEqual(self.daemon.values, {})
+
+        response = self.run_batch([
+            {"action" : "set", "key" : "a", "value" : 1},
+            {"action" : "set", "key" : "b", "value" : 2}], atomic=True)
+        self.assertEqual(response["committed"], True)
+        self.assertEqual(self.daemon.values, {"a" : 1, "b" : 2})
+        self.assertEqual(self.daemon.storage_writer.current_transaction(),
+            None)
+
+    def test_requests_as_data(self):
+        data = json.dumps([{"action" : "set", "key" : "a",
+            "value" : 3}]).encode("utf-8")
+        response = self.run_batch(None, data=memoryview(data))
+        self.assertEqual(response["response_type"], "success")
+        self.assertEqual(self.daemon.values, {"a" : 3})
+
+        response = self.run_batch([{"action" : "fail"}] * 11)
+        self.assertEqual(response["response_type"], "error")
+
+    def test_commit_failure_undoes_writes(self):
+        values = []
+        def fail():
+            raise RuntimeError("disk full")
+        transaction = StorageTransaction()
+        transaction.add(lambda: values.append(1), lambda: values.remove(1))
+        transaction.add(fail)
+        self.assertRaises(RuntimeError, transaction.commit)
+        self.assertEqual(values, [])
+
+class TestAtomicPermissions(unittest.TestCase):
+    """ Atomic batches with the real permission actions. """
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.tag_index = TagIndex(self.path)
+        self.index = MetadataIndex(self.path, tag_index=self.tag_index)
+        self.daemon = BatchDaemon()
+        self.permissions = PeerPermissions(self.path, self.tag_index,
+            self.index, storage_writer=self.daemon.storage_writer)
+        self.permissions.register_actions(self.daemon.actions)
+
+    def tearDown(self):
+        self.index.close()
+        self.tag_index.close()
+        shutil.rmtree(self.path)
+
+    def run_batch(self, requests):
+        return self.daemon.process_internal_msg(FakeClient(), {
+            "action" : "batch", "atomic" : True, "requests" : requests})
+
+    def test_failed_batch_changes_nothing(self):
+        response = self.run_batch([
+            {"action" : "allow-read", "fingerprint" : "peer",
+                "tags" : ["photos"]},
+            {"action" : "fail"}])
+        self.assertEqual(response["committed"], False)
+        self.assertEqual(self.permissions.tags("peer", "read"), set())
+        self.assertFalse(os.path.exists(os.path.join(self.path,
+            "permissions.json")))
+
+        response = self.run_batch([
+            {"action" : "allow-read", "fingerprint" : "peer",
+                "tags" : ["photos"]},
+            {"action" : "allow-read", "fingerprint" : "peer",
+                "tags" : ["music"]},
+            {"action" : "revoke-read", "fingerprint" : "peer",
+                "tags" : ["photos"]}])
+        self.assertEqual(response["committed"], True)
+        self.assertEqual(self.permissions.tags("peer", "read"),
+            set(["music"]))
+        reloaded = PeerPermissions(self.path, self.tag_index, self.index)
+        self.assertEqual(reloaded.tags("peer", "read"), set(["music"]))
+
+    def test_actions_without_transactions_refused(self):
+        self.daemon.actions["prune-versions"] = \
+            lambda client, msg, data: make_response(msg)
+        for action in ["prune-versions", "check-permission"]:
+            response = self.run_batch([
+                {"action" : "allow-read", "fingerprint" : "peer",
+                    "tags" : ["photos"]},
+                {"action" : action, "item_id" : "a"}])
+            self.assertEqual(response["response_type"], "error")
+            self.assertEqual(response["committed"], False)
+            self.assertFalse("results" in response)
+        self.assertEqual(self.permissions.tags("peer", "read"), set())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,103 @@
+'''
+information-node - an advanced tool for data synchronization
+Copyright (C) 2015  Information Node Development Team (see AUTHORS.md)
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 2 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+
+
+import threading
+import unittest
+
+from informationnode.daemon.events import EventHub
+from informationnode.daemon.scheduler import Scheduler
+
+class FakeClient(object):
+    def __init__(self):
+        self.sent = []
+        self.close_callbacks = []
+
+    def respond(self, obj, data=None):
+        self.sent.append(obj)
+        return True
+
+    def add_close_callback(self, func):
+        self.close_callbacks.append(func)
+
+class TestEventHub(unittest.TestCase):
+    def setUp(self):
+        self.scheduler = Scheduler()
+        self.thread = threading.Thread(target=self.scheduler.run)
+        self.thread.start()
+        self.hub = EventHub(self.scheduler, coalesce_delay=0.05,
+            max_pending=100)
+        self.actions = dict()
+        self.hub.register_actions(self.actions)
+
+    def tearDown(self):
+        self.scheduler.terminate()
+        self.thread.join()
+
+    def subscribe(self, client, events):
+        response = self.actions["subscribe"](client,
+            {"action" : "subscribe", "events" : events}, None)
+        self.assertEqual(response["response_type"], "success")
+        return response["subscription_id"]
+
+    def wait_for_flush(self):
+        done = threading.Event()
+        self.scheduler.call_later(0.1, done.set)
+        self.assertTrue(done.wait(5))
+
+    def test_coalescing(self):
+        client = FakeClient()
+        self.subscribe(client, ["item-changed"])
+        for i in range(1000):
+            self.hub.publish("item-changed", "a", item_id="a", version=i)
+        self.hub.publish("item-changed", "b", item_id="b")
+        self.hub.publish("gateway-status", "x")
+        self.wait_for_flush()
+        self.assertEqual(len(client.sent), 1)
+        events = client.sent[0]["events"]
+        self.assertEqual(len(events), 2)
+        self.assertEqual([e for e in events if e["item_id"] == "a"][0][
+            "version"], 999)
+        self.assertEqual(client.sent[0]["coalesced"], 999)
+
+    def test_overflow_and_close(self):
+        client = FakeClient()
+        self.subscribe(client, ["item-added"])
+        for i in range(101):
+            self.hub.publish("item-added", i, item_id=i)
+        self.wait_for_flush()
+        self.assertEqual(client.sent[0]["events"], [{"event" : "resync"}])
+
+        # fewer events, but too large to fit into one message together:
+        client.sent = []
+        for i in range(90):
+            self.hub.publish("item-added", i, item_id=("%093d" % i),
+                tags=["tag"] * 20)
+        self.wait_for_flush()
+        self.assertEqual(client.sent[0]["events"], [{"event" : "resync"}])
+
+        for func in client.close_callbacks:
+            func()
+        self.assertEqual(self.hub.subscriber_count(), 0)
+        response = self.actions["subscribe"](client,
+            {"action" : "subscribe", "events" : ["nonsense"]}, None)
+        self.assertEqual(response["response_type"], "error")
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,76 @@
+'''
+information-node - an advanced tool for data synchronization
+Copyright (C) 2015  Information Node Development Team (see AUTHORS.md)
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 2 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+
+import shutil
+import tempfile
+import unittest
+
+from informationnode.daemon.permissions import PeerPermissions
+from informationnode.daemon.storage.metadataindex import MetadataIndex
+from informationnode.daemon.storage.tagindex import TagIndex
+
+class TestPeerPermissions(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.tag_index = TagIndex(self.path)
+        self.index = MetadataIndex(self.path, tag_index=self.tag_index)
+        self.index.update_from_record("a", 1, {"tags" : ["work", "photos"]})
+        self.index.update_from_record("b", 1, {"tags" : ["private"]})
+        self.actions = dict()
+        PeerPermissions(self.path, self.tag_index,
+            self.index).register_actions(self.actions)
+
+    def tearDown(self):
+        self.index.close()
+        self.tag_index.close()
+        shutil.rmtree(self.path)
+
+    def call(self, action, **args):
+        msg = {"action" : action}
+        msg.update(args)
+        return self.actions[action](None, msg, None)
+
+    def check(self, item_id, access="read"):
+        return self.call("check-permission", fingerprint="peer",
+            item_id=item_id, access=access)["allowed"]
+
+    def test_tag_list_permissions(self):
+        self.assertEqual(self.call("allow-read", fingerprint="peer",
+            tags=["photos", "music"])["response_type"], "success")
+        self.assertTrue(self.check("a"))
+        self.assertFalse(self.check("b"))
+        self.assertFalse(self.check("a", "write-modify"))
+        self.assertFalse(self.check("unknown"))
+
+        # rules are stored in the node folder:
+        permissions = PeerPermissions(self.path, self.tag_index, self.index)
+        self.assertEqual(list(permissions.accessible_items("peer")),
+            [self.index.item_ordinal("a")])
+
+        self.index.update_from_record("b", 2, {"tags" : ["music"]})
+        self.assertTrue(self.check("b"))
+        self.call("revoke-read", tags=["music"])
+        self.assertFalse(self.check("b"))
+        self.assertEqual(self.call("allow-read", tags=["x"])[
+            "response_type"], "error")
+        self.call("revoke-read", fingerprint="peer")
+        self.assertFalse(self.check("a"))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,65 @@
+'''
+information-node - an advanced tool for data synchronization
+Copyright (C) 2015  Information Node Development Team (see AUTHORS.md)
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 2 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+
+import threading
+import time
+import unittest
+
+from informationnode.daemon.scheduler import Scheduler
+
+class SchedulerTest(unittest.TestCase):
+    def setUp(self):
+        self.scheduler = Scheduler()
+        self.thread = threading.Thread(target=self.scheduler.run)
+        self.thread.start()
+
+    def tearDown(self):
+        self.scheduler.terminate()
+        self.thread.join(5.0)
+
+    def test_order(self):
+        results = []
+        done = threading.Event()
+        self.scheduler.call_later(0.1, results.append, 2)
+        self.scheduler.call_later(0.15, done.set)
+        self.scheduler.call_later(0.05, results.append, 1)
+        cancelled = self.scheduler.call_later(0.01, results.append, 0)
+        cancelled.cancel()
+        self.assertTrue(done.wait(5.0))
+        self.assertEqual(results, [1, 2])
+
+    def test_call_every(self):
+        calls = []
+        action = self.scheduler.call_every(0.02, lambda: calls.append(1))
+        time.sleep(0.2)
+        action.cancel()
+        count = len(calls)
+        self.assertTrue(count >= 3)
+        time.sleep(0.1)
+        self.assertEqual(len(calls), count)
+
+    def test_fast_terminate(self):
+        # an idle scheduler with a far-off timer must stop right away:
+        self.scheduler.call_later(3600, lambda: None)
+        time.sleep(0.05)
+        started = time.monotonic()
+        self.scheduler.terminate()
+        self.thread.join(5.0)
+        self.assertFalse(self.thread.is_alive())
+        self.assertTrue(time.monotonic() - started < 0.1)
@@ -0,0 +1,207 @@
+'''
+information-node - an advanced tool for data synchronization
+Copyright (C) 2015  Information Node Development Team (see AUTHORS.md)
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 2 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+
+import io
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import unittest
+
+from informationnode.client.api.apiclient import ApiClient
+from informationnode.daemon.apiserver import FileSocketApiServer, \
+    make_response
+from informationnode.daemon.streams import StreamTransfers
+from informationnode.daemon.workerpool import InternalApiWorkerPool
+
+class MemoryContent(object):
+    """ In-memory stand-in for an ItemChunkManager. """
+    def __init__(self, chunk_size):
+        self.chunk_size = chunk_size
+        self.chunks = dict()
+        self.saved = False
+        self.discarded = False
+        self.contents_finalized = False
+
+    def content_chunk_count(self):
+        return len(self.chunks)
+
+    def content_get_chunk(self, chunk_no):
+        return self.chunks[chunk_no]
+
+    def content_set_chunk(self, chunk_no, data):
+        self.chunks[chunk_no] = data
+
+    def crop_chunks(self, chunk_amount):
+        for chunk_no in list(self.chunks.keys()):
+            if chunk_no >= chunk_amount:
+                del(self.chunks[chunk_no])
+
+    def save(self):
+        self.saved = True
+        self.contents_finalized = True
+
+    def discard(self):
+        self.discarded = True
+        self.contents_finalized = True
+
+class StreamDaemon(object):
+    def __init__(self, node_path):
+        self.contents = dict()
+        self.actions = dict()
+        self.streams = StreamTransfers(self.open_content, window=4)
+        self.streams.register_actions(self.actions)
+        self.pool = InternalApiWorkerPool(self.process, worker_count=2,
+            queue_size=1)
+        self.pool.start()
+        api_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        api_socket.bind(os.path.join(node_path, "api_access.sock"))
+        self.api_server = FileSocketApiServer(self, api_socket)
+        self.thread = threading.Thread(target=self.api_server.run)
+        self.thread.start()
+
+    def open_content(self, item_id, writable):
+        if writable:
+            self.contents[item_id] = MemoryContent(1000)
+        elif not item_id in self.contents:
+            raise ValueError("no such item")
+        return self.contents[item_id]
+
+    def process(self, client, msg, data):
+        response = self.actions[msg["action"]](client, msg, data)
+        if response != None:
+            client.respond(response)
+        client.request_done()
+
+    def queue_internal_request(self, client, msg, data=None):
+        return self.pool.submit(client, msg, data)
+
+    def api_retry_after_ms(self, msg):
+        return self.pool.retry_after_ms(msg)
+
+    def terminate(self):
+        self.pool.terminate()
+        self.pool.join()
+        self.api_server.terminate()
+        self.thread.join()
+        self.api_server.api_socket.close()
+
+class StreamTransfersTest(unittest.TestCase):
+    def setUp(self):
+        self.node_path = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.node_path, "storage"))
+        for name, contents in [("identity.secret", "-"),
+                ("pidfile", str(os.getpid()))]:
+            with open(os.path.join(self.node_path, name), "w") as f:
+                f.write(contents)
+        self.daemon = StreamDaemon(self.node_path)
+        self.client = ApiClient(self.node_path)
+
+    def tearDown(self):
+        self.daemon.terminate()
+        shutil.rmtree(self.node_path)
+
+    def test_upload_download(self):
+        payload = os.urandom(25500)
+        (result, response) = self.client.upload("item1", io.BytesIO(payload))
+        self.assertTrue(result, response)
+        self.assertEqual(response["chunks_received"], 26)
+        content = self.daemon.contents["item1"]
+        self.assertTrue(content.saved)
+        self.assertEqual(len(content.chunks[0]), 1000)
+        self.assertEqual(len(content.chunks[25]), 500)
+
+        out = io.BytesIO()
+        self.assertEqual(self.client.download("item1", out), (True, 26))
+        self.assertEqual(out.getvalue(), payload)
+        self.assertEqual(self.daemon.streams.stream_count(), 0)
+
+    def test_download_unknown_item(self):
+        (result, response) = self.client.download("nope", io.BytesIO())
+        self.assertFalse(result)
+        self.assertEqual(response["response_type"], "error")
+
+class StreamCleanupTest(unittest.TestCase):
+    """ Calls the stream actions directly with a fake client. """
+    class Client(object):
+        framing = "binary"
+
+        def __init__(self):
+            self.sent = []
+            self.close_callbacks = []
+
+        def respond(self, obj, data=None):
+            self.sent.append(obj)
+            return True
+
+        def add_close_callback(self, func):
+            self.close_callbacks.append(func)
+
+    def setUp(self):
+        self.contents = dict()
+        self.actions = dict()
+        self.streams = StreamTransfers(self.open_content, window=4)
+        self.streams.register_actions(self.actions)
+        self.client = self.Client()
+
+    def open_content(self, item_id, writable):
+        if writable:
+            self.contents[item_id] = MemoryContent(10)
+        return self.contents[item_id]
+
+    def call(self, action, **args):
+        msg = {"action" : action, "item_id" : "item"}
+        msg.update(args)
+        return self.actions[action](self.client, msg, args.get("data", None))
+
+    def test_aborted_upload_discarded(self):
+        stream_id = self.call("stream-upload")["stream_id"]
+        self.call("stream-data", stream_id=stream_id, chunk_no=0,
+            data=b"abc")
+        response = self.call("stream-data", stream_id=stream_id,
+            chunk_no=1, data=b"x" * 11)
+        self.assertEqual(response["response_type"], "error")
+        self.assertTrue(self.contents["item"].discarded)
+        self.assertEqual(self.streams.stream_count(), 0)
+
+        # a client that disconnects in the middle of an upload:
+        self.call("stream-upload")
+        for callback in self.client.close_callbacks:
+            callback()
+        self.assertTrue(self.contents["item"].discarded)
+        self.assertFalse(self.contents["item"].saved)
+
+    def test_ack_after_download_end(self):
+        stream_id = self.call("stream-upload")["stream_id"]
+        self.call("stream-data", stream_id=stream_id, chunk_no=0,
+            data=b"abc")
+        self.call("stream-end", stream_id=stream_id, chunk_count=1)
+        self.assertTrue(self.contents["item"].saved)
+        self.assertFalse(self.contents["item"].discarded)
+
+        self.assertEqual(self.call("stream-download"), None)
+        stream_id = [msg for msg in self.client.sent if \
+            msg.get("responded_action", None) == "stream-download"][0][
+            "stream_id"]
+        self.assertEqual(self.client.sent[-1]["action"], "stream-end")
+        self.assertEqual(self.call("stream-ack", stream_id=stream_id,
+            count=1), None)
+        self.assertEqual(self.call("stream-ack", stream_id=stream_id + 5,
+            count=1)["response_type"], "error")
@@ -0,0 +1,77 @@
+'''
+information-node - an advanced tool for data synchronization
+Copyright (C) 2015  Information Node Development Team (see AUTHORS.md)
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 2 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+
+import threading
+import time
+import unittest
+
+from informationnode.daemon.workerpool import InternalApiWorkerPool
+
+class InternalApiWorkerPoolTest(unittest.TestCase):
+    def setUp(self):
+        self.results = []
+        self.results_lock = threading.Lock()
+        self.done = threading.Semaphore(0)
+        self.pool = InternalApiWorkerPool(self.process, worker_count=4)
+        self.pool.start()
+
+    def tearDown(self):
+        self.pool.terminate()
+        self.pool.join()
+
+    def process(self, client, msg, data):
+        time.sleep(msg.get("delay", 0))
+        with self.results_lock:
+            self.results.append((msg.get("item_id", None), msg["no"]))
+        self.done.release()
+
+    def test_same_item_stays_ordered(self):
+        for i in range(20):
+            self.pool.submit(None, {"item_id" : "abc", "no" : i,
+                "delay" : 0.001})
+        for i in range(20):
+            self.assertTrue(self.done.acquire(timeout=5.0))
+        self.assertEqual([no for (item, no) in self.results],
+            list(range(20)))
+        self.assertEqual(self.pool.stats()["queue_depth"], 0)
+
+    def test_slow_item_doesnt_block_others(self):
+        self.pool.submit(None, {"item_id" : "slow", "no" : 0,
+            "delay" : 0.5})
+        slow_worker = self.pool.worker_for({"item_id" : "slow"})
+        other_item = [str(i) for i in range(100) if \
+            self.pool.worker_for({"item_id" : str(i)}) != slow_worker][0]
+        self.pool.submit(None, {"item_id" : other_item, "no" : 1})
+        self.assertTrue(self.done.acquire(timeout=5.0))
+        self.assertEqual(self.results[0], (other_item, 1))
+        self.assertTrue(self.done.acquire(timeout=5.0))
+
+        stats = self.pool.stats()
+        self.assertEqual(stats["worker_count"], 4)
+        self.assertEqual(sum([w["processed"] for w in stats["workers"]]), 2)
+        self.assertTrue(stats["utilisation"] > 0)
+
+    def test_bounded_queue(self):
+        pool = InternalApiWorkerPool(self.process, worker_count=1,
+            queue_size=2)
+        self.assertEqual(pool.submit(None, {"no" : 0}), (True, None))
+        self.assertEqual(pool.submit(None, {"no" : 1}), (True, None))
+        (result, retry_after_ms) = pool.submit(None, {"no" : 2})
+        self.assertFalse(result)
+        self.assertTrue(retry_after_ms >= pool.MIN_RETRY_AFTER_MS)
@@ -0,0 +1,170 @@
+'''
+information-node - an advanced tool for data synchronization
+Copyright (C) 2015  Information Node Development Team (see AUTHORS.md)
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 2 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+
+import logging
+import queue
+import threading
+import time
+import zlib
+
+class InternalApiWorker(threading.Thread):
+    """ One worker of the InternalApiWorkerPool. It processes the requests
+        of its own queue one after another.
+    """
+    def __init__(self, pool, no, queue_size):
+        super().__init__()
+        self.pool = pool
+        self.no = no
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.busy = False
+        self.busy_seconds = 0.0
+        self.processed = 0
+
+    def run(self):
+        try:
+            while not self.pool._terminate:
+                # sleep until there's work, or until woken up for shutdown:
+                request = self.queue.get()
+                if request == None:
+                    continue
+                (client, msg, data) = request
+                self.busy = True
+                started = time.monotonic()
+                try:
+                    self.pool.process(client, msg, data)
+                finally:
+                    self.busy_seconds += time.monotonic() - started
+                    self.processed += 1
+                    self.busy = False
+        except Exception as e:
+            logging.exception("unhandled exception in InternalApiWorker")
+            raise e
+
+class InternalApiWorkerPool(object):
+    """ A pool of internal api processor threads which do the actual I/O
+        work on disk.
+
+        Requests concerning an item (with an "item_id") are always routed to
+        the same worker, so all operations on one item happen in the order
+        they were received. Other items are processed by the other workers
+        in parallel. Requests without an item are given to the worker with
+        the shortest queue.
+
+        The queue of each worker is bounded by queue_size. When a request
+        cannot be queued, the caller is told how long it should wait before
+        retrying instead.
+    """
+    MIN_RETRY_AFTER_MS=10
+    MAX_RETRY_AFTER_MS=5000
+    def __init__(self, process_func, worker_count=4, queue_size=256):
+        if worker_count < 1:
+            raise ValueError("at least one worker is required")
+        if queue_size < 1:
+            raise ValueError("queue size needs to be positive")
+        self.process_func = process_func
+        self.queue_size = queue_size
+        self.started = time.monotonic()
+        self._terminate = False
+        self.workers = [InternalApiWorker(self, i, queue_size) \
+            for i in range(worker_count)]
+
+    def start(self):
+        for worker in self.workers:
+            worker.start()
+
+    def terminate(self):
+        self._terminate = True
+
+        # wake up idle workers. A worker with a full queue is busy and will
+        # notice the termination after its current request anyway:
+        for worker in self.workers:
+            try:
+                worker.queue.put_nowait(None)
+            except queue.Full:
+                pass
+
+    def join(self):
+        for worker in self.workers:
+            worker.join()
+
+    def process(self, client, msg, data):
+        self.process_func(client, msg, data)
+
+    def worker_for(self, msg):
+        """ Pick the worker which should process the given request. """
+        item_id = msg.get("item_id", None)
+        if item_id != None:
+            shard = zlib.crc32(str(item_id).encode("utf-8", "ignore"))
+            return self.workers[shard % len(self.workers)]
+        return min(self.workers, key=lambda worker: worker.queue.qsize())
+
+    def retry_after_ms(self, msg):
+        """ Estimate how long it takes until the worker responsible for the
+            given request has room for it again, in milliseconds.
+        """
+        worker = self.worker_for(msg)
+        if worker.processed > 0:
+            per_request = worker.busy_seconds / worker.processed
+        else:
+            per_request = 0.0
+        estimate = int(per_request * worker.queue.qsize() * 1000)
+        return max(self.MIN_RETRY_AFTER_MS, min(estimate,
+            self.MAX_RETRY_AFTER_MS))
+
+    def submit(self, client, msg, data=None):
+        """ Queue up a request. Returns (result, retry_after_ms)
+
+            result: True if the request was queued, False if the daemon is
+                    saturated
+            retry_after_ms: if result is False, the suggested time to wait
+                            before retrying
+        """
+        try:
+            self.worker_for(msg).queue.put_nowait((client, msg, data))
+        except queue.Full:
+            return (False, self.retry_after_ms(msg))
+        return (True, None)
+
+    def queue_depth(self):
+        return sum([worker.queue.qsize() for worker in self.workers])
+
+    def stats(self):
+        """ Get queue depth and utilisation info of all workers as a JSON
+            serializable dict. The utilisation is the fraction of time a
+            worker was busy since the pool was created.
+        """
+        uptime = max(time.monotonic() - self.started, 0.000001)
+        workers = []
+        for worker in self.workers:
+            workers.append({
+                "queue_depth" : worker.queue.qsize(),
+                "busy" : worker.busy,
+                "processed" : worker.processed,
+                "busy_seconds" : round(worker.busy_seconds, 3),
+                "utilisation" : round(min(worker.busy_seconds / uptime,
+                    1.0), 4),
+            })
+        return {
+            "worker_count" : len(self.workers),
+            "queue_size" : self.queue_size,
+            "queue_depth" : self.queue_depth(),
+            "utilisation" : round(sum([w["utilisation"] \
+                for w in workers]) / len(workers), 4),
+            "workers" : workers,
+        }
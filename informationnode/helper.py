@@ -19,6 +19,7 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 '''
 
 import argparse
+import datetime
 import json
 import os
 import platform
@@ -27,6 +28,7 @@ import socket
 import struct
 import sys
 import textwrap
+import time
 
 class DoubleLineBreakFormatter(argparse.HelpFormatter):
     """ Retains double line breaks/paragraphs """
@@ -47,6 +49,19 @@ class DoubleLineBreakFormatter(argparse.HelpFormatter):
     def _fill_text(self, t, width, indent):
         return self._static_fill_text(t, width, indent)
 
+def parse_isoformat(value):
+    """ Parse a time written by datetime.isoformat() without a time zone.
+        (datetime.fromisoformat() only exists since Python 3.7.)
+    """
+    if not isinstance(value, str):
+        raise TypeError("time needs to be a string")
+    for layout in ["%Y-%m-%dT%H:%M:%S.%f", "%Y-%m-%dT%H:%M:%S"]:
+        try:
+            return datetime.datetime.strptime(value, layout)
+        except ValueError:
+            pass
+    raise ValueError("invalid time: " + value)
+
 def check_if_node_dir(path, allow_new=False):
     """ Check if the given directory is a valid node path.
         If allow_new is True, an empty directory will also result in a
@@ -195,48 +210,147 @@ def get_api_socket_for_node(node_folder):
     s.settimeout(5.0)
     return (True, s)
 
-def send_json(sock, json_obj):
+# Messages on the api socket are length-prefixed JSON per default. After
+# a successful "set-framing" request with "framing" : "binary", both sides
+# switch to binary frames instead, which consist of a FRAME_HEADER
+# (frame type, JSON length, data length) followed by the JSON message and
+# an optional raw data attachment which needs no escaping or base64.
+FRAME_HEADER = struct.Struct("!BII")
+FRAME_TYPE_MESSAGE = 1
+MAX_FRAME_DATA_SIZE = (1024 * 1024 * 16)
+
+def encode_json(json_obj):
+    """ Encode the given JSON object as a length-prefixed message as it is
+        sent over the api socket by send_json.
+    """
     data = json.dumps(json_obj).encode("utf-8", "ignore")
-    length_bytes = struct.pack("!i", len(data))
+    return struct.pack("!i", len(data)) + data
+
+def encode_frame(json_obj, data=None):
+    """ Encode the given JSON object and optional raw data as a binary frame.
+        Returns a list of buffers to be sent in order, so the data doesn't
+        need to be copied.
+    """
+    msg = json.dumps(json_obj).encode("utf-8", "ignore")
+    data_len = 0
+    if data != None:
+        data_len = len(memoryview(data).cast("B"))
+    buffers = [FRAME_HEADER.pack(FRAME_TYPE_MESSAGE, len(msg), data_len),
+        msg]
+    if data_len > 0:
+        buffers.append(data)
+    return buffers
+
+def decode_json_msg(buf, offset=0, max_size=(1024 * 20)):
+    """ Decode a length-prefixed JSON message in buf at the given offset,
+        which is useful when reading from a non-blocking socket.
+
+        Returns (msg, next_offset), or (None, offset) if the message isn't
+        complete yet. Raises a ValueError if the message is oversized or
+        broken, in which case the connection should be dropped.
+    """
+    if len(buf) - offset < 4:
+        return (None, offset)
+    (msg_size,) = struct.unpack_from("!i", buf, offset)
+    if msg_size < 0 or (max_size > 0 and msg_size > max_size):
+        raise ValueError("invalid message size: " + str(msg_size))
+    if len(buf) - offset - 4 < msg_size:
+        return (None, offset)
+    msg = json.loads(bytes(buf[offset + 4:offset + 4 + msg_size]).decode(
+        "utf-8", "ignore"))
+    return (msg, offset + 4 + msg_size)
+
+def decode_frame(buf, offset=0, max_size=(1024 * 20),
+        max_data_size=MAX_FRAME_DATA_SIZE):
+    """ Decode a binary frame in buf at the given offset, like
+        decode_json_msg.
+
+        Returns (msg, data, next_offset) with data being None if the frame
+        has no data attachment, or (None, None, offset) if the frame isn't
+        complete yet. Raises a ValueError for invalid frames.
+    """
+    if len(buf) - offset < FRAME_HEADER.size:
+        return (None, None, offset)
+    (frame_type, msg_size, data_size) = FRAME_HEADER.unpack_from(buf, offset)
+    if frame_type != FRAME_TYPE_MESSAGE:
+        raise ValueError("unknown frame type: " + str(frame_type))
+    if (max_size > 0 and msg_size > max_size) or \
+            (max_data_size > 0 and data_size > max_data_size):
+        raise ValueError("frame exceeds size limit")
+    start = offset + FRAME_HEADER.size
+    if len(buf) - start < msg_size + data_size:
+        return (None, None, offset)
+    msg = json.loads(bytes(buf[start:start + msg_size]).decode(
+        "utf-8", "ignore"))
+    data = None
+    if data_size > 0:
+        data = bytes(buf[start + msg_size:start + msg_size + data_size])
+    return (msg, data, start + msg_size + data_size)
+
+def send_json(sock, json_obj):
     try:
-        sock.send(length_bytes)
+        sock.sendall(encode_json(json_obj))
     except (socket.timeout, BrokenPipeError):
         return False
+    return True
+
+def send_buffers(sock, buffers):
+    """ Send all the given buffers, with a single sendmsg call where
+        possible.
+    """
+    if not hasattr(sock, "sendmsg"):
+        # e.g. on windows.
+        sock.sendall(b"".join(buffers))
+        return
+    views = [memoryview(b).cast("B") for b in buffers]
+    while len(views) > 0:
+        sent = sock.sendmsg(views)
+        while sent > 0 and len(views) > 0:
+            if sent >= len(views[0]):
+                sent -= len(views[0])
+                views.pop(0)
+            else:
+                views[0] = views[0][sent:]
+                sent = 0
+
+def send_frame(sock, json_obj, data=None):
+    """ Send a binary frame (see encode_frame). The socket needs to have
+        been switched to binary framing with negotiate_framing first.
+    """
     try:
-        sock.send(data)
-    except (socket.timeout, BrokenPipeError):
+        send_buffers(sock, encode_frame(json_obj, data))
+    except (socket.timeout, BrokenPipeError, ConnectionResetError):
         return False
     return True
 
+def _recv_into(sock, view):
+    """ Fill the given memoryview completely from the socket. Returns False
+        if the connection broke before.
+    """
+    got = 0
+    while got < len(view):
+        try:
+            amount = sock.recv_into(view[got:])
+        except (socket.timeout, BrokenPipeError, ConnectionResetError):
+            return False
+        if amount == 0:
+            return False
+        got += amount
+    return True
+
 def recv_json(sock, max_size=(1024 * 20)):
     # get message size:
-    msg_size = b""
-    while len(msg_size) < 4:
-        try:
-            new_data = sock.recv(4 - len(msg_size))
-        except (socket.timeout, BrokenPipeError):
-            return None
-        if len(new_data) == 0:
-            return None
-        msg_size += new_data
-    assert(len(msg_size) == 4)
-    msg_size = struct.unpack("!i", msg_size)
-    assert(len(msg_size) == 1)
-    msg_size = msg_size[0]
-    if max_size > 0 and msg_size > max_size:
+    msg_size = bytearray(4)
+    if not _recv_into(sock, memoryview(msg_size)):
+        return None
+    (msg_size,) = struct.unpack("!i", msg_size)
+    if msg_size < 0 or (max_size > 0 and msg_size > max_size):
         return None
 
     # get message:
-    msg = b""
-    while len(msg) < msg_size:
-        try:
-            new_data = sock.recv(msg_size - len(msg))
-        except (socket.timeout, BrokenPipeError):
-            return None
-        if len(new_data) == 0:
-            return None
-        msg += new_data
-    assert(len(msg) == msg_size)
+    msg = bytearray(msg_size)
+    if not _recv_into(sock, memoryview(msg)):
+        return None
 
     # process message:
     try:
@@ -244,3 +358,74 @@ def recv_json(sock, max_size=(1024 * 20)):
     except ValueError:
         return None
 
+class FrameReader(object):
+    """ Receives binary frames from a socket into a buffer which is allocated
+        once and reused, growing only if a larger frame arrives.
+    """
+    def __init__(self, sock, max_size=(1024 * 20),
+            max_data_size=MAX_FRAME_DATA_SIZE, initial_size=(1024 * 128)):
+        self.sock = sock
+        self.max_size = max_size
+        self.max_data_size = max_data_size
+        self.header = bytearray(FRAME_HEADER.size)
+        self.buf = bytearray(initial_size)
+
+    def recv(self):
+        """ Receive the next frame. Returns (msg, data), or (None, None) if
+            the connection broke or an invalid frame was received.
+
+            data is a memoryview into the reader's buffer which is only valid
+            until the next call of recv() - copy it if you need to keep it.
+        """
+        if not _recv_into(self.sock, memoryview(self.header)):
+            return (None, None)
+        (frame_type, msg_size, data_size) = FRAME_HEADER.unpack(self.header)
+        if frame_type != FRAME_TYPE_MESSAGE or \
+                (self.max_size > 0 and msg_size > self.max_size) or \
+                (self.max_data_size > 0 and data_size > self.max_data_size):
+            return (None, None)
+        if msg_size + data_size > len(self.buf):
+            self.buf = bytearray(msg_size + data_size)
+        view = memoryview(self.buf)
+        if not _recv_into(self.sock, view[:msg_size + data_size]):
+            return (None, None)
+        try:
+            msg = json.loads(bytes(view[:msg_size]).decode("utf-8",
+                "ignore"))
+        except ValueError:
+            return (None, None)
+        data = None
+        if data_size > 0:
+            data = view[msg_size:msg_size + data_size]
+        return (msg, data)
+
+def negotiate_framing(sock, framing="binary"):
+    """ Ask the data server to switch the given api socket connection, which
+        must still use the default JSON framing, to the given framing.
+        Returns True on success, after which send_frame and a FrameReader
+        must be used.
+    """
+    if not send_json(sock, {"action" : "set-framing", "framing" : framing}):
+        return False
+    response = recv_json(sock)
+    return isinstance(response, dict) and \
+        response.get("response_type", None) == "success"
+
+def request_json(sock, json_obj, max_busy_retries=20):
+    """ Send the given request and return the response. If the data server
+        responds that it is busy, wait for as long as it suggests and send
+        the request again, up to max_busy_retries times.
+
+        Returns the response, or None if the connection failed.
+    """
+    retries = 0
+    while True:
+        if not send_json(sock, json_obj):
+            return None
+        response = recv_json(sock)
+        if response == None or not isinstance(response, dict) or \
+                response.get("response_type", None) != "busy" or \
+                retries >= max_busy_retries:
+            return response
+        retries += 1
+        time.sleep(max(int(response.get("retry_after_ms", 100)), 1) / 1000.0)
@@ -72,6 +72,8 @@ setup(
     package_data={"informationnode" : ['data/*']},
     scripts=['information-node', 'inode-viewer', 'inode-viewer-cli'],
     install_requires=required,
+    # content-defined chunking (--chunking cdc) is much faster with numpy:
+    extras_require={"cdc" : ["numpy>=1.9"]},
     long_description=open(os.path.join(os.path.dirname(__file__),
         'README.md'), "r").read(),
     classifiers=[